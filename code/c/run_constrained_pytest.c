@@ -57,6 +57,37 @@
  * NB: the " characters are escaped in the example above to protect them
  * from the shell
  *
+ * The user (and group) the code runs as is the owner of the installed
+ * executable. To test several submissions at the same time, install a
+ * copy owned by a user of its own for each testing worker (run_stud1,
+ * run_stud2, ...; see subtest_sandboxes in the configuration), so
+ * that the code tested in one cannot get at the files or processes of
+ * another. $USER and $HOME are set to those of that user.
+ *
+ * Called as
+ *
+ *   run_constrained_pytest --forkserver [module ...] < listening socket
+ *
+ * the wrapper starts the fork server (see subtest/forkserver.py) as
+ * the same user, with the same limits (except for the CPU time, which
+ * the fork server applies to each job it runs) and environment,
+ * instead of py.test. The fork server imports py.test and the given
+ * modules once, and then runs each job in a process forked from it,
+ * taking requests on the unix socket passed as its stdin (created by
+ * the caller where run_stud cannot write). It runs with the python of
+ * py.test (from the #! line of PYTEST), so that jobs are tested as
+ * py.test would test them; -DFORKSERVER_PYTHON sets another one. The
+ * path of forkserver.py (which must be readable by run_stud) can be
+ * set with -DFORKSERVER, as for -DPYTEST above.
+ *
+ * Called as
+ *
+ *   run_constrained_pytest --pythonpath <directory> <script> ...
+ *
+ * the directory is put in front of the PYTHONPATH given below (the
+ * precompiled environment of an assignment, see
+ * subtest.assignment_environment()).
+ *
  * We define _XOPEN_SOURCE=600 in order to expose definitions for SUSv3
  * (UNIX03; i.e. POSIX.1-2001 base spec + XSI extension).  This is
  * required so that the compiler can see definitions of the setenv
@@ -76,13 +107,31 @@
 #include <errno.h>
 #include <string.h>
 #include <signal.h>
+#include <pwd.h>
 
 #ifndef PYTEST
 #define PYTEST "/usr/local/bin/py.test"
 #endif
 
+#ifndef FORKSERVER
+#define FORKSERVER "/home/run_stud/code/python-libs/forkserver.py"
+#endif
+
+/* CPU time limit in seconds (see below) */
+#define CPU_SECONDS 90UL
+
 static char* py_call = PYTEST;
 
+#ifdef FORKSERVER_PYTHON
+static char* forkserver_python = FORKSERVER_PYTHON;
+#else
+static char* forkserver_python = 0; /* the python of py.test */
+#endif
+
+/* NB: PYTHONPATH must come first (see --pythonpath), HOME and USER
+   are replaced by those of the user we run as */
+#define ENV_HOME 2
+#define ENV_USER 3
 static char *wrapped_env[]={"PYTHONPATH=/home/run_stud/code/python-libs","DISPLAY=:2.0","HOME=/home/run_stud","USER=run_stud","PATH=/usr/local/bin:/bin:/usr/bin:/usr/local/X11/bin:/usr/X11/bin","LANG=C","TERM=ansi","SHELL=/bin/sh","LANGUAGE=uk",0};
 
 static char* rxstr_path_and_file="^\\(.*\\)/\\([^/]*\\)$";
@@ -113,18 +162,100 @@ static void handle_sigterm(int n) {
   exit(0);
 }
 
+/* Reads the #! line of py.test: sets *interpreter to its python and
+   *argument to the argument given to it (0 if none), as the kernel
+   would split the line. */
+static void pytest_interpreter(char **interpreter, char **argument) {
+  static char line[256];
+  FILE *f;
+  char *p, *end;
+
+  if(NULL==(f=fopen(py_call,"r")))
+    err_sys("cannot open py.test to find its python");
+  if(NULL==fgets(line,sizeof(line),f) || 0!=strncmp(line,"#!",2)
+     || NULL==(end=strchr(line,'\n'))) {
+    aiee("no #! line in py.test to find its python (compile with -DFORKSERVER_PYTHON)");
+  }
+  fclose(f);
+
+  while(end>line && (end[-1]=='\n' || end[-1]=='\r' || end[-1]==' ' || end[-1]=='\t'))
+    end--;
+  *end=0;
+  for(p=line+2; *p==' ' || *p=='\t'; p++)
+    ;
+  *interpreter=p;
+  while(*p && *p!=' ' && *p!='\t')
+    p++;
+  *argument=0;
+  if(*p) {
+    *p++=0;
+    while(*p==' ' || *p=='\t')
+      p++;
+    if(*p)
+      *argument=p;
+  }
+}
+
+static void enforce_limits(int limit_cpu) {
+  static struct rlimit limit;
+
+  /* Enforcing limits... limit to the minimum of any existing limit or
+     our chosen value. */
+
+  /* Address space (virtual memory): 500 MB */
+  if(0!=getrlimit(RLIMIT_AS,&limit))
+    err_sys("getrlimit() failure!\n");
+
+  /* A limit of 500MB virtual memory  */
+   limit.rlim_cur=limit.rlim_max=min(limit.rlim_max,500*1048576);
+  if(0!=setrlimit(RLIMIT_AS,&limit))
+    err_sys("setrlimit() failure!\n");
+
+  /* CPU time: 90 seconds -- we check the execution time from Python
+     which makes it easier to identify that an infinite loop is the problem
+     and to give feedback to the student. The time specified here
+     is only a hard-coded upper limit. (The fork server sets it for
+     each job instead.) */
+  if(limit_cpu) {
+    if(0!=getrlimit(RLIMIT_CPU,&limit))
+      err_sys("getrlimit() failure!\n");
+
+    limit.rlim_cur = limit.rlim_max = min(limit.rlim_max,CPU_SECONDS);
+    if(0!=setrlimit(RLIMIT_CPU,&limit))
+      err_sys("setrlimit() failure!\n");
+  }
+
+  /* Maximum disk file size: 1 MiB (protects against using all the
+	 * disk space capturing stdout of unterminated loops etc)*/
+  if(0!=getrlimit(RLIMIT_FSIZE,&limit))
+    err_sys("getrlimit() failure for RLIMIT_FSIZE!\n");
+
+  limit.rlim_cur=limit.rlim_max=min(limit.rlim_max,1048576);
+  if(0!=setrlimit(RLIMIT_FSIZE,&limit))
+    err_sys("setrlimit() failure for RLIMIT_FSIZE!\n");
+
+  /* Resident Set Size: 500 MB */
+  if(0!=getrlimit(RLIMIT_RSS,&limit))
+    err_sys("getrlimit() failure!\n");
+  limit.rlim_cur=limit.rlim_max=min(limit.rlim_max,500*1048576);
+
+  if(0!=setrlimit(RLIMIT_RSS,&limit))
+    err_sys("setrlimit() failure!\n");
+}
+
 int main(int argc, char **argv, char **envp)
 {
-  int i;
+  int i, nargs;
   uid_t uid;
   gid_t gid;
+  struct passwd *pw;
   int child_pid;
   char **pycall;
   static regex_t rx_path_and_file;
-  static struct rlimit limit;
   static regmatch_t matches[3];
+  static char cpu_seconds[32];
   int len_path,len_script;
-  char *path, *script;
+  char *path, *script, *pythonpath, *argument;
 
   /* First of all, we fork. In fact, parent and child process are using the
      same I/O channels here, and all I/O will be handled by the child.
@@ -150,6 +281,16 @@ int main(int argc, char **argv, char **envp)
   /* If we got here, we are the child process... */
 
 
+  if(argc>=4 && 0==strcmp(argv[1],"--pythonpath")) {
+    if(NULL==(pythonpath=malloc(strlen(wrapped_env[0])+strlen(argv[2])+2))) {
+      err_sys("malloc() failure!");
+    }
+    sprintf(pythonpath,"PYTHONPATH=%s:%s",argv[2],wrapped_env[0]+strlen("PYTHONPATH="));
+    wrapped_env[0]=pythonpath;
+    argv+=2;
+    argc-=2;
+  }
+
   if(argc<2) {
     aiee("Need script to run!");
   }
@@ -165,6 +306,40 @@ int main(int argc, char **argv, char **envp)
   if(0!=setregid(gid,gid))
     err_sys("setgid() failed");
 
+  if(NULL==(pw=getpwuid(uid))) {
+    aiee("getpwuid() failed: unknown sandbox user");
+  }
+  if(   (NULL==(wrapped_env[ENV_HOME]=malloc(strlen("HOME=")+strlen(pw->pw_dir)+1)))
+	|| (NULL==(wrapped_env[ENV_USER]=malloc(strlen("USER=")+strlen(pw->pw_name)+1)))) {
+    err_sys("malloc() failure!");
+  }
+  sprintf(wrapped_env[ENV_HOME],"HOME=%s",pw->pw_dir);
+  sprintf(wrapped_env[ENV_USER],"USER=%s",pw->pw_name);
+
+  if(argc>=2 && 0==strcmp(argv[1],"--forkserver")) {
+    /* [python argument] forkserver.py <cpu seconds> [module ...] */
+    if(NULL==(pycall=malloc(sizeof(char*)*(4+argc)))) {
+      err_sys("malloc() failure!");
+    }
+    argument=0;
+    if(NULL==forkserver_python)
+      pytest_interpreter(&forkserver_python,&argument);
+    snprintf(cpu_seconds,sizeof(cpu_seconds),"%lu",CPU_SECONDS);
+    nargs=0;
+    pycall[nargs++]=forkserver_python;
+    if(argument)
+      pycall[nargs++]=argument;
+    pycall[nargs++]=FORKSERVER;
+    pycall[nargs++]=cpu_seconds;
+    for(i=2;i<argc;i++) {
+      pycall[nargs++] = argv[i];
+    }
+    pycall[nargs]=0;
+
+    enforce_limits(0);
+    goto run;
+  }
+
   if(0!=(regexec(&rx_path_and_file,argv[1],3,matches,0))) {
     aiee("regexec() failed on script path!");
   }
@@ -201,52 +376,16 @@ int main(int argc, char **argv, char **envp)
   for(i=2;i<argc;i++) {
     pycall[i] = argv[i];
   }
-  pycall[argc]=0;
-
-  /* Enforcing limits... limit to the minimum of any existing limit or
-     our chosen value. */
-
-  /* Address space (virtual memory): 500 MB */
-  if(0!=getrlimit(RLIMIT_AS,&limit))
-    err_sys("getrlimit() failure!\n");
-
-  /* A limit of 500MB virtual memory  */
-   limit.rlim_cur=limit.rlim_max=min(limit.rlim_max,500*1048576);
-  if(0!=setrlimit(RLIMIT_AS,&limit))
-    err_sys("setrlimit() failure!\n");
-
-  /* CPU time: 90 seconds -- we check the execution time from Python
-     which makes it easier to identify that an infinite loop is the problem
-     and to give feedback to the student. The time specified here
-     is only a hard-coded upper limit. */
-  if(0!=getrlimit(RLIMIT_CPU,&limit))
-    err_sys("getrlimit() failure!\n");
+  nargs=argc;
+  pycall[nargs]=0;
 
-  limit.rlim_cur = limit.rlim_max = min(limit.rlim_max,90UL); 
-  if(0!=setrlimit(RLIMIT_CPU,&limit))
-    err_sys("setrlimit() failure!\n");
-
-  /* Maximum disk file size: 1 MiB (protects against using all the
-	 * disk space capturing stdout of unterminated loops etc)*/
-  if(0!=getrlimit(RLIMIT_FSIZE,&limit))
-    err_sys("getrlimit() failure for RLIMIT_FSIZE!\n");
-
-  limit.rlim_cur=limit.rlim_max=min(limit.rlim_max,1048576);
-  if(0!=setrlimit(RLIMIT_FSIZE,&limit))
-    err_sys("setrlimit() failure for RLIMIT_FSIZE!\n");
-
-  /* Resident Set Size: 500 MB */
-  if(0!=getrlimit(RLIMIT_RSS,&limit))
-    err_sys("getrlimit() failure!\n");
-  limit.rlim_cur=limit.rlim_max=min(limit.rlim_max,500*1048576);
-
-  if(0!=setrlimit(RLIMIT_RSS,&limit))
-    err_sys("setrlimit() failure!\n");
+  enforce_limits(1);
 
+ run:
   if(0!=setenv("DISPLAY",":2.0",1))
     err_sys("setenv() on $DISPLAY failed!");
 
-  if(0!=setenv("HOME","/home/run_stud",1))
+  if(0!=setenv("HOME",pw->pw_dir,1))
     err_sys("setenv() on $HOME failed!");
 
   if(0!=execve(pycall[0],pycall,wrapped_env)) {
@@ -254,7 +393,7 @@ int main(int argc, char **argv, char **envp)
 
     fprintf(stderr, "filename: %s\n", pycall[0]);
 
-    for(int i=0; i <= argc; i++) {
+    for(int i=0; i <= nargs; i++) {
       fprintf(stderr, "argv[%d]: %s\n", i, pycall[i]);
     }
 
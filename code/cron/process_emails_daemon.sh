@@ -0,0 +1,49 @@
+#!/bin/bash
+
+# This file is part of the TeTePy software
+# Copyright (c) 2017, 2018, University of Southampton
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Keeps 'process_emails.py --daemon' running: run this from cron (for
+# example every few minutes) instead of process_emails.sh. It starts
+# the daemon unless the process recorded in the daemon's pid file is
+# still alive.
+
+. $HOME/bin/mysettings.sh
+
+if [ ! -d $HOME/$YEAR/log/ ] ; then
+  mkdir -p $HOME/$YEAR/log/
+fi
+
+PIDFILE=$HOME/$YEAR/log/process-emails.pid
+
+if [ -f $PIDFILE ] && kill -0 `cat $PIDFILE` 2> /dev/null ; then
+  exit 0
+fi
+
+nohup python $HOME/code/python/process_emails.py --daemon >> $HOME/$YEAR/log/process_emails.log 2>&1 &
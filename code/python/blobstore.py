@@ -0,0 +1,246 @@
+# This file is part of the TeTePy software
+# Copyright (c) 2017, 2018, University of Southampton
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+# Content-addressed storage of submitted files.
+#
+# Every attachment is stored once, under the SHA-1 of its content, in
+# a blob directory (conf.Blobdir). Each lab directory of a student
+# holds an append-only manifest (MANIFEST) with one line per stored
+# version:
+#
+#   <time>\t<sha1>\t<size>\t<filename>
+#
+# The latest version of each file is exposed in the lab directory
+# under its plain name as a hardlink to the blob (or as a copy if the
+# blob directory lives on another filesystem), so that the tests can
+# run in the lab directory as before. Storing a new version therefore
+# costs one blob write (none if the content is already known), one
+# manifest line and one rename, independent of how many versions
+# there are.
+
+import errno, fcntl, hashlib, os, re, shutil, tempfile, time
+
+MANIFEST = "_manifest.txt"
+
+# files in a lab directory which are not submitted files
+_rx_not_submitted = re.compile(r"^(log\.txt|_.*|.*\.[0-9]+)$")
+
+# names that cannot be stored: they would break the manifest format
+# (control characters) or point outside the lab directory
+_rx_bad_filename = re.compile(r"[\x00-\x1f\x7f/]")
+
+
+def is_storable_filename(filename):
+    """Return True if filename can be stored as a submitted file: it
+    must not be the manifest, contain control characters or a '/', or
+    be '.' or '..'."""
+    return filename not in (MANIFEST, '.', '..', '') and not _rx_bad_filename.search(filename)
+
+
+def blob_path(blobdir, digest):
+    """Return the path of the blob with the given sha1 hex digest."""
+    return os.path.join(blobdir, digest[:2], digest)
+
+
+def put_blob(blobdir, data):
+    """Store data in the blob directory (unless it is already there)
+    and return its sha1 hex digest."""
+    digest = hashlib.sha1(data).hexdigest()
+    path = blob_path(blobdir, digest)
+    if os.path.exists(path):
+        return digest
+
+    subdir = os.path.dirname(path)
+    try:
+        os.makedirs(subdir)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    # write under a temporary name and rename, so that a blob is
+    # either complete or absent
+    (fd, tmpname) = tempfile.mkstemp(dir=subdir, prefix=".tmp-")
+    try:
+        f = os.fdopen(fd, 'wb')
+        f.write(data)
+        f.close()
+        # blobs may be hardlinked into several lab directories
+        os.chmod(tmpname, 0444)
+        os.rename(tmpname, path)
+    except:
+        os.unlink(tmpname)
+        raise
+    return digest
+
+
+def read_manifest(lab_dir):
+    """Return the list of (time, sha1, size, filename) entries in the
+    manifest of lab_dir, oldest first, or None if there is no
+    manifest."""
+    try:
+        f = open(os.path.join(lab_dir, MANIFEST), 'r')
+    except IOError, e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    entries = []
+    for line in f:
+        fields = line.rstrip("\n").split("\t", 3)
+        if len(fields) != 4:
+            continue # incomplete last line after a crash
+        entries.append((float(fields[0]), fields[1], int(fields[2]), fields[3]))
+    f.close()
+    return entries
+
+
+def latest_versions(lab_dir):
+    """Return a dictionary mapping each filename in the manifest of
+    lab_dir to its latest (time, sha1, size, nversions) entry, or None
+    if there is no manifest."""
+    entries = read_manifest(lab_dir)
+    if entries is None:
+        return None
+    latest = {}
+    for (t, digest, size, filename) in entries:
+        nversions = 1
+        if filename in latest:
+            nversions += latest[filename][3]
+        latest[filename] = (t, digest, size, nversions)
+    return latest
+
+
+def latest_files(lab_dir):
+    """Return the sorted names of the files submitted for lab_dir.
+
+    Lab directories written before the blob store was introduced have
+    no manifest; for these we fall back to listing the directory,
+    leaving out the old 'name.N' backup copies and our own files."""
+    latest = latest_versions(lab_dir)
+    if latest is None:
+        if not os.path.isdir(lab_dir):
+            return []
+        latest = [x for x in os.listdir(lab_dir)
+                  if os.path.isfile(os.path.join(lab_dir, x))
+                  and not _rx_not_submitted.match(x)]
+    return sorted(latest)
+
+
+def versions(lab_dir, filename):
+    """Return the (time, sha1, size) entries for all stored versions of
+    filename in lab_dir, newest first."""
+    entries = read_manifest(lab_dir) or []
+    return [(t, digest, size) for (t, digest, size, name) in reversed(entries)
+            if name == filename]
+
+
+def _append_to_manifest(lab_dir, entries):
+    f = open(os.path.join(lab_dir, MANIFEST), 'a')
+    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    for (t, digest, size, filename) in entries:
+        f.write("%.3f\t%s\t%d\t%s\n" % (t, digest, size, filename))
+    f.flush()
+    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    f.close()
+
+
+def _expose(blobdir, digest, path):
+    """Make path refer to the blob digest: a hardlink if possible,
+    otherwise a copy. The old file at path (if any) is replaced
+    atomically."""
+    tmpname = "%s.tmp-%d" % (path, os.getpid())
+    if os.path.lexists(tmpname):
+        os.unlink(tmpname)
+    try:
+        os.link(blob_path(blobdir, digest), tmpname)
+    except OSError, e:
+        # EXDEV: blob store on another filesystem, EMLINK: too many
+        # links to one blob, EPERM: filesystem without hardlinks
+        if e.errno not in (errno.EXDEV, errno.EMLINK, errno.EPERM):
+            raise
+        shutil.copyfile(blob_path(blobdir, digest), tmpname)
+    os.rename(tmpname, path)
+
+
+def adopt_existing_files(blobdir, lab_dir):
+    """Create the manifest for a lab directory written before the blob
+    store existed, recording the files currently in it as their first
+    version. Old 'name.N' backups are left where they are."""
+    entries = []
+    for filename in latest_files(lab_dir):
+        path = os.path.join(lab_dir, filename)
+        f = open(path, 'rb')
+        data = f.read()
+        f.close()
+        digest = put_blob(blobdir, data)
+        entries.append((os.path.getmtime(path), digest, len(data), filename))
+        _expose(blobdir, digest, path)
+    _append_to_manifest(lab_dir, entries)
+
+
+def store_files(blobdir, lab_dir, files):
+    """Store the files (a dictionary mapping filename to content) as
+    the new versions in lab_dir and expose them under their names.
+
+    Returns a dictionary mapping each filename to the number of older
+    versions kept for it; a file whose content is identical to its
+    latest version is not recorded again and maps to None. Raises
+    ValueError for a filename that is not is_storable_filename()."""
+    for filename in files.keys():
+        if not is_storable_filename(filename):
+            raise ValueError, "Cannot store a file named %s" % repr(filename)
+    if not os.path.exists(os.path.join(lab_dir, MANIFEST)):
+        adopt_existing_files(blobdir, lab_dir)
+    latest = latest_versions(lab_dir)
+
+    now = time.time()
+    entries = []
+    kept = {}
+    for filename in files.keys():
+        data = files[filename]
+        digest = put_blob(blobdir, data)
+        path = os.path.join(lab_dir, filename)
+        if filename in latest and latest[filename][1] == digest \
+                and os.path.exists(path):
+            kept[filename] = None
+            continue
+        if filename in latest:
+            kept[filename] = latest[filename][3]
+        else:
+            kept[filename] = 0
+        entries.append((now, digest, len(data), filename))
+        _expose(blobdir, digest, path)
+    _append_to_manifest(lab_dir, entries)
+    return kept
+
+
+def open_version(blobdir, lab_dir, filename, version=0):
+    """Open a stored version of filename in lab_dir for reading: 0 is
+    the latest, 1 the one before, and so on."""
+    return open(blob_path(blobdir, versions(lab_dir, filename)[version][1]), 'rb')
@@ -60,12 +60,21 @@ if home == None:
 Homedir = os.path.join(home,Year)
 Maildir = os.path.join(Homedir,'mail')
 Submissiondir = os.path.join(Homedir,'submissions')
+# Content-addressed store of all submitted file versions. Keep it on
+# the same filesystem as Submissiondir so that the latest versions can
+# be hardlinked into the students' lab directories.
+Blobdir = os.path.join(Submissiondir,'_blobs')
 Tempdir = os.path.join(Homedir,'tmp')
 Lockdir = os.path.join(Homedir,'locks')
 
 Studentlistdir = os.path.join(Homedir, 'studentlist')
 Studentlistcsvfile = os.path.join(Studentlistdir,
                                       'nameemail.csv.' + Modulecode.lower())
+# Real names of senders as seen in their emails, by login. Used for
+# senders that are not in the Studentlistcsvfile. It is seeded once
+# from the log files in Submissiondir (marked by realnames_file +
+# '.imported'; remove that file to import again).
+realnames_file = os.path.join(Studentlistdir, 'realnames.txt')
 
 # Logfile dealing with processing of incoming emails from students
 Logfile = os.path.join(Homedir,'log/main.log')
@@ -73,13 +82,87 @@ Logfile = os.path.join(Homedir,'log/main.log')
 # Can check this file periodically to check that services are running
 pulsefile = os.path.join(Homedir,'log','pulse-process-emails.dat')
 
+# Settings for running 'process_emails.py --daemon' (see
+# cron/process_emails_daemon.sh) instead of starting process_emails.py
+# from cron. The daemon notices new mail within daemon_max_poll seconds
+# (immediately if pyinotify is installed), and updates the pulsefile
+# every daemon_pulse_interval seconds.
+daemon_pidfile = os.path.join(Homedir,'log','process-emails.pid')
+daemon_max_poll = 1.0
+daemon_pulse_interval = 60
+
 # where do we store the inbox -- good to stick to Linux convention
 inbox = os.path.join('/var/mail',Modulecode.lower())
 
 
 
-# file for temporary mail processing (do we need it?) 
-tmpname = os.path.join(Homedir,'mail/_tmp')
+# Directory for batches of emails taken from the inbox. Each run moves
+# the inbox into a new batch file here (by renaming it if this
+# directory is on the same file system as the inbox, otherwise by
+# copying it), and records in 'batch-*.offset' how far it has got.
+# Batches left over from a crashed run are resumed by the next run.
+inbox_batchdir = os.path.join(Homedir,'mail','_batches')
+
+# Number of worker processes that process the emails of one batch
+# concurrently. Emails are assigned to workers by sender login, so the
+# emails of each student are still processed in order. 1 means that
+# all emails are processed sequentially in the main process.
+ingest_workers = 1
+
+# Read the inbox copy via mmap (faster on large spools). Either way,
+# only one email is held in memory at a time.
+inbox_use_mmap = False
+
+# An email that raises an exception while being processed is moved to
+# Quarantinedir (with the traceback), and the administrator is told at
+# the end of the run. If more than ingest_failure_budget emails fail in
+# one run, the run is stopped (and the lock left in place) as before.
+Quarantinedir = os.path.join(Maildir,'_quarantine')
+ingest_failure_budget = 10
+
+# Rate limit for tests per student and assignment: at most
+# submission_rate_capacity tests in a burst, then one more every
+# submission_rate_interval seconds. Further submissions are saved and
+# acknowledged, and the latest of them is tested when the limit
+# allows. None disables the limit.
+submission_rate_capacity = 5
+submission_rate_interval = 120
+submission_ratelimit_db = os.path.join(Homedir,'ratelimit.sqlite')
+
+# Ledger of processed emails (by Message-ID and content). Emails found
+# in it are skipped, so that a spool can be replayed after a crash
+# without duplicate submissions, tests or replies. Emails are recorded
+# once their mailbox copies are written (see mailbox_durability).
+# None disables it.
+ingest_ledger = os.path.join(Maildir,'_ledger.sqlite')
+
+# Copies of incoming and outgoing emails are appended to the mailboxes
+# in Maildir in batches. mailbox_durability is one of
+#  'message' -- write after every email
+#  'fsync'   -- write and fsync after every email
+#  'batch'   -- write when mailbox_flush_bytes are buffered and at the
+#               end of each batch (fewest system calls, but the batch
+#               checkpoint only advances with the writes: after a crash,
+#               all emails since the last write are processed again,
+#               and their replies and tests are sent again)
+mailbox_durability = 'message'
+mailbox_flush_bytes = 1048576
+
+# Instead of the mbox files in Maildir, store these emails in a
+# compressed archive with an index by login, assignment and Message-ID
+# (see mailarchive.py, which can also import the existing mbox files
+# and extract mail for a student). Segments are rotated by the
+# strftime format mail_archive_segment_format.
+mail_archive = False
+Mailarchivedir = os.path.join(Maildir,'_archive')
+mail_archive_segment_format = "%Y-%m"
+
+# Files retrieved by students ("retrieve <assignment>") are sent in
+# emails of at most retrieval_max_bytes (files larger than that are
+# sent on their own). The encoded attachments are cached in
+# retrieval_partcache, which may be emptied at any time.
+retrieval_max_bytes = 10*1048576
+retrieval_partcache = os.path.join(Tempdir,'mimeparts')
 
 # directory for html reports on submissions
 HTMLreportdir = os.path.join(Homedir,'htmlreport')
@@ -96,6 +179,8 @@ SysadminName = "TeTePy Admin"
 # (old system), or we provide an explicite list of students who are allowed
 # to submit (new system, and more secure.)
 Domain = "example.org"
+# Sending domains accepted if allow_only_emails_given_in_list is False
+known_domains = ["example.org","example.org.uk"]
 
 # address for email delivery. Easiest is localhost, i.e. 127.0.0.1
 smtp = '127.0.0.1'
@@ -175,15 +260,121 @@ include_pprinted_report = False
 subtest_base = os.path.join(Homedir,'testingcode')
 subtest_testcodedir = os.path.join(subtest_base,Modulecode.lower()) 
 subtest_queue = os.path.join(subtest_base,'queue')
+# jobs in the testing queue (jobs left as files in subtest_queue by
+# earlier versions are moved into it automatically)
+subtest_queue_db = os.path.join(subtest_queue,'queue.sqlite')
+# a job not finished after subtest_lease seconds is tested again (a
+# local worker renews it while testing, so this only happens if the
+# worker died; the result of whichever worker loses the claim is
+# not reported)
+subtest_lease = 3600
+# A job whose testing fails because py.test or the sandbox broke is
+# tested again up to subtest_retries times (so at most subtest_retries
+# + 1 times in all), after subtest_retry_backoff seconds (doubling with
+# each attempt). Jobs that still fail, or fail
+# for other reasons, are moved to subtest_manual (with the error in
+# <job>.error) and the administrator is emailed; other jobs are
+# tested meanwhile.
+subtest_retries = 3
+subtest_retry_backoff = 60
+# number of submissions tested at the same time (each in its own
+# sandboxes, see subtest_sandboxes and subtest_shards); jobs of
+# one student for the same assignment are never tested at the same
+# time
+subtest_workers = 1
+# The sandboxes: (run_constrained_pytest executable, group of the user
+# it runs as), one for each testing worker (and each further shard a
+# worker runs, see subtest_shards). Code tested at the same
+# time by two workers sharing a user could read and change the other
+# student's submission and results, or kill its processes. For more
+# than one worker, add a user run_stud<N> (with its own group, set up
+# with the module account as for run_stud) and a copy of
+# run_constrained_pytest owned by it (chown run_stud<N>:run_stud<N>,
+# chmod 6550) for each; run_stud's code/python-libs must be readable
+# by them.
+subtest_sandboxes = [(os.path.expanduser('~/code/c/run_constrained_pytest'), 'run_stud')]
+# order in which queued submissions are tested: 'fifo' (first come,
+# first served), 'fairshare' (round robin over students), 'sjf'
+# (assignments that test fastest first) or 'deadline' (earliest
+# deadline from deadline_groups first). "python jobqueue.py
+# <subtest_queue_db>" shows the turnaround of each policy used.
+subtest_schedule = 'fifo'
 subtest_manual = os.path.join(subtest_base,'manual')
 subtest_locks  = os.path.join(subtest_base,'locks')
 subtest_logfile = os.path.join(Homedir,'log','subtest.log')
 subtest_pulsefile =  os.path.join(Homedir,'log','pulse-process-subtest.dat')
+# Queue depth and histograms of queue wait, testing time and
+# turnaround per assignment, written with the pulse file in the
+# Prometheus text format (for the node exporter's textfile collector;
+# None to disable). Times of single jobs: see 'python jobqueue.py'.
+subtest_metricsfile = os.path.join(Homedir,'log','subtest-metrics.prom')
+# Settings for running 'process_subtests.py --daemon' (see
+# cron/process_subtests_daemon.sh) instead of starting it from cron.
+# The daemon is woken through subtest_wakeup_socket as soon as a job
+# is queued, and looks at the queue every subtest_daemon_poll seconds
+# in any case.
+subtest_wakeup_socket = os.path.join(subtest_base,'wakeup.sock')
+subtest_daemon_pidfile = os.path.join(Homedir,'log','process-subtests.pid')
+subtest_daemon_poll = 60
+# Testing on several hosts: 'process_subtests.py --coordinator' (on
+# this host, instead of process_subtests.py or its daemon) hands out
+# the queued jobs at subtest_coordinator, to 'process_subtests.py
+# --worker' on any host (each starting subtest_workers processes,
+# which need run_constrained_pytest and this configuration, but not
+# the test files). Requests must carry subtest_coordinator_token, a
+# secret shared by all hosts; the coordinator refuses to start
+# without it. Archives of files sent either way are limited to
+# subtest_max_archive bytes; a job whose archive is larger fails
+# (without retries).
+subtest_coordinator = ('localhost', 7315)
+subtest_coordinator_token = None
+subtest_worker_poll = 2
+subtest_max_archive = 64*1048576
 subtest_maxseconds = 60 # maximum time py.test run may take 
-
-# The files that contain the tests
+# Unix socket of the fork server (run_constrained_pytest --forkserver,
+# see subtest/forkserver.py), which imports py.test and the modules in
+# subtest_forkserver_preload once and forks a process from that for
+# each job, instead of starting py.test for each job (None: start
+# py.test each time). Sandbox N > 0 has its own fork server at
+# <socket>.N. The socket is created by this account and handed to the
+# fork server, so that the code tested cannot take its place: its
+# directory must belong to this account and be writable by no one
+# else (otherwise py.test is started each time). The fork server runs
+# with the python of run_constrained_pytest's py.test, is started when
+# needed and keeps running; it restarts by itself when one of the
+# preloaded modules changes.
+subtest_forkserver_socket = None
+subtest_forkserver_preload = ['tetepy', 'ctestlib']
+# Directory of precompiled environments, one per assignment and
+# version of its files (None: none). An environment holds the test
+# file (with the .pyc that py.test makes of it) and the modules and
+# packages in subtest_envcache_libs and subtest_envcache_modules[
+# assignment], compiled once by subtest_envcache_python (which must be
+# the python of subtest_envcache_pytest, the py.test the sandbox runs).
+# The sandbox finds them first on its PYTHONPATH. When one of these
+# files changes, a new environment is built. The directory must be
+# readable by run_stud.
+subtest_envcache = None
+subtest_envcache_python = '/usr/bin/python3'
+subtest_envcache_pytest = '/usr/local/bin/py.test'
+subtest_envcache_libs = [os.path.join('/home/run_stud/code/python-libs', lib) for lib in ('tetepy', 'ctestlib')]
+subtest_envcache_modules = {}
+
+# The files that contain the tests (one file, or a list of files, per
+# assignment)
 subtest_tests = {'demo': 'test_demo.py',
                  'demo2': 'test_demo2.py'}
+# Assignments whose tests are split into several shards, each run in a
+# sandbox of its own at the same time (and with the same time limit,
+# subtest_maxseconds), e.g. {'lab5': 4}. Each testing worker keeps as
+# many sandboxes as the largest number here (see subtest_sandboxes),
+# which may leave fewer workers than subtest_workers; with fewer
+# sandboxes than shards, there are as many shards as sandboxes. The test functions and Test
+# classes defined in the test files are dealt out to the shards in
+# turn; tests in a shard share its module-level setup, which is done
+# once per shard. The results are merged as if the tests had been
+# run in one go.
+subtest_shards = {}
 
 
 # We now define more detailed post-processing functions 
@@ -306,6 +497,13 @@ outgoingmail_locks = os.path.join(Homedir,'outgoingmail','locks')
 outgoingmail_logfile =  os.path.join(Homedir,'log','outgoingmail.log')
 outgoingmail_processed = os.path.join(outgoingmail_queue,'processed')
 outgoingmail_pulsefile = os.path.join(Homedir,'log','pulse-process-outgoingmail.dat')
+# Settings for running 'process_outgoing_mails.py --daemon' (see
+# cron/process_outgoing_mails_daemon.sh): woken through
+# outgoingmail_wakeup_socket when a mail is queued, and retrying mails
+# that could not be sent every outgoingmail_daemon_poll seconds.
+outgoingmail_wakeup_socket = os.path.join(Homedir,'outgoingmail','wakeup.sock')
+outgoingmail_daemon_pidfile = os.path.join(Homedir,'log','process-outgoingmail.pid')
+outgoingmail_daemon_poll = 60
 
 # If something is in the outgoing mail queue, which cannot be parsed
 # as a valid email message, it will end up in the following location.
@@ -329,7 +527,8 @@ allow_only_emails_given_in_list=True
 #if allow_only_emails_given_in_list =False, use domains and common
 #sense checks on emailaddresses that are acceptable.
 
-# time to sleep between subsequent runs (each parsing the inbox)
+# time to sleep between subsequent runs (each parsing the inbox); in
+# daemon mode, the shortest interval for polling the inbox
 sleeptime = 0.1
 
 sysadminmailfolder = 'sysadmin'
@@ -386,7 +585,7 @@ Please re-send your email with a proper subject line.
 """ + textwrap.fill("""
 If you think your subject line is well chosen, then please inform
 %s (%s).
-You may have found a bug.\n""" % (SysadminName, SysadminEmail)
+You may have found a bug.\n""" % (SysadminName, SysadminEmail))
 
 
 
@@ -29,7 +29,7 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 
-import csv
+import csv, fcntl
 import logging, mylogger, os
 
 try:
@@ -115,6 +115,119 @@ def readcsv_group(filename):
 
     return students
 
+class Roster(object):
+    """In-memory index of the student list file (as read by
+    readcsv_group), with O(1) lookups by email address, login and
+    group. Call refresh() (or use get_roster()) before lookups: it
+    re-reads the file only if its modification time has changed.
+
+    The roster also holds the map login -> real name of students as
+    seen in their emails (see record_realname()), which is persisted
+    in realnames_file, one 'login<TAB>real name' line per change.
+    """
+
+    def __init__(self, filename, realnames_file=None):
+        self.filename = filename
+        self.realnames_file = realnames_file
+        self.mtime = None
+        self.realnames_mtime = None
+        self.students = {}   # email -> (name, group)
+        self.logins = {}     # login -> email
+        self.groups = {}     # group -> list of emails
+        self.realnames = {}  # login -> real name
+        self.refresh()
+
+    def refresh(self):
+        mtime = os.stat(self.filename).st_mtime
+        if mtime != self.mtime:
+            log_global.debug("Reading student list {0} (mtime={1})".format(self.filename, mtime))
+            self.students = readcsv_group(self.filename)
+            self.logins = {}
+            self.groups = {}
+            for email in sorted(self.students.keys()):
+                login = email.rsplit('@',1)[0]
+                if login not in self.logins:
+                    self.logins[login] = email
+                self.groups.setdefault(self.students[email][1], []).append(email)
+            self.mtime = mtime
+
+        if self.realnames_file is not None:
+            try:
+                mtime = os.stat(self.realnames_file).st_mtime
+            except OSError:
+                mtime = None
+            if mtime != self.realnames_mtime:
+                self.realnames = {}
+                if mtime is not None:
+                    for line in open(self.realnames_file,'r'):
+                        login, realname = line.rstrip('\n').split('\t',1)
+                        self.realnames[login] = realname
+                self.realnames_mtime = mtime
+        return self
+
+    def is_allowed(self, email):
+        return email.lower() in self.students
+
+    def lookup_email(self, email):
+        """Returns ('real name','group') for email, or None."""
+        return self.students.get(email.lower())
+
+    def email_for_login(self, login):
+        """Returns the email address in the student list for login (the
+        part of the address before the '@'), or None."""
+        return self.logins.get(login.lower())
+
+    def emails_in_group(self, group):
+        return self.groups.get(group, [])
+
+    def students_with_groups(self):
+        """Returns a copy of the dictionary {'email':('real name','group'), ...}
+        as readcsv_group() would."""
+        return dict(self.students)
+
+    def realname(self, login):
+        """Returns the real name last recorded for login, or None."""
+        return self.realnames.get(login.lower())
+
+    def record_realname(self, login, realname):
+        """Persistently records realname as the real name of login (if
+        it is not known already)."""
+        login = login.lower()
+        if not realname or self.realnames.get(login) == realname or self.realnames_file is None:
+            return
+        line = "{0}\t{1}\n".format(login, realname.replace('\n',' ').replace('\t',' '))
+        f = open(self.realnames_file, 'a')
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        f.write(line)
+        f.flush()
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        f.close()
+        self.realnames[login] = realname
+
+
+_rosters = {}
+
+def get_roster(filename=None):
+    """Returns the (up to date) Roster for filename, by default
+    conf.Studentlistcsvfile, reading the file only when it has
+    changed since the last call. The first call seeds the real names
+    from the users' log files, if that has not been done before."""
+
+    if filename is None:
+        filename = conf.Studentlistcsvfile
+    if filename not in _rosters:
+        realnames_file = getattr(conf, 'realnames_file',
+                                 os.path.join(os.path.dirname(filename), 'realnames.txt'))
+        roster = Roster(filename, realnames_file)
+        if realnames_file is not None:
+            # lab_helpers imports this module
+            import lab_helpers
+            lab_helpers.import_realnames_from_logfiles(conf.Submissiondir, roster)
+        _rosters[filename] = roster
+        return roster
+    return _rosters[filename].refresh()
+
+
 if __name__ == "__main__":
     filename = 'nameemail.csv'
 
@@ -29,6 +29,7 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import email.Message, errno, fcntl, os, os.path
+import wakeup
 
 log_global = None
 conf = None
@@ -49,7 +50,7 @@ def send_text_message( mailto, mailfrom,  text, subject, html=False ):
     
     msg.set_payload(html_header+
                     text+"\n\n"+70*"-"+"\n\n"+conf.disclaimer+
-                    +html_footer)
+                    html_footer)
 
     return send_message(msg)
 
@@ -65,8 +66,23 @@ def send_message(msg, return_msg_as_string = 1):
     else:
         return None
 
+def wakeup_socket():
+    """Returns the socket on which process_outgoing_mails.py --daemon
+    listens for new mail (see wakeup.py)."""
+    return getattr(conf, 'outgoingmail_wakeup_socket',
+                   os.path.join(os.path.dirname(conf.outgoingmail_queue),'wakeup.sock'))
+
 def mailqueue_push(msg):
-    # All outgoing mail should be placed into the queue via this function.
+    # All outgoing mail should be placed into the queue via this function
+    # (or, for mail written piecewise, mailqueue_push_stream).
+
+    return mailqueue_push_stream(msg["To"], lambda f: f.write(msg.as_string()))
+
+def mailqueue_push_stream(mailto, write):
+    """Enqueues an outgoing mail to mailto that is written by calling
+    write(f) with a file object f. The mail is written under a
+    temporary name (not seen by process_outgoing_mails) and renamed
+    into the queue when complete. Returns the queue id."""
 
     counterfile = os.path.join(conf.outgoingmail_queue,'.maxid')
 
@@ -94,19 +110,28 @@ def mailqueue_push(msg):
         # Unlock
         fcntl.flock(f.fileno(), fcntl.LOCK_UN)
 
-    # Use some msg fields to determine filename for queued email.
-    if msg["To"].count(",") == 0:
+    # Use the recipient to determine filename for queued email.
+    if mailto.count(",") == 0:
         # single recipient
-        to = msg["To"]
+        to = mailto
     else:
-        to = msg["To"].split(",")[0]
+        to = mailto.split(",")[0]
     filename = "m%010d-%s" % (q_id,to)
     log_global.info("Enqueueing outgoing mail (id=%d) to queue entry '%s'" % (q_id,filename))
 
-    # Save the string representation of the message in the sending queue.
-    assert os.path.exists(os.path.join(conf.outgoingmail_queue,filename))==False, \
+    # Save the message in the sending queue.
+    path = os.path.join(conf.outgoingmail_queue,filename)
+    assert os.path.exists(path)==False, \
         "Internal error: will not overwrite outgoing email {0:s}".format(filename)
-    with open(os.path.join(conf.outgoingmail_queue,filename),'w') as f:
-        f.write(msg.as_string())
-
+    tmppath = os.path.join(conf.outgoingmail_queue,"."+filename+".tmp")
+    try:
+        with open(tmppath,'w') as f:
+            write(f)
+        os.rename(tmppath,path)
+    except:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
+
+    wakeup.notify(wakeup_socket())
     return q_id
@@ -0,0 +1,596 @@
+# This file is part of the TeTePy software
+# Copyright (c) 2017, 2018, University of Southampton
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+# The testing queue: jobs put in by process_emails (one per
+# submission to be tested) and taken out by process_subtests.
+#
+# Jobs are kept in an sqlite database (in WAL mode, so that reading
+# does not block the processes adding jobs). Each job has a state:
+#
+#   pending    -- waiting to be tested
+#   claimed    -- being tested; the claim holds a lease, and if the
+#                 lease expires (the tester died), the job can be
+#                 claimed again
+#   done       -- tested
+#   failed     -- testing failed for good, see the 'error' column
+#   superseded -- not tested, as the student submitted again for the
+#                 same assignment before testing started
+#
+# The order in which jobs are claimed is given by a scheduling policy
+# (see 'policies' below); the default is their id (FIFO). A job is
+# never handed out while another job of the same student for the same
+# assignment is being tested (several testers may claim jobs at the
+# same time, and they would work in the same directory). The metadata
+# of a job (a dictionary) is stored as JSON. All operations use
+# indices, so their cost does not grow with the number of (old) jobs.
+#
+# For each job we record when it was queued ('enqueued'), claimed for
+# testing ('claimed'), when testing ended ('tested') and when the
+# result was mailed ('mailed', i.e. put into the outgoing mail queue).
+# When a job is done, its queue wait, testing time and turnaround
+# (queued to mailed) are added to cumulative histograms per
+# assignment (see histograms()), so that exporting them does not
+# require reading all jobs.
+#
+# A job whose testing fails can be put back with retry(): it is
+# pending again, but not claimed before its 'not_before' time, and the
+# number of failed attempts is kept in 'attempts'. Once a job has
+# failed more often than it may be retried, it is failed.
+
+import ast, errno, json, math, os, re, sqlite3, sys, time
+
+PENDING, CLAIMED, DONE, FAILED, SUPERSEDED = "pending", "claimed", "done", "failed", "superseded"
+
+_schema = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    state TEXT NOT NULL,
+    assignment TEXT NOT NULL,
+    login TEXT NOT NULL,
+    metadata TEXT NOT NULL,
+    enqueued REAL NOT NULL,
+    claimed REAL,
+    lease_until REAL,
+    worker TEXT,
+    finished REAL,
+    error TEXT,
+    deadline REAL,
+    policy TEXT,
+    tested REAL,
+    mailed REAL,
+    attempts INTEGER,
+    not_before REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs(state, id);
+CREATE INDEX IF NOT EXISTS jobs_student ON jobs(login, assignment, state);
+CREATE INDEX IF NOT EXISTS jobs_enqueued ON jobs(enqueued);
+CREATE INDEX IF NOT EXISTS jobs_login ON jobs(login, state, id);
+CREATE INDEX IF NOT EXISTS jobs_assignment ON jobs(assignment, state, id);
+CREATE TABLE IF NOT EXISTS runtimes (
+    assignment TEXT PRIMARY KEY,
+    mean REAL NOT NULL,
+    n INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runtimes_mean ON runtimes(mean, assignment);
+CREATE TABLE IF NOT EXISTS students (
+    login TEXT PRIMARY KEY,
+    waiting INTEGER NOT NULL,
+    claimed INTEGER NOT NULL,
+    last_claimed REAL
+);
+CREATE INDEX IF NOT EXISTS students_turn ON students(waiting, claimed, last_claimed, login);
+CREATE TABLE IF NOT EXISTS histogram_buckets (
+    metric TEXT NOT NULL,
+    assignment TEXT NOT NULL,
+    le TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (metric, assignment, le)
+);
+CREATE TABLE IF NOT EXISTS histogram_sums (
+    metric TEXT NOT NULL,
+    assignment TEXT NOT NULL,
+    sum REAL NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (metric, assignment)
+);
+"""
+
+# columns added to the jobs table after it was first released
+_added_columns = [('deadline', 'REAL'), ('policy', 'TEXT'), ('tested', 'REAL'), ('mailed', 'REAL'),
+                  ('attempts', 'INTEGER'), ('not_before', 'REAL')]
+
+# the histograms kept of done jobs, and their bucket bounds in seconds
+# (cumulative, as in Prometheus: bucket le counts the jobs that took
+# at most le seconds)
+WAIT, RUN, TURNAROUND = "wait", "run", "turnaround"
+histogram_buckets = ['1', '2', '5', '10', '30', '60', '120', '300', '600',
+                     '1800', '3600', '7200', '+Inf']
+
+# The scheduling policies: (the ORDER BY clause by which the next job
+# j is chosen among the pending jobs, turns). turns is None, or a
+# query giving values of a column of j in turn, with that column: the
+# next job is then chosen among those with the first value that has
+# one. The keys of turns are kept up to date in tables of their own
+# (students, runtimes), so that a claim reads them by index.
+#
+#   fifo      -- oldest job first
+#   fairshare -- round robin over students: the student with the
+#                fewest jobs being tested, and then the one who was
+#                served longest ago (then by login), goes first
+#   sjf       -- shortest expected job first, by the mean testing time
+#                of earlier jobs for the same assignment (see
+#                complete()); assignments not tested yet go first, to
+#                learn their testing time
+#   deadline  -- the job with the earliest deadline (passed to
+#                enqueue()) first; jobs without deadline or submitted
+#                after it go last
+policies = {
+    'fifo': ("j.id", None),
+    'fairshare': ("j.id", ("SELECT login FROM students WHERE waiting=1 "
+                           "ORDER BY claimed, last_claimed, login", "j.login")),
+    'sjf': ("j.id", ("SELECT assignment FROM runtimes ORDER BY mean, assignment", "j.assignment")),
+    'deadline': ("(j.deadline IS NULL OR j.deadline < j.enqueued), j.deadline, j.id", None),
+}
+
+# the mean testing time of an assignment follows the last _runtime_window
+# jobs (exponentially weighted)
+_runtime_window = 20
+
+
+def encode_metadata(metadata):
+    """Returns metadata (a dictionary) as JSON. Byte strings (as we get
+    them from emails, in any encoding) are stored as latin-1, which
+    maps each byte to one character; decode_metadata reverses this."""
+    return json.dumps(metadata, encoding='latin-1', sort_keys=True)
+
+
+def _to_bytes(x):
+    if isinstance(x, unicode):
+        return x.encode('latin-1')
+    if isinstance(x, list):
+        return [_to_bytes(y) for y in x]
+    if isinstance(x, dict):
+        return dict((_to_bytes(k), _to_bytes(v)) for (k, v) in x.items())
+    return x
+
+
+def decode_metadata(text):
+    return _to_bytes(json.loads(text))
+
+
+class JobQueue(object):
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.pid = os.getpid()
+        # transactions are started explicitly (BEGIN IMMEDIATE), so
+        # that a claim is atomic
+        self.db = sqlite3.connect(filename, timeout=60, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        new_students = self.db.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='students'").fetchone() is None
+        self.db.executescript(_schema)
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(jobs)")]
+        for (column, sqltype) in _added_columns:
+            if column not in columns:
+                self.db.execute("ALTER TABLE jobs ADD COLUMN %s %s" % (column, sqltype))
+        if new_students:
+            # a queue made before the students table: fill it (and
+            # runtimes) from the jobs
+            self.db.execute("INSERT OR IGNORE INTO students (login, waiting, claimed, last_claimed) "
+                            "SELECT login, MAX(state=?), SUM(state=?), MAX(claimed) FROM jobs GROUP BY login",
+                            (PENDING, CLAIMED))
+            self.db.execute("INSERT OR IGNORE INTO runtimes (assignment, mean, n) "
+                            "SELECT DISTINCT assignment, 0, 0 FROM jobs WHERE state=?", (PENDING,))
+
+    def _transaction(self, function, *args):
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            result = function(*args)
+        except:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+        return result
+
+    def enqueue(self, metadata, supersede=True, deadline=None):
+        """Add a job with metadata (a dictionary with at least the keys
+        'assignment' and 'login'). Unless supersede is False, pending
+        jobs of the same login for the same assignment are superseded.
+        deadline (seconds since the epoch) is used by the 'deadline'
+        scheduling policy. Returns (id, [ids of superseded jobs]). The
+        id is also stored in the metadata as 'id'."""
+        return self._transaction(self._enqueue, metadata, supersede, None, deadline)
+
+    def _enqueue(self, metadata, supersede, q_id, deadline=None):
+        superseded = []
+        if supersede:
+            superseded = [row[0] for row in self.db.execute(
+                "SELECT id FROM jobs WHERE login=? AND assignment=? AND state=?",
+                (metadata['login'], metadata['assignment'], PENDING))]
+            self.db.execute("UPDATE jobs SET state=?, finished=? WHERE login=? AND assignment=? AND state=?",
+                            (SUPERSEDED, time.time(), metadata['login'], metadata['assignment'], PENDING))
+        cursor = self.db.execute(
+            "INSERT INTO jobs (id, state, assignment, login, metadata, enqueued, deadline) VALUES (?, ?, ?, ?, '', ?, ?)",
+            (q_id, PENDING, metadata['assignment'], metadata['login'], time.time(), deadline))
+        q_id = cursor.lastrowid
+        metadata['id'] = q_id
+        metadata['superseded'] = superseded
+        self.db.execute("UPDATE jobs SET metadata=? WHERE id=?", (encode_metadata(metadata), q_id))
+        # an assignment not tested yet goes first under 'sjf'
+        self.db.execute("INSERT OR IGNORE INTO runtimes (assignment, mean, n) VALUES (?, 0, 0)",
+                        (metadata['assignment'],))
+        self._update_student(metadata['login'])
+        return (q_id, superseded)
+
+    def _update_student(self, login, claimed=None):
+        """Count the pending and claimed jobs of login for the
+        'fairshare' policy, after they changed; claimed is the time a
+        job of login was claimed, if it was."""
+        waiting = self.db.execute("SELECT 1 FROM jobs WHERE login=? AND state=? LIMIT 1",
+                                  (login, PENDING)).fetchone() is not None
+        nclaimed = self.db.execute("SELECT COUNT(*) FROM jobs WHERE login=? AND state=?",
+                                   (login, CLAIMED)).fetchone()[0]
+        self.db.execute("INSERT OR IGNORE INTO students (login, waiting, claimed) VALUES (?, 0, 0)", (login,))
+        self.db.execute("UPDATE students SET waiting=?, claimed=?, last_claimed=COALESCE(?, last_claimed) WHERE login=?",
+                        (int(waiting), nclaimed, claimed, login))
+
+    def _update_student_of(self, q_id, claimed=None):
+        row = self.db.execute("SELECT login FROM jobs WHERE id=?", (q_id,)).fetchone()
+        if row is not None:
+            self._update_student(row[0], claimed)
+
+    def claim(self, worker, lease, policy='fifo'):
+        """Claim a claimed job whose lease has expired or else the next
+        pending job by the scheduling policy (a key of 'policies') for
+        worker (a string) for lease seconds, skipping jobs of students
+        who have a job of the same assignment claimed already and jobs
+        waiting to be retried (see retry()). Returns its metadata, or
+        None if there is no job."""
+        if policy not in policies:
+            raise ValueError("Unknown scheduling policy %s (known: %s)" % (repr(policy), sorted(policies.keys())))
+        return self._transaction(self._claim, worker, lease, policy)
+
+    def _claim(self, worker, lease, policy):
+        now = time.time()
+        row = self.db.execute("SELECT id, metadata FROM jobs WHERE state=? AND lease_until<? ORDER BY id LIMIT 1",
+                              (CLAIMED, now)).fetchone()
+        if row is None:
+            row = self._next_pending(policy, now)
+        if row is None:
+            return None
+        self.db.execute("UPDATE jobs SET state=?, claimed=?, lease_until=?, worker=?, policy=? WHERE id=?",
+                        (CLAIMED, now, now + lease, worker, policy, row[0]))
+        self._update_student_of(row[0], now)
+        return decode_metadata(row[1])
+
+    def _next_pending(self, policy, now):
+        (order, turns) = policies[policy]
+        query = ("SELECT id, metadata FROM jobs AS j WHERE state=? "
+                 "AND (not_before IS NULL OR not_before<=?) AND NOT EXISTS "
+                 "(SELECT 1 FROM jobs WHERE login=j.login AND assignment=j.assignment "
+                 "AND state=? AND lease_until>=?)")
+        args = (PENDING, now, CLAIMED, now)
+        if turns is None:
+            return self.db.execute(query + " ORDER BY %s LIMIT 1" % order, args).fetchone()
+        (candidates, column) = turns
+        for (value,) in self.db.execute(candidates):
+            row = self.db.execute(query + " AND %s=? ORDER BY %s LIMIT 1" % (column, order), args + (value,)).fetchone()
+            if row is not None:
+                return row
+        return None
+
+    def renew(self, q_id, lease, worker=None):
+        """Extend the lease on the claimed job q_id by lease seconds
+        (only if worker holds the claim, if worker is given). Returns
+        whether the lease was extended."""
+        if worker is None:
+            cursor = self.db.execute("UPDATE jobs SET lease_until=? WHERE id=? AND state=?",
+                                     (time.time() + lease, q_id, CLAIMED))
+        else:
+            cursor = self.db.execute("UPDATE jobs SET lease_until=? WHERE id=? AND state=? AND worker=?",
+                                     (time.time() + lease, q_id, CLAIMED, worker))
+        return cursor.rowcount > 0
+
+    def timestamp(self, q_id, event):
+        """Record the time of event ('tested' or 'mailed') for job q_id."""
+        if event not in ('tested', 'mailed'):
+            raise ValueError("Unknown job event %s" % repr(event))
+        self.db.execute("UPDATE jobs SET %s=? WHERE id=?" % event, (time.time(), q_id))
+
+    def complete(self, q_id, error=None, worker=None):
+        """Mark the job q_id as done, or as failed if error (a string)
+        is given. The testing time of done jobs is recorded for the
+        'sjf' policy, and their times are added to the histograms. If
+        worker is given and does not hold the claim on the job (see
+        claimant()), nothing is recorded. Returns whether the job was
+        marked."""
+        return self._transaction(self._complete, q_id, error, worker)
+
+    def _complete(self, q_id, error, worker=None):
+        if worker is not None and self.claimant(q_id) != worker:
+            return False
+        now = time.time()
+        if error is None:
+            state = DONE
+        else:
+            state = FAILED
+        self.db.execute("UPDATE jobs SET state=?, finished=?, error=? WHERE id=?", (state, now, error, q_id))
+        self._update_student_of(q_id)
+        row = self.db.execute("SELECT assignment, enqueued, claimed, tested, mailed FROM jobs WHERE id=?",
+                              (q_id,)).fetchone()
+        if state != DONE or row is None or row[2] is None:
+            return True
+        (assignment, enqueued, claimed, tested, mailed) = row
+        runtime = (tested or now) - claimed
+        self._observe(WAIT, assignment, claimed - enqueued)
+        self._observe(RUN, assignment, runtime)
+        self._observe(TURNAROUND, assignment, (mailed or now) - enqueued)
+
+        mean = self.db.execute("SELECT mean, n FROM runtimes WHERE assignment=?", (assignment,)).fetchone()
+        if mean is None:
+            self.db.execute("INSERT INTO runtimes (assignment, mean, n) VALUES (?, ?, 1)", (assignment, runtime))
+        else:
+            n = mean[1] + 1
+            self.db.execute("UPDATE runtimes SET mean=?, n=? WHERE assignment=?",
+                            (mean[0] + (runtime - mean[0]) / min(n, _runtime_window), n, assignment))
+        return True
+
+    def _observe(self, metric, assignment, value):
+        for le in histogram_buckets:
+            if le == '+Inf' or value <= float(le):
+                self.db.execute("INSERT OR IGNORE INTO histogram_buckets VALUES (?, ?, ?, 0)",
+                                (metric, assignment, le))
+                self.db.execute("UPDATE histogram_buckets SET count=count+1 WHERE metric=? AND assignment=? AND le=?",
+                                (metric, assignment, le))
+        self.db.execute("INSERT OR IGNORE INTO histogram_sums VALUES (?, ?, 0, 0)", (metric, assignment))
+        self.db.execute("UPDATE histogram_sums SET sum=sum+?, count=count+1 WHERE metric=? AND assignment=?",
+                        (value, metric, assignment))
+
+    def histograms(self):
+        """Return the histograms of done jobs as a dictionary
+        {(metric, assignment): ({le: count}, sum, count)}, where metric
+        is WAIT, RUN or TURNAROUND and le runs over histogram_buckets
+        (the counts are cumulative, and only ever grow)."""
+        result = {}
+        for (metric, assignment, total, count) in self.db.execute(
+                "SELECT metric, assignment, sum, count FROM histogram_sums"):
+            result[(metric, assignment)] = (dict((le, 0) for le in histogram_buckets), total, count)
+        for (metric, assignment, le, count) in self.db.execute(
+                "SELECT metric, assignment, le, count FROM histogram_buckets"):
+            if (metric, assignment) in result:
+                result[(metric, assignment)][0][le] = count
+        return result
+
+    def jobs_between(self, start, end):
+        """Return [(id, assignment, login, enqueued, claimed, tested,
+        mailed)] of the jobs queued from start to end (seconds since
+        the epoch), in order."""
+        return self.db.execute("SELECT id, assignment, login, enqueued, claimed, tested, mailed FROM jobs "
+                               "WHERE enqueued>=? AND enqueued<? ORDER BY id", (start, end)).fetchall()
+
+    def retry(self, q_id, error, retries, backoff, worker=None):
+        """Record that testing job q_id failed with error (a string).
+        If the job has been retried fewer than retries times, it is put
+        back into the queue, to be claimed again after backoff seconds,
+        doubling with each further failure; otherwise it is failed (so
+        a job is tested at most retries + 1 times). If worker is given
+        and does not hold the claim on the job (see claimant()),
+        nothing is recorded and None is returned. Otherwise returns
+        (number of failed attempts, seconds until the retry or None if
+        the job failed)."""
+        return self._transaction(self._retry, q_id, error, retries, backoff, worker)
+
+    def _retry(self, q_id, error, retries, backoff, worker):
+        if worker is not None and self.claimant(q_id) != worker:
+            return None
+        row = self.db.execute("SELECT attempts FROM jobs WHERE id=?", (q_id,)).fetchone()
+        attempts = ((row and row[0]) or 0) + 1
+        self.db.execute("UPDATE jobs SET attempts=? WHERE id=?", (attempts, q_id))
+        if attempts > retries:
+            self._complete(q_id, error)
+            return (attempts, None)
+        delay = backoff * 2 ** (attempts - 1)
+        self.db.execute("UPDATE jobs SET state=?, claimed=NULL, lease_until=NULL, worker=NULL, error=?, "
+                        "not_before=? WHERE id=?", (PENDING, error, time.time() + delay, q_id))
+        self._update_student_of(q_id)
+        return (attempts, delay)
+
+    def release(self, q_id):
+        """Put the claimed job q_id back into the queue."""
+        self._transaction(self._release, q_id)
+
+    def _release(self, q_id):
+        self.db.execute("UPDATE jobs SET state=?, claimed=NULL, lease_until=NULL, worker=NULL WHERE id=? AND state=?",
+                        (PENDING, q_id, CLAIMED))
+        self._update_student_of(q_id)
+
+    def count(self, state):
+        """Return the number of jobs in state."""
+        return self.db.execute("SELECT COUNT(*) FROM jobs WHERE state=?", (state,)).fetchone()[0]
+
+    def turnaround(self, policy=None, since=None):
+        """Return (number of jobs, mean, 95th percentile) of the
+        turnaround time in seconds (from enqueueing to completion) of
+        the done jobs claimed under policy (all if None) and finished
+        at or after since (seconds since the epoch; all if None), or
+        None if there are no such jobs."""
+        query = "SELECT finished - enqueued FROM jobs WHERE state=?"
+        args = [DONE]
+        if policy is not None:
+            query += " AND policy=?"
+            args.append(policy)
+        if since is not None:
+            query += " AND finished>=?"
+            args.append(since)
+        times = sorted(row[0] for row in self.db.execute(query, args))
+        if len(times) == 0:
+            return None
+        p95 = times[int(math.ceil(0.95 * len(times))) - 1]
+        return (len(times), sum(times) / len(times), p95)
+
+    def get(self, q_id):
+        """Return the metadata of job q_id (or None)."""
+        row = self.db.execute("SELECT metadata FROM jobs WHERE id=?", (q_id,)).fetchone()
+        if row is None:
+            return None
+        return decode_metadata(row[0])
+
+    def claimant(self, q_id):
+        """Return the worker that holds the claim on job q_id, or None
+        if the job is not claimed."""
+        row = self.db.execute("SELECT worker FROM jobs WHERE id=? AND state=?", (q_id, CLAIMED)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def migrate_directory(self, directory):
+        """Move the jobs from the queue directory used before (one file
+        per job, written with pprint, named s<id>-<assignment>-<login>)
+        into this queue, keeping their ids and order. Jobs in its
+        'running' subdirectory (claimed by a run that was interrupted)
+        are put back into the queue as well. Job ids continue after the
+        directory's .maxid counter.
+
+        Each job is enqueued under its old id before its file is moved
+        to the 'migrated' subdirectory, so that a job whose file was not
+        moved (after a crash) is not enqueued twice. Files in 'running'
+        of jobs that are in the queue already are this queue's own
+        records (see process_subtests.py) and are left alone, as are
+        files that cannot be read. Returns (number of jobs migrated,
+        [paths of the files that cannot be read])."""
+        if not os.path.isdir(directory):
+            return (0, [])
+
+        counterfile = os.path.join(directory, '.maxid')
+        if os.path.exists(counterfile):
+            maxid = int(open(counterfile).read() or 0)
+            self._transaction(self._reserve_ids, maxid)
+
+        migrated_dir = os.path.join(directory, 'migrated')
+        jobfiles = []
+        for subdir in ('', 'running'):
+            if os.path.isdir(os.path.join(directory, subdir)):
+                jobfiles.extend((int(re.match(r"s(\d+)-", x).group(1)), subdir, x)
+                                for x in os.listdir(os.path.join(directory, subdir))
+                                if re.match(r"s\d+-", x))
+        jobfiles.sort()
+        n = 0
+        unreadable = []
+        for (q_id, subdir, filename) in jobfiles:
+            path = os.path.join(directory, subdir, filename)
+            if self._has_job(q_id):
+                if subdir == 'running':
+                    continue
+            else:
+                try:
+                    metadata = ast.literal_eval(open(path).read())
+                except IOError, e:
+                    if e.errno == errno.ENOENT: # migrated by another process
+                        continue
+                    raise
+                except (SyntaxError, ValueError):
+                    unreadable.append(path)
+                    continue
+                if self._transaction(self._enqueue_migrated, metadata, q_id):
+                    n += 1
+            if not os.path.exists(migrated_dir):
+                try:
+                    os.mkdir(migrated_dir)
+                except OSError, e:
+                    if e.errno != errno.EEXIST:
+                        raise
+            try:
+                os.rename(path, os.path.join(migrated_dir, filename))
+            except OSError, e:
+                if e.errno != errno.ENOENT: # moved by another process
+                    raise
+        return (n, unreadable)
+
+    def _has_job(self, q_id):
+        return self.db.execute("SELECT 1 FROM jobs WHERE id=?", (q_id,)).fetchone() is not None
+
+    def _enqueue_migrated(self, metadata, q_id):
+        if self._has_job(q_id): # migrated by another process
+            return False
+        self._enqueue(metadata, False, q_id)
+        return True
+
+    def _reserve_ids(self, maxid):
+        # new ids are larger than any id in sqlite_sequence
+        row = self.db.execute("SELECT seq FROM sqlite_sequence WHERE name='jobs'").fetchone()
+        if row is None:
+            self.db.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('jobs', ?)", (maxid,))
+        elif row[0] < maxid:
+            self.db.execute("UPDATE sqlite_sequence SET seq=? WHERE name='jobs'", (maxid,))
+
+    def close(self):
+        self.db.close()
+
+
+def _seconds(t):
+    if t is None:
+        return "-"
+    return "%.1f" % t
+
+
+if __name__ == "__main__":
+    # Show the jobs per state and the turnaround of each scheduling
+    # policy, or the times of the jobs queued between two times, as in
+    #
+    #   python jobqueue.py ~/testingcode/queue/queue.sqlite
+    #   python jobqueue.py ~/testingcode/queue/queue.sqlite "2018-11-20 15:50" "2018-11-20 16:00"
+    if len(sys.argv) not in (2, 4):
+        print "usage: %s <queue database> [<from> <to>]" % sys.argv[0]
+        print "(times as YYYY-MM-DD HH:MM)"
+        sys.exit(1)
+
+    queue = JobQueue(sys.argv[1])
+
+    if len(sys.argv) == 4:
+        (start, end) = [time.mktime(time.strptime(t, "%Y-%m-%d %H:%M")) for t in sys.argv[2:]]
+        print "%6s %-12s %-12s %-8s %8s %8s %8s" % ('id', 'assignment', 'login', 'queued', 'wait/s', 'run/s', 'total/s')
+        for (q_id, assignment, login, enqueued, claimed, tested, mailed) in queue.jobs_between(start, end):
+            print "%6d %-12s %-12s %-8s %8s %8s %8s" % (
+                q_id, assignment, login, time.strftime("%H:%M:%S", time.localtime(enqueued)),
+                _seconds(claimed and claimed - enqueued),
+                _seconds(claimed and tested and tested - claimed),
+                _seconds(mailed and mailed - enqueued))
+        queue.close()
+        sys.exit(0)
+
+    for state in (PENDING, CLAIMED, DONE, FAILED, SUPERSEDED):
+        print "%-10s %6d" % (state, queue.count(state))
+    print
+    print "%-10s %6s %10s %10s" % ('policy', 'jobs', 'mean/s', 'p95/s')
+    for policy in sorted(policies.keys()):
+        stats = queue.turnaround(policy)
+        if stats is not None:
+            print "%-10s %6d %10.1f %10.1f" % ((policy,) + stats)
+    queue.close()
@@ -138,52 +138,79 @@ def submitted_files_report(lab_name, user_files_by_type, report_in_detail=["mand
 
 def allowed_email_addresses():
     """Returns list of email addresses that are acceptable as sending submissions."""
-    students = csvio.readcsv(conf.Studentlistcsvfile)
-    return students.keys()
+    return csvio.get_roster().students.keys()
+
+def realname_from_logfile( datadir, login ):
+    """Returns the real name recorded in the 'studentdata' line of the
+    log.txt file of login in datadir, or None."""
+    userdir = os.path.join(datadir, login)
+    try:
+        f = open( os.path.join(userdir,'log.txt') )
+    except IOError, mgs: # file does not exist
+        return None
+
+    realname = None
+
+    for line in f.readlines()[:-1]:
+        bits = line.split(20*"-"+"studentdata:")
+        if len(bits)==2:
+            data = bits[1]
+            login2, realname = data[:-1].split(":",1)
+            login2 = login2.lower().strip("'\"") # process_emails logs repr(login)
+            if not login2 == login:
+                print "line =",line
+                print "login=",login
+                print "login2=",login2
+                print "realame=",realname
+                print "directory name ",userdir
+                raise StandardError, "login does not match login2 from User's log.txt "
+            break
+
+    f.close()
+    return realname
+
+def import_realnames_from_logfiles( datadir, roster ):
+    """Records the real names found in the log.txt files of all users in
+    datadir in the roster, unless this has been done before. This is
+    only needed once, to fill the map of real names when upgrading from
+    versions that looked names up in the log files; csvio.get_roster()
+    calls it before the roster is first used. Done once is marked by
+    the file roster.realnames_file + '.imported' (the realnames file
+    itself is created by the first record_realname())."""
+    marker = roster.realnames_file + '.imported'
+    if os.path.exists(marker):
+        return
+    if os.path.isdir(datadir):
+        for login in find_users(datadir):
+            try:
+                realname = realname_from_logfile(datadir, login.lower())
+            except (StandardError, ValueError), msg:
+                print "Skipping log file of %s: %s" % (repr(login), msg)
+                continue
+            if realname is not None and roster.realname(login) is None:
+                if realname[:1] in "'\"" and realname[-1:] == realname[:1]:
+                    realname = realname[1:-1] # log file has repr(realname)
+                roster.record_realname(login, realname)
+    open(marker, 'a').close()
 
 def database_name_for_user( datadir, login, studentlist = None ):
     #first try to find the name in the list
-    if studentlist == None:
-        students = csvio.readcsv(conf.Studentlistcsvfile)
-        #this returns email address in lowercase
+    roster = csvio.get_roster()
 
     login = login.lower()
 
-    if login in students.keys():
-        return students[login]
-    elif login + conf.Domain in students.keys():
-        return students[login + conf.Domain]
+    if roster.lookup_email(login) is not None:
+        (name, group) = roster.lookup_email(login)
+        return name + ' ' + group
+    elif roster.email_for_login(login) is not None:
+        (name, group) = roster.lookup_email(roster.email_for_login(login))
+        return name + ' ' + group
     else:
-        print "Could not find login %s, searching in log files" % repr(login)
-        #try to get data from logfiles
-        userdir = os.path.join(datadir, login)
-        try:
-            f = open( os.path.join(userdir,'log.txt') )
-        except IOError, mgs: # file does not exist
-            realname = "_ (not in list, unknown)"
-            return realname
-
-        realname = "_ (not in list, unknown)"
-    
-        for line in f.readlines()[:-1]:
-            bits = line.split(20*"-"+"studentdata:")
-            if len(bits)==2:
-                data = bits[1]
-                login2, realname = data[:-1].split(":")
-                realname = "_"+realname+" (not in list)"
-                login2 = login2.lower()
-                if not login2 == login:
-                    print "line =",line
-                    print "login=",login
-                    print "login2=",login2
-                    print "realame=",realname
-                    print "directory name ",userdir
-                    raise StandardError, "login does not match login2 from User's log.txt "
-                break
-
-        f.close()
-
-    return realname
+        print "Could not find login %s, looking up recorded real names" % repr(login)
+        realname = roster.realname(login)
+        if realname is None:
+            return "_ (not in list, unknown)"
+        return "_"+realname+" (not in list)"
 
 def user_realname( login ):
     db_name = database_name_for_user(conf.Submissiondir,login)
@@ -196,6 +223,8 @@ def user_realname( login ):
 def find_users( directory ):
     usernames = []
     for dir in os.listdir(directory):
+        if dir[0:1] == "_": # e.g. the blob store, conf.Blobdir
+            continue
         if os.path.isdir(os.path.join(directory,dir)):
             usernames.append( dir )
     usernames.sort()
@@ -240,21 +269,17 @@ def analyze_filenames(file_map, filenames, logger,ignored_files=["log.txt"]):
             logger.debug("Skipping %s (pytest testing)" % repr(filename))
             continue
 
-        #if file is of type ex1.py.1, ex1.py.2, etc
-        if re.search(r"\.[0-9]+$",filename):
-            logger.debug( "Skipping %s (only backup)" % repr(filename))
-            continue
-        else:
-            logger.debug( "File %s seems not to be of .1 type" % repr(filename))
+        # older versions are not in the list: filenames come from
+        # blobstore.latest_files(), which reads the manifest
 
-            our_filename=[n for (rx,n) in filter(lambda x:re.match(x[0],filename),match_rx)]
-            
-            if len(our_filename)>0:
-                ftype=addfile(our_filename[0])
-                logger.debug("  file %s type %s" % (repr(filename),repr(ftype)))
-            else: # do not try to canonicalize UNKNOWN file
-                ftype=addfile(filename)
-                logger.debug("  file %s type %s" % (repr(filename),repr(ftype)))
+        our_filename=[n for (rx,n) in filter(lambda x:re.match(x[0],filename),match_rx)]
+
+        if len(our_filename)>0:
+            ftype=addfile(our_filename[0])
+            logger.debug("  file %s type %s" % (repr(filename),repr(ftype)))
+        else: # do not try to canonicalize UNKNOWN file
+            ftype=addfile(filename)
+            logger.debug("  file %s type %s" % (repr(filename),repr(ftype)))
                 
     ret={}
     for key in files_by_type.keys():
@@ -0,0 +1,83 @@
+# This file is part of the TeTePy software
+# Copyright (c) 2017, 2018, University of Southampton
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+# Persistent record of the emails that have been processed.
+#
+# Every incoming email is identified by its Message-ID together with
+# the sha1 of its complete text (so that a different email reusing a
+# Message-ID is not mistaken for a duplicate). Once an email has been
+# processed, this is committed to an sqlite database in a transaction
+# of its own. Emails found in the ledger are skipped, so that a spool
+# can be processed again after a crash (or fed into the inbox again
+# by an operator) without saving attachments, queueing tests or
+# sending replies twice.
+
+import hashlib, os, sqlite3, time
+
+_schema = """
+CREATE TABLE IF NOT EXISTS processed (
+    message_id TEXT NOT NULL,
+    sha1 TEXT NOT NULL,
+    time REAL NOT NULL,
+    PRIMARY KEY (message_id, sha1)
+);
+"""
+
+
+def mail_key(mail, message_id):
+    """Return the ledger key (message_id, sha1) of mail (a string)
+    whose Message-ID header is message_id (or None)."""
+    return (message_id or '', hashlib.sha1(mail).hexdigest())
+
+
+class Ledger(object):
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.pid = os.getpid()
+        self.db = sqlite3.connect(filename, timeout=60)
+        self.db.executescript(_schema)
+
+    def seen(self, key):
+        """Return the time at which the email with key was processed,
+        or None if it has not been."""
+        row = self.db.execute("SELECT time FROM processed WHERE message_id=? AND sha1=?", key).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def record(self, key):
+        """Commit that the email with key has been processed."""
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO processed (message_id, sha1, time) VALUES (?, ?, ?)",
+                            key + (time.time(),))
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,269 @@
+# This file is part of the TeTePy software
+# Copyright (c) 2017, 2018, University of Southampton
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+# Compressed, indexed archive of all mail that is otherwise appended to
+# the mbox files in conf.Maildir (see conf.mail_archive).
+#
+# Every mail is stored once, compressed on its own, in a segment file
+# named after the month in which it was archived (so old segments are
+# never written to again and can be moved elsewhere). A record in a
+# segment is a line "<length> <sha1>\n" followed by <length> bytes of
+# zlib-compressed mail.
+#
+# An sqlite index next to the segments maps each mail (by sha1 of its
+# content) to its segment and offset, together with its Message-ID,
+# and records which folders (the former mbox names: '_allincomingemail',
+# '_errors', or the login of a student) refer to it, for which
+# assignment and when. An incoming email that used to be written to
+# both _allincomingemail and the student's mbox is therefore stored
+# once and referenced twice, and a lookup by login, assignment or
+# Message-ID reads the index and seeks straight to the records.
+#
+# MailArchive has the same interface as mailboxwriter.MailboxWriter,
+# so that it can buffer appends and honour the same durability levels.
+
+import email.parser, errno, fcntl, hashlib, os, sqlite3, time, zlib
+
+import mailboxwriter
+
+INDEX = "index.sqlite"
+
+_schema = """
+CREATE TABLE IF NOT EXISTS mails (
+    id INTEGER PRIMARY KEY,
+    sha1 TEXT UNIQUE NOT NULL,
+    message_id TEXT,
+    time REAL NOT NULL,
+    segment TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS entries (
+    mail_id INTEGER NOT NULL REFERENCES mails(id),
+    folder TEXT NOT NULL,
+    assignment TEXT,
+    time REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS mails_message_id ON mails(message_id);
+CREATE INDEX IF NOT EXISTS entries_folder ON entries(folder, time);
+CREATE INDEX IF NOT EXISTS entries_assignment ON entries(assignment, time);
+"""
+
+
+def message_id(mail):
+    """Return the Message-ID header of mail (a string), or None."""
+    end = mail.find('\n\n')
+    if end < 0:
+        end = len(mail)
+    headers = email.parser.HeaderParser().parsestr(mail[:end+1])
+    return headers["Message-ID"]
+
+
+class MailArchive(object):
+
+    def __init__(self, directory, durability='message', flush_bytes=1048576,
+                 segment_format="%Y-%m", compresslevel=6):
+        if durability not in mailboxwriter.DURABILITY_LEVELS:
+            raise ValueError, "durability must be one of %s, not %s" % (mailboxwriter.DURABILITY_LEVELS, repr(durability))
+        self.directory = directory
+        self.durability = durability
+        self.flush_bytes = flush_bytes
+        self.segment_format = segment_format
+        self.compresslevel = compresslevel
+        self.pending = []   # (folder, assignment, time, sha1, mail)
+        self.buffered = 0
+        self.current = 0    # index in pending of the current email's first mail
+        self.pid = os.getpid()
+        self._db = None
+
+    def db(self):
+        if self._db is None:
+            if not os.path.exists(self.directory):
+                try:
+                    os.makedirs(self.directory)
+                except OSError, e:
+                    if e.errno != errno.EEXIST:
+                        raise
+            self._db = sqlite3.connect(os.path.join(self.directory, INDEX), timeout=60)
+            self._db.executescript(_schema)
+            if self.durability != 'fsync':
+                self._db.execute("PRAGMA synchronous=NORMAL")
+        return self._db
+
+    # -- writing (same interface as mailboxwriter.MailboxWriter)
+
+    def append(self, folder, mail, assignment=None):
+        """Queue mail (a string) for archiving in folder."""
+        self.pending.append((folder, assignment, time.time(), hashlib.sha1(mail).hexdigest(), mail))
+        self.buffered += len(mail)
+
+    def end_of_message(self):
+        """See mailboxwriter.MailboxWriter.end_of_message()."""
+        self.current = len(self.pending)
+        if self.durability != 'batch' or self.buffered >= self.flush_bytes:
+            self.flush()
+        return self.buffered == 0
+
+    def flush(self):
+        """Write the queued mails that are not in the archive yet to the
+        current segment, and record all of them in the index."""
+        if len(self.pending) == 0:
+            return
+        db = self.db()
+
+        known = set()
+        records = []
+        for (folder, assignment, t, sha1, mail) in self.pending:
+            if sha1 in known:
+                continue
+            known.add(sha1)
+            if db.execute("SELECT 1 FROM mails WHERE sha1=?", (sha1,)).fetchone():
+                continue
+            records.append((sha1, t, mail))
+
+        if records:
+            segment = "mail-%s.z" % time.strftime(self.segment_format, time.localtime(records[0][1]))
+            fd = os.open(os.path.join(self.directory, segment), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                offset = os.lseek(fd, 0, os.SEEK_END)
+                data = []
+                rows = []
+                for (sha1, t, mail) in records:
+                    compressed = zlib.compress(mail, self.compresslevel)
+                    head = "%d %s\n" % (len(compressed), sha1)
+                    offset += len(head)
+                    rows.append((sha1, message_id(mail), t, segment, offset, len(compressed)))
+                    offset += len(compressed)
+                    data.append(head)
+                    data.append(compressed)
+                data = "".join(data)
+                while data:
+                    data = data[os.write(fd, data):]
+                if self.durability == 'fsync':
+                    os.fsync(fd)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+        else:
+            rows = []
+
+        with db:
+            db.executemany("INSERT OR IGNORE INTO mails (sha1, message_id, time, segment, offset, length)"
+                           " VALUES (?, ?, ?, ?, ?, ?)", rows)
+            db.executemany("INSERT INTO entries (mail_id, folder, assignment, time)"
+                           " SELECT id, ?, ?, ? FROM mails WHERE sha1=?",
+                           [(folder, assignment, t, sha1) for (folder, assignment, t, sha1, mail) in self.pending])
+        self.pending = []
+        self.buffered = 0
+        self.current = 0
+
+    def discard(self):
+        """Drop all queued mail."""
+        self.pending = []
+        self.buffered = 0
+        self.current = 0
+
+    def discard_message(self):
+        """Drop the mail queued since the last end_of_message()."""
+        for entry in self.pending[self.current:]:
+            self.buffered -= len(entry[4])
+        del self.pending[self.current:]
+
+    def close(self):
+        """Flush, and close the index."""
+        self.flush()
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    # -- reading
+
+    def lookup(self, folder=None, assignment=None, message_id=None, since=None, until=None):
+        """Return (time, folder, assignment, mail_id) for the archived
+        mails matching all the given criteria, oldest first."""
+        conditions = []
+        args = []
+        for (column, value) in (("entries.folder=?", folder), ("entries.assignment=?", assignment),
+                                ("mails.message_id=?", message_id),
+                                ("entries.time>=?", since), ("entries.time<?", until)):
+            if value is not None:
+                conditions.append(column)
+                args.append(value)
+        query = "SELECT entries.time, entries.folder, entries.assignment, mails.id" \
+                " FROM entries JOIN mails ON entries.mail_id=mails.id"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        return self.db().execute(query + " ORDER BY entries.time, entries.rowid", args).fetchall()
+
+    def read(self, mail_id):
+        """Return the mail with the given id (from lookup())."""
+        (segment, offset, length) = self.db().execute(
+            "SELECT segment, offset, length FROM mails WHERE id=?", (mail_id,)).fetchone()
+        f = open(os.path.join(self.directory, segment), 'rb')
+        f.seek(offset)
+        data = f.read(length)
+        f.close()
+        return zlib.decompress(data)
+
+    def import_mbox(self, folder, filename):
+        """Archive all mails in the mbox file filename in folder (to
+        migrate the existing mbox files). Returns the number of mails."""
+        import mboxio
+        n = 0
+        for (start, end, mail) in mboxio.iter_mbox(filename):
+            self.append(folder, mail)
+            self.end_of_message()
+            n += 1
+        self.flush()
+        return n
+
+
+if __name__ == "__main__":
+    # python mailarchive.py DIRECTORY show [folder=LOGIN] [assignment=LAB] [message_id=ID]
+    #    writes the matching mails as mbox to stdout
+    # python mailarchive.py DIRECTORY import FOLDER MBOXFILE
+    #    archives an existing mbox file as folder FOLDER
+
+    import sys
+
+    if len(sys.argv) < 3 or sys.argv[2] not in ("show", "import"):
+        print >>sys.stderr, "usage: %s DIRECTORY show [folder=LOGIN] [assignment=LAB] [message_id=ID]" % sys.argv[0]
+        print >>sys.stderr, "       %s DIRECTORY import FOLDER MBOXFILE" % sys.argv[0]
+        sys.exit(2)
+
+    archive = MailArchive(sys.argv[1])
+    if sys.argv[2] == "import":
+        print "Archived %d mails" % archive.import_mbox(sys.argv[3], sys.argv[4])
+    else:
+        criteria = dict(arg.split("=", 1) for arg in sys.argv[3:])
+        for (t, folder, assignment, mail_id) in archive.lookup(**criteria):
+            sys.stdout.write(archive.read(mail_id))
+    archive.close()
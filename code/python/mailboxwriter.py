@@ -0,0 +1,210 @@
+# This file is part of the TeTePy software
+# Copyright (c) 2017, 2018, University of Southampton
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+# Buffered appending to the mbox files in conf.Maildir.
+#
+# Every incoming email is appended to _allincomingemail and to the
+# student's mailbox, and every reply to the student's mailbox again.
+# Opening, locking and closing the mailbox for each of these costs
+# several system calls per append. A MailboxWriter keeps the appends
+# for each mailbox in memory and writes them with one write() per
+# mailbox when it is flushed, keeping one open file descriptor per
+# mailbox.
+#
+# How much may be lost in a crash is chosen with 'durability':
+#
+#   'batch'   -- flush when more than flush_bytes are buffered (checked
+#                at the end of an email) and at the end of the batch
+#   'message' -- flush at the end of every email (the default)
+#   'fsync'   -- as 'message', and fsync() every mailbox written to
+
+import collections, errno, fcntl, os
+
+DURABILITY_LEVELS = ('batch', 'message', 'fsync')
+
+
+class MailboxWriter(object):
+
+    def __init__(self, directory, durability='message', flush_bytes=1048576, max_open=512):
+        if durability not in DURABILITY_LEVELS:
+            raise ValueError, "durability must be one of %s, not %s" % (DURABILITY_LEVELS, repr(durability))
+        self.directory = directory
+        self.durability = durability
+        self.flush_bytes = flush_bytes
+        self.max_open = max_open
+        self.buffers = collections.OrderedDict() # mailbox -> list of strings
+        self.buffered = 0                        # bytes in self.buffers
+        self.fds = collections.OrderedDict()     # mailbox -> fd, least recently used first
+        self.pid = os.getpid()
+        self.current = []                        # mailboxes appended to for the current email
+
+    def append(self, mailbox, mail, assignment=None):
+        """Queue mail (a string) for appending to mailbox (a name in
+        self.directory). The assignment is only recorded by
+        mailarchive.MailArchive."""
+        self.buffers.setdefault(mailbox, []).append(mail)
+        self.buffered += len(mail)
+        self.current.append(mailbox)
+
+    def end_of_message(self):
+        """Called after each email has been processed completely.
+        Flushes if the durability level asks for it, and returns True
+        if nothing is left in the buffers afterwards (i.e. it is safe
+        to record that this email has been processed)."""
+        self.current = []
+        if self.durability != 'batch' or self.buffered >= self.flush_bytes:
+            self.flush()
+        return self.buffered == 0
+
+    def _fd(self, mailbox):
+        fd = self.fds.pop(mailbox, None)
+        if fd is None:
+            if len(self.fds) >= self.max_open:
+                os.close(self.fds.popitem(last=False)[1])
+            fd = os.open(os.path.join(self.directory, mailbox),
+                         os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+        self.fds[mailbox] = fd
+        return fd
+
+    def flush(self):
+        """Write all buffered mail to the mailboxes."""
+        for (mailbox, mails) in self.buffers.items():
+            data = "".join(mails)
+            fd = self._fd(mailbox)
+            # other processes (e.g. parallel ingestion workers) may
+            # append to the same mailbox
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                while data:
+                    data = data[os.write(fd, data):]
+                if self.durability == 'fsync':
+                    os.fsync(fd)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            del self.buffers[mailbox]
+            self.buffered -= sum(len(x) for x in mails)
+
+    def discard(self):
+        """Drop all buffered mail (e.g. when the emails it belongs to
+        will be processed again)."""
+        self.buffers.clear()
+        self.buffered = 0
+        self.current = []
+
+    def discard_message(self):
+        """Drop the mail buffered since the last end_of_message() (i.e.
+        for an email that could not be processed)."""
+        for mailbox in reversed(self.current):
+            mails = self.buffers.get(mailbox)
+            if not mails: # flushed already
+                continue
+            self.buffered -= len(mails.pop())
+            if len(mails) == 0:
+                del self.buffers[mailbox]
+        self.current = []
+
+    def close(self):
+        """Flush and close all mailboxes."""
+        self.flush()
+        while len(self.fds) > 0:
+            os.close(self.fds.popitem()[1])
+
+
+if __name__ == "__main__":
+    # Benchmark: python mailboxwriter.py [emails [students]]
+    #
+    # Appends the mailbox writes of a batch of emails (a copy to
+    # _allincomingemail, to the student's mailbox, and a reply) the
+    # way append_mail_to_mailbox() used to, and with a MailboxWriter
+    # at each durability level, and counts the system calls involved
+    # (every open is matched by a close).
+
+    import __builtin__, random, shutil, sys, tempfile, time
+
+    nmails = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    nstudents = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    counts = collections.defaultdict(int)
+
+    def counting(name, function):
+        def wrapper(*args, **kwargs):
+            counts[name] += 1
+            return function(*args, **kwargs)
+        return wrapper
+
+    def syscw():
+        for line in open('/proc/self/io'):
+            if line.startswith('syscw:'):
+                return int(line.split()[1])
+
+    def legacy_append(directory, mailbox, mail):
+        f_out = open(os.path.join(directory, mailbox), 'a')
+        fcntl.flock(f_out.fileno(), fcntl.LOCK_EX)
+        f_out.write(mail)
+        f_out.flush()
+        fcntl.flock(f_out.fileno(), fcntl.LOCK_UN)
+        f_out.close()
+
+    random.seed(0)
+    mail = "From stud@example.org Mon Oct 23 15:59:00 2017\nSubject: lab1\n\n" + "x" * 4000 + "\n\n"
+    reply = "From admin@example.org Mon Oct 23 15:59:00 2017\nSubject: Re: lab1\n\n" + "y" * 1500 + "\n\n"
+    logins = ["stud%d" % random.randrange(nstudents) for i in range(nmails)]
+
+    open_ = __builtin__.open
+    os_open, os_fsync, flock = os.open, os.fsync, fcntl.flock
+    __builtin__.open = counting('open', open_)
+    os.open = counting('open', os_open)
+    os.fsync = counting('fsync', os_fsync)
+    fcntl.flock = counting('flock', flock)
+
+    print "%d emails from %d students, 3 appends per email" % (nmails, nstudents)
+    print "%-10s %9s %9s %9s %9s %9s" % ("method", "open", "flock", "write", "fsync", "s")
+    for method in ('legacy',) + DURABILITY_LEVELS:
+        directory = tempfile.mkdtemp()
+        counts.clear()
+        w0 = syscw()
+        t0 = time.time()
+        if method == 'legacy':
+            for login in logins:
+                legacy_append(directory, '_allincomingemail', mail)
+                legacy_append(directory, login, mail)
+                legacy_append(directory, login, reply)
+        else:
+            writer = MailboxWriter(directory, durability=method)
+            for login in logins:
+                writer.append('_allincomingemail', mail)
+                writer.append(login, mail)
+                writer.append(login, reply)
+                writer.end_of_message()
+            writer.close()
+        t = time.time() - t0
+        # don't count the reads of /proc/self/io by open()
+        print "%-10s %9d %9d %9d %9d %9.2f" % (method, counts['open'] - 1, counts['flock'], syscw() - w0, counts['fsync'], t)
+        shutil.rmtree(directory)
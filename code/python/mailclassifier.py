@@ -0,0 +1,242 @@
+# This file is part of the TeTePy software
+# Copyright (c) 2017, 2018, University of Southampton
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+# Classification of incoming emails: decides in one pass over the
+# headers of an email what process_emails should do with it. All
+# regular expressions are compiled once, when the classifier is made.
+
+import re
+
+# Regex for mail daemon
+_rx_email_daemon=r"daemon|deamon|fetchmail-daemon|FETCHMAIL-DAEMON|cron|root|postmaster"
+
+_forward_reply_keywords = ['Fwd:', 'Forward:', 'Re:', 'Reply:']
+
+default_known_domains = ["example.org","example.org.uk"]
+
+# Routing decisions
+DAEMON = 'daemon'                 # from a mailing daemon, forward to admin
+MYSELF = 'myself'                 # from this system (danger of loop)
+TWITTER = 'twitter'               # from twitter, forward to admin
+UNKNOWN_SENDER = 'unknown-sender' # address not in student list
+WRONG_DOMAIN = 'wrong-domain'     # sending domain not accepted
+BAD_SUBJECT = 'bad-subject'       # cannot identify assignment
+RETRIEVAL = 'retrieval'           # 'retrieve <assignment>'
+SUBMISSION = 'submission'         # submission for an assignment
+
+
+def domain_pattern(known_domains):
+    # This turns known_domains into word-boundary-delimited matches, i.e.
+    # soton.ac.uk -> \bsoton\.ac\.uk, then builds a terminal-or-pattern from that.
+    return re.compile("(%s)$" % "|".join(["\\b"+re.escape(d) for d in known_domains]),
+                      re.IGNORECASE)
+
+
+class MailClassifier(object):
+    """Routing rules for incoming email, compiled once.
+
+    assignments: the assignment names (conf.assignments.keys())
+    modulecode: emails from addresses containing this are from ourselves
+    is_allowed: function mapping an email address to True if that
+      address may submit, or None to accept by sending domain instead
+    known_domains: domains accepted if is_allowed is None
+    """
+
+    def __init__(self, assignments, modulecode, is_allowed=None,
+                 known_domains=default_known_domains):
+        assert len(assignments) > 0, "Internal error"
+        self.assignments = frozenset([x.lower() for x in assignments])
+        self.modulecode = modulecode.lower()
+        self.is_allowed = is_allowed
+        self.rx_daemon = re.compile(_rx_email_daemon, re.IGNORECASE)
+        self.rx_domain = domain_pattern(known_domains)
+        self.rx_retrieve = re.compile(r"\s*retrieve\s+(.*)", re.IGNORECASE)
+        self.rx_spam = re.compile(r"\{Spam?\}(.*)")
+        self.rx_forward_reply = re.compile("|".join(
+            [re.escape(kwd) for kwd in _forward_reply_keywords]))
+
+    def sender_kind(self, from_addr, domain):
+        """Returns DAEMON, MYSELF or TWITTER for senders whose emails must
+        not be answered, None otherwise."""
+        if self.rx_daemon.search(from_addr):
+            return DAEMON
+        if self.modulecode in from_addr.lower():
+            return MYSELF
+        if "twitter" in domain.lower():
+            return TWITTER
+        return None
+
+    def sending_domain_okay(self, domain):
+        return self.rx_domain.search(domain) is not None
+
+    def retrieval_subject(self, subject):
+        """Returns the rest of the subject if it starts with 'retrieve',
+        and None otherwise."""
+        if subject is None:
+            return None
+        m = self.rx_retrieve.match(subject)
+        if m:
+            return m.group(1)
+        return None
+
+    def identify_assignment(self, submission, log):
+        """Returns the (lower case) assignment named in the subject line
+        submission, or None if we cannot identify it."""
+
+        if submission == None:
+            log.warn("unparseable subject: '%s' " % submission)
+            return None
+
+        if submission == '':
+            log.warn("unparseable empty string in subject: '%s' " % submission)
+            return None
+
+        #check whether subject line is preceeded by "{Spam?} ". If so,
+        #then the mailing system thinks it is spam. This could be wrong, however.
+        #we therefore get rid of this, and log it.
+        match_spam = self.rx_spam.match(submission)
+        if match_spam:
+            submission = match_spam.group(1)
+            log.warn("stripping off '{Spam?}' from subject line: %s " % repr(submission))
+
+        if self.rx_forward_reply.search(submission):
+            log.warn("stripping off forward/reply keywords from subject line: {} ".format(submission))
+            submission = self.rx_forward_reply.sub('', submission)
+
+        canonicalized_submission = submission.replace(' ','').lower()
+
+        #do trivial test (i.e. input is 'lab1' or 'cw')
+        if canonicalized_submission in self.assignments:
+            return canonicalized_submission
+
+        log.warn("unparseable string: %s / %s" % (submission, canonicalized_submission))
+        return None
+
+    def classify(self, email_login, email_addr, domain, subject, log):
+        """Returns the routing decision for an email as a tuple
+        (decision, assignment), where assignment is None unless
+        decision is RETRIEVAL or SUBMISSION.
+
+        email_login and domain are the parts of the sender's address
+        email_addr, subject is the subject line."""
+
+        kind = self.sender_kind(email_login, domain)
+        if kind is not None:
+            return (kind, None)
+
+        if self.is_allowed is not None:
+            if not self.is_allowed(email_addr):
+                return (UNKNOWN_SENDER, None)
+        elif not self.sending_domain_okay(domain):
+            return (WRONG_DOMAIN, None)
+
+        remaining_subject = self.retrieval_subject(subject)
+        if remaining_subject is not None:
+            assignment = self.identify_assignment(remaining_subject, log)
+            decision = RETRIEVAL
+        else:
+            assignment = self.identify_assignment(subject, log)
+            decision = SUBMISSION
+
+        if assignment is None:
+            return (BAD_SUBJECT, None)
+        return (decision, assignment)
+
+
+def _legacy_classify(assignments, modulecode, allowed, email_login, email_addr, domain, subject):
+    """What process_emails did per email before MailClassifier (for
+    the benchmark below)."""
+
+    if re.search(_rx_email_daemon,email_login,re.IGNORECASE):
+        return (DAEMON, None)
+    if email_login.lower().count(modulecode.lower()):
+        return (MYSELF, None)
+    if domain.lower().count("twitter"):
+        return (TWITTER, None)
+    if email_addr.lower() not in map(str.lower, allowed):
+        return (UNKNOWN_SENDER, None)
+    pattern = "(%s)$" % reduce(lambda x,y:(x+"|"+y),["\\b"+re.escape(d) for d in default_known_domains])
+    re.search(pattern,domain,re.IGNORECASE)
+    decision = SUBMISSION
+    if re.match(r"\s*retrieve\s+",subject,re.IGNORECASE):
+        subject = re.match(r"\s*retrieve\s+(.*)",subject,re.IGNORECASE).group(1)
+        decision = RETRIEVAL
+    m = re.match(r"\{Spam?\}(.*)",subject)
+    if m:
+        subject = m.group(1)
+    for kwd in _forward_reply_keywords:
+        if kwd in subject:
+            subject = subject.replace(kwd, '')
+    keys = [x.lower() for x in assignments]
+    canonical = subject.replace(' ','').lower()
+    if canonical in keys:
+        return (decision, canonical)
+    return (BAD_SUBJECT, None)
+
+
+if __name__ == "__main__":
+    # Microbenchmark: python mailclassifier.py [emails [students]]
+    import sys, time, random, logging
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    nstudents = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+
+    log = logging.getLogger('mailclassifier-benchmark')
+    log.addHandler(logging.NullHandler())
+    log.propagate = False
+
+    assignments = ['lab%d' % i for i in range(1, 11)] + ['cw', 'training1', 'training2']
+    students = ['student%d@example.org' % i for i in range(nstudents)]
+    subjects = ['lab3', 'Re: lab 4', 'retrieve training1', '{Spam?} cw', 'hello', 'Fwd: lab10']
+    headers = []
+    for i in range(n):
+        if i % 50 == 0:
+            login, domain = 'MAILER-DAEMON', 'example.org'
+        elif i % 20 == 0:
+            login, domain = 'stranger%d' % i, 'elsewhere.org'
+        else:
+            login, domain = 'student%d' % random.randrange(nstudents), 'example.org'
+        headers.append((login, login + '@' + domain, domain, random.choice(subjects)))
+
+    allowed = set([s.lower() for s in students])
+    classifier = MailClassifier(assignments, 'TETEPY', allowed.__contains__)
+
+    t0 = time.time()
+    new = [classifier.classify(l, a, d, s, log) for (l, a, d, s) in headers]
+    dt_new = time.time() - t0
+
+    t0 = time.time()
+    old = [_legacy_classify(assignments, 'TETEPY', students, l, a, d, s) for (l, a, d, s) in headers]
+    dt_old = time.time() - t0
+
+    assert new == old, "classifier disagrees with legacy rules"
+    print("{} emails, {} students in list".format(n, nstudents))
+    print("  legacy rules: {:8.2f} us/email".format(dt_old / n * 1e6))
+    print("  classifier:   {:8.2f} us/email".format(dt_new / n * 1e6))
@@ -0,0 +1,231 @@
+# This file is part of the TeTePy software
+# Copyright (c) 2017, 2018, University of Southampton
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+# Reading of mbox spool files, one message at a time.
+#
+# The inbox may hold tens of thousands of emails (after an SMTP
+# outage, or on a deadline evening). We therefore never keep more than
+# one message in memory: iter_mbox() is a generator that yields each
+# email together with its byte offsets in the file, so that the caller
+# can record how far it got.
+
+import mmap, os, re
+
+# Lines starting with "From " in the body of an email are escaped as
+# ">From ", and ">From " is escaped as ">>From " etc. We undo one level
+# of escaping when reading.
+_rx_from_escape = re.compile(r"^>(>*From )", re.MULTILINE)
+
+
+def _unescape(text):
+    if ">From " in text:
+        return _rx_from_escape.sub(r"\1", text)
+    return text
+
+
+def _iter_mbox_readline(fin, start):
+    fin.seek(start)
+    offset = start
+    msg_start = None
+    mailtext = []
+
+    for line in iter(fin.readline, ''):
+        if line[0:5] == "From ":
+            if msg_start is not None:
+                yield (msg_start, offset, _unescape(''.join(mailtext)))
+            msg_start = offset
+            mailtext = []
+        if msg_start is not None:
+            # anything before the first 'From ' line is not an email
+            mailtext.append(line)
+        offset += len(line)
+
+    if msg_start is not None:
+        yield (msg_start, offset, _unescape(''.join(mailtext)))
+
+
+def _iter_mbox_mmap(fin, start):
+    size = os.fstat(fin.fileno()).st_size
+    if size <= start:
+        return                  # mmap refuses to map empty files
+
+    mm = mmap.mmap(fin.fileno(), size, access=mmap.ACCESS_READ)
+    try:
+        if mm[start:start+5] == "From ":
+            msg_start = start
+        else:
+            msg_start = mm.find("\nFrom ", start)
+            if msg_start == -1:
+                return
+            msg_start += 1
+
+        while msg_start < size:
+            msg_end = mm.find("\nFrom ", msg_start)
+            if msg_end == -1:
+                msg_end = size
+            else:
+                msg_end += 1
+            yield (msg_start, msg_end, _unescape(mm[msg_start:msg_end]))
+            msg_start = msg_end
+    finally:
+        mm.close()
+
+
+def iter_mbox(filename, start=0, use_mmap=False):
+    """Generator over the emails in the mbox file 'filename'.
+
+    Yields tuples (start, end, text) where text is the email as a
+    string (including its 'From ' line, and with '>From ' escaping
+    undone), and start and end are the byte offsets of that email in
+    the file. Reading begins at byte offset 'start', which must be 0
+    or the end offset of a previously yielded email.
+
+    With use_mmap=True the file is mapped into memory and searched for
+    message boundaries, rather than read line by line. Both variants
+    hold only the current email in (private) memory.
+    """
+
+    fin = open(filename, 'rb')
+    try:
+        if use_mmap:
+            reader = _iter_mbox_mmap(fin, start)
+        else:
+            reader = _iter_mbox_readline(fin, start)
+        for item in reader:
+            yield item
+    finally:
+        fin.close()
+
+
+def read_mail(fin, start, end):
+    """Returns the email stored between byte offsets start and end (as
+    yielded by iter_mbox) of the open mbox file fin."""
+
+    fin.seek(start)
+    return _unescape(fin.read(end - start))
+
+
+def _write_synthetic_mbox(filename, megabytes, attachment_kb=48):
+    """Writes an mbox of roughly 'megabytes' MB to filename, made of
+    submissions with one base64 encoded attachment each. Returns the
+    number of emails written."""
+
+    import base64
+    body = base64.encodestring(os.urandom(attachment_kb*1024*3/4))
+    template = ("From student%(n)d@example.org Mon Oct 23 15:59:%(s)02d 2017\n"
+                "From: Student %(n)d <student%(n)d@example.org>\n"
+                "To: tetepysubmission@example.org\n"
+                "Subject: demo\n"
+                "Message-ID: <%(n)d@example.org>\n"
+                "MIME-Version: 1.0\n"
+                "Content-Type: multipart/mixed; boundary=\"XXXX\"\n\n"
+                "--XXXX\nContent-Type: text/plain\n\n"
+                "Please find attached my submission.\n"
+                ">From the lab sheet I understood ...\n\n"
+                "--XXXX\nContent-Type: application/octet-stream; name=\"demo.py\"\n"
+                "Content-Transfer-Encoding: base64\n\n%(body)s\n"
+                "--XXXX--\n\n")
+    target = megabytes * 1024 * 1024
+    written = 0
+    n = 0
+    f = open(filename, 'wb')
+    while written < target:
+        text = template % {'n': n, 's': n % 60, 'body': body}
+        f.write(text)
+        written += len(text)
+        n += 1
+    f.close()
+    return n
+
+
+def _benchmark_one(filename, method):
+    """Runs one reader in a forked child so that ru_maxrss is not
+    polluted by the other methods. Returns (count, bytes, seconds, maxrss_kb)."""
+
+    import resource, time
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        t0 = time.time()
+        count = nbytes = 0
+        if method == 'list':
+            # what split_mailbox_into_strings used to do
+            mails = [text for (s, e, text) in iter_mbox(filename)]
+            count, nbytes = len(mails), sum(map(len, mails))
+        else:
+            for (s, e, text) in iter_mbox(filename, use_mmap=(method == 'mmap')):
+                count += 1
+                nbytes += len(text)
+        dt = time.time() - t0
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(wfd, repr((count, nbytes, dt, maxrss)))
+        os._exit(0)
+    os.close(wfd)
+    data = ''
+    while True:
+        chunk = os.read(rfd, 4096)
+        if not chunk:
+            break
+        data += chunk
+    os.close(rfd)
+    os.waitpid(pid, 0)
+    return eval(data)
+
+
+if __name__ == "__main__":
+    # Benchmark: python mboxio.py [megabytes [filename [methods]]]
+    #
+    # e.g. python mboxio.py 2048 /var/tmp/bench.mbox readline,mmap
+    #
+    # The 'list' method keeps all emails in memory like the old
+    # split_mailbox_into_strings() did, and needs at least as much RAM
+    # as the mbox is large. For 'mmap', maxrss includes the clean,
+    # file-backed pages of the mapping, which the kernel can drop at
+    # any time; private memory stays at the size of one email.
+    import sys
+
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 2048
+    filename = sys.argv[2] if len(sys.argv) > 2 else '/var/tmp/mboxio-bench.mbox'
+    methods = sys.argv[3].split(',') if len(sys.argv) > 3 else ['readline', 'mmap']
+
+    if not os.path.exists(filename) or \
+       os.path.getsize(filename) < megabytes * 1024 * 1024:
+        print("Writing synthetic mbox of {} MB to {}".format(megabytes, filename))
+        n = _write_synthetic_mbox(filename, megabytes)
+        print("  wrote {} emails".format(n))
+
+    size_mb = os.path.getsize(filename) / 1024. / 1024.
+    print("{:>10s} {:>10s} {:>10s} {:>10s} {:>12s}".format(
+        "method", "emails", "MB", "MB/s", "maxrss (MB)"))
+    for method in methods:
+        count, nbytes, dt, maxrss = _benchmark_one(filename, method)
+        print("{:>10s} {:10d} {:10.1f} {:10.1f} {:12.1f}".format(
+            method, count, size_mb, size_mb / dt, maxrss / 1024.))
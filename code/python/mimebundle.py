@@ -0,0 +1,182 @@
+# This file is part of the TeTePy software
+# Copyright (c) 2017, 2018, University of Southampton
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+# MIME bundles of submitted files (for "retrieve <assignment>" requests),
+# written straight into the outgoing mail queue.
+#
+# The encoded (base64 or quoted-printable) form of each file is cached
+# under the SHA-1 of the file content, so every version of a file is
+# encoded only once, however often it is retrieved. A bundle is then
+# assembled by copying the cached parts into the queue file piece by
+# piece, without holding files or the message in memory. Bundles
+# larger than a size limit are split over several emails.
+
+import base64, email.Message, errno, hashlib, mimetypes, os, quopri, random, shutil, sys, tempfile
+
+import blobstore
+import enqueue_outgoing_mails
+
+# overhead of boundary and part headers, for size estimates
+_part_overhead = 256
+
+
+def content_type(filename):
+    """Return (content type, transfer encoding) for filename."""
+    contentType,ignored=mimetypes.guess_type(filename)
+    if contentType==None: # If no guess, use generic opaque type
+        contentType="application/octet-stream"
+    if contentType.startswith("text/"):
+        return (contentType, "quoted-printable")
+    return (contentType, "base64")
+
+
+def file_sha1(path):
+    """Return the sha1 hex digest of the content of path."""
+    h = hashlib.sha1()
+    f = open(path, 'rb')
+    for block in iter(lambda: f.read(65536), ""):
+        h.update(block)
+    f.close()
+    return h.hexdigest()
+
+
+def encoded_part(cachedir, path, cte, digest=None):
+    """Return the path to the cached encoding (cte) of the file path,
+    encoding it first if it is not in the cache. digest is the sha1 of
+    the file content, if known."""
+    if digest is None:
+        digest = file_sha1(path)
+    suffix = {"base64": ".b64", "quoted-printable": ".qp"}[cte]
+    cachepath = os.path.join(cachedir, digest[:2], digest + suffix)
+    if os.path.exists(cachepath):
+        return cachepath
+
+    subdir = os.path.dirname(cachepath)
+    try:
+        os.makedirs(subdir)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+    (fd, tmpname) = tempfile.mkstemp(dir=subdir, prefix=".tmp-")
+    try:
+        fout = os.fdopen(fd, 'wb')
+        fin = open(path, 'rb')
+        if cte == "quoted-printable":
+            quopri.encode(fin, fout, 1) # 1 for encode tabs
+        else:
+            base64.encode(fin, fout)
+        fin.close()
+        fout.close()
+        os.rename(tmpname, cachepath)
+    except:
+        os.unlink(tmpname)
+        raise
+    return cachepath
+
+
+def split_parts(parts, max_bytes):
+    """Split the list of parts (filename, content type, cte, cached
+    path, size) into lists whose total size stays below max_bytes
+    (except for single parts that are larger than that)."""
+    messages = []
+    current = []
+    total = 0
+    for part in parts:
+        size = part[4] + _part_overhead
+        if current and total + size > max_bytes:
+            messages.append(current)
+            current = []
+            total = 0
+        current.append(part)
+        total += size
+    if current:
+        messages.append(current)
+    return messages
+
+
+def write_bundle(f, to, mailfrom, subject, parts):
+    """Write a multipart/mixed email with the given parts (see
+    split_parts) to the file object f."""
+    # '=' is always encoded in quoted-printable, and appears at most
+    # twice (at the end) in base64, so this cannot occur in a part
+    boundary = "===============%d==" % random.randrange(sys.maxint)
+
+    mainMsg=email.Message.Message()
+    mainMsg["To"]=to
+    mainMsg["From"]=mailfrom
+    mainMsg["Subject"]=subject
+    mainMsg["Mime-version"]="1.0"
+    # as_string() would write an (empty) multipart body if we set the
+    # content type, so we add that header ourselves
+    f.write(mainMsg.as_string()[:-1])
+    f.write('Content-type: multipart/mixed; boundary="%s"\n\n' % boundary)
+    f.write("Mime message\n")
+
+    for (filename, contentType, cte, cachepath, size) in parts:
+        subMsg=email.Message.Message()
+        subMsg.add_header("Content-type",contentType,name=filename)
+        subMsg.add_header("Content-transfer-encoding",cte)
+        f.write("\n--%s\n" % boundary)
+        f.write(subMsg.as_string())
+        fin = open(cachepath, 'rb')
+        shutil.copyfileobj(fin, f)
+        fin.close()
+
+    f.write("\n--%s--\n" % boundary)
+
+
+def enqueue_bundle(directory, filenames, to, mailfrom, subject, cachedir, max_bytes):
+    """Enqueue emails to 'to' with the files filenames in directory
+    attached, each email at most max_bytes long (roughly). Returns a
+    list of (queue id, [filenames]) for the emails sent."""
+
+    latest = blobstore.latest_versions(directory) or {}
+
+    parts = []
+    for filename in filenames:
+        path = os.path.join(directory, filename)
+        (contentType, cte) = content_type(filename)
+        digest = None
+        if filename in latest:
+            digest = latest[filename][1]
+        cachepath = encoded_part(cachedir, path, cte, digest)
+        parts.append((filename, contentType, cte, cachepath, os.path.getsize(cachepath)))
+
+    messages = split_parts(parts, max_bytes)
+    sent = []
+    for (i, message) in enumerate(messages):
+        if len(messages) > 1:
+            message_subject = "%s (part %d of %d)" % (subject, i+1, len(messages))
+        else:
+            message_subject = subject
+        q_id = enqueue_outgoing_mails.mailqueue_push_stream(to,
+            lambda f: write_bundle(f, to, mailfrom, message_subject, message))
+        sent.append((q_id, [part[0] for part in message]))
+    return sent
@@ -30,11 +30,23 @@
 
 import email, email.Utils, types, os, os.path, mimetypes, string, time, smtplib
 import logging, exceptions, fcntl, sys, shutil, email.MIMEBase, email.MIMEText
-import re, random, pprint, shelve, errno, textwrap
+import re, random, pprint, shelve, errno, textwrap, zlib, traceback
+import collections, multiprocessing, Queue, email.parser, atexit
 
 import mylogger
+import csvio
+import blobstore
+import jobqueue
+import ledger
+import ratelimit
+import wakeup
 
 import enqueue_outgoing_mails
+import mailarchive
+import mailboxwriter
+import mailclassifier
+import mboxio
+import mimebundle
 
 
 try:
@@ -65,14 +77,30 @@ else:
 class myException(exceptions.Exception):
     pass
 
-# Regex for mail daemon
-_rx_email_daemon=r"daemon|deamon|fetchmail-daemon|FETCHMAIL-DAEMON|cron|root|postmaster"
+# Routing rules for incoming email, see get_classifier()
+_classifier = None
 
-# Regex for From-escaping in emails
-_rx_from_escape=">(>*From (.|\n)*)"
+# Buffered appends to the mailboxes in conf.Maildir, see get_mailbox_writer()
+_mailbox_writer = None
+
+# Emails processed so far, see get_ledger()
+_ledger = None
+
+# Ledger keys of emails processed whose mailbox copies may still be
+# buffered, see record_processed()
+_unrecorded = []
+
+# Number of emails quarantined in this run, see quarantine_mail()
+_quarantined = 0
+
+# Admission control for the testing queue, see get_rate_limiter()
+_rate_limiter = None
+
+# The testing queue, see get_job_queue()
+_job_queue = None
 
 # User cannot upload files with such names:
-blacklisted_filenames=["log.txt","s.py"]
+blacklisted_filenames=["log.txt","s.py",blobstore.MANIFEST]
 
 
 def is_true(x):
@@ -81,57 +109,6 @@ def is_true(x):
     else:
         return False
 
-def bundle_files_in_directory_in_email( directory,to,From,Subject ):
-    """bundle all files in directory and return as email object
-
-    This is taken from Matthew Cowles
-    http://aspn.activestate.com/ASPN/Cookbook/Python/Recipe/86674  """
-
-    import cStringIO
-    import base64
-    import email.Generator
-    import email.Message
-    import os
-    import quopri
-
-    mainMsg=email.Message.Message()
-    mainMsg["To"]=to
-    mainMsg["From"]=From
-    mainMsg["Subject"]=Subject
-    mainMsg["Mime-version"]="1.0"
-    mainMsg["Content-type"]="Multipart/mixed"
-    mainMsg.preamble="Mime message\n"
-    mainMsg.epilogue="" # To ensure that message ends with newline
-    # Get names of plain files
-    filenames = []
-    for f in os.listdir(directory):
-        if os.path.isfile(os.path.join(directory,f)):
-            filenames.append(f)
-
-    for fileName in filenames:
-        # print "working on",fileName
-        contentType,ignored=mimetypes.guess_type(fileName)
-        if contentType==None: # If no guess, use generic opaque type
-            contentType="application/octet-stream"
-        contentsEncoded=cStringIO.StringIO()
-        f=open(os.path.join(directory,fileName),"rb")
-        mainType=contentType[:contentType.find("/")]
-        if mainType=="text":
-            cte="quoted-printable"
-            quopri.encode(f,contentsEncoded,1) # 1 for encode tabs
-        else:
-            cte="base64"
-            base64.encode(f,contentsEncoded)
-        f.close()
-        subMsg=email.Message.Message()
-        subMsg.add_header("Content-type",contentType,name=fileName)
-        subMsg.add_header("Content-transfer-encoding",cte)
-        subMsg.set_payload(contentsEncoded.getvalue())
-        contentsEncoded.close()
-        mainMsg.attach(subMsg)
-
-    return mainMsg
-
 def retrieve_assignment(assignment,message,student_dir,real_name,email_addr,logger):
 
     logger.info("Retrieving files for %s" % repr(assignment))
@@ -142,10 +119,10 @@ def retrieve_assignment(assignment,message,student_dir,real_name,email_addr,logg
     submission_dir = os.path.join(student_dir,assignment)
 
     if os.path.exists ( submission_dir ):
-        submitted_files = os.listdir( submission_dir  )
+        submitted_files = blobstore.latest_files( submission_dir )
     else:
         errormail = replymail_error( message, "It seems that you have not yet submitted any files." )
-        append_mail_to_mailbox( errormail, username, logger, "(outgoing error mail: no files submitted->retrieval is impossible)" )
+        append_mail_to_mailbox( errormail, username, logger, "(outgoing error mail: no files submitted->retrieval is impossible)", assignment )
         return None
 
     files_by_type = analyze_filenames(assignment_file_map(assignment), submitted_files, logger)
@@ -157,7 +134,7 @@ def retrieve_assignment(assignment,message,student_dir,real_name,email_addr,logg
     body.append("Here is a list of your files found on the server for assignment '%s':\n\n" % assignment)
     body.append(report)
 
-    body.append("\n\nPlease find attached to the _next_ email these files\n")
+    body.append("\n\nPlease find attached to the _next_ email(s) these files\n")
     body.append("that you submitted for '%s'.\n\n" %assignment)
     body.append("(In addition, there may be one (or more) files named\n")
     body.append("'part00?.bin' which contain the body of your email and can \n")
@@ -167,7 +144,7 @@ def retrieve_assignment(assignment,message,student_dir,real_name,email_addr,logg
 
 
     mail = enqueue_outgoing_mails.send_text_message( email_addr, conf.ModuleEmailAddress, string.join(body,""), subject)
-    append_mail_to_mailbox( mail, username, logger, "(outgoing retrieval report mail)" )
+    append_mail_to_mailbox( mail, username, logger, "(outgoing retrieval report mail)", assignment )
 
     #now do retrieve the files and mail those
 
@@ -175,20 +152,27 @@ def retrieve_assignment(assignment,message,student_dir,real_name,email_addr,logg
     From = conf.ModuleEmailAddress
     to = email_addr
 
-    retrieval_return_mail = bundle_files_in_directory_in_email( submission_dir,to,From,subject)
-    text =  enqueue_outgoing_mails.send_message(retrieval_return_mail)
-    append_mail_to_mailbox( text, 'test', logger, "(outgoing retrieval mail)" )
+    # written straight into the outgoing queue, split into several
+    # emails if necessary
+    sent = mimebundle.enqueue_bundle( submission_dir, submitted_files, to, From, subject,
+        getattr(conf, 'retrieval_partcache', os.path.join(conf.Tempdir,'mimeparts')),
+        getattr(conf, 'retrieval_max_bytes', 10*1048576))
 
-    logger.info("Sent retrieval mail for %s" % repr(assignment))
+    # the bundles may be large, keep only a note of them in the mailbox
+    for (q_id, filenames) in sent:
+        note=email.Message.Message()
+        note["To"]=to
+        note["From"]=From
+        note["Subject"]=subject
+        note.set_payload("Retrieval mail (queue id %d) with attachments:\n   %s\n" % (q_id,string.join(filenames,"\n   ")))
+        append_mail_to_mailbox( note.as_string(unixfrom=1), 'test', logger, "(outgoing retrieval mail)", assignment )
+
+    logger.info("Sent %d retrieval mail(s) for %s" % (len(sent),repr(assignment)))
 
 
 def is_retrieval (subject):
     """check whether the first part of the subject is 'retrieve'"""
-    #catch empty subject
-    if subject == None:
-        return False
-
-    return is_true(re.match(r"\s*retrieve\s+",subject,re.IGNORECASE))
+    return get_classifier().retrieval_subject(subject) is not None
 
 def extract_attachments(msg):
     """Extracts attachments from msg (which is a Message Object from
@@ -207,7 +191,8 @@ def extract_attachments(msg):
         if part.get_content_type() == 'multipart':
             continue
         filename = part.get_filename()
-        if not(filename) or (listindex(blacklisted_filenames,filename)):
+        if not(filename) or filename in blacklisted_filenames \
+                or not blobstore.is_storable_filename(filename):
             counter += 1
             log_local += "Could not get file_name of attachment. "
             filename = 'part-%03d%s' % (counter, ".bin")
@@ -225,42 +210,13 @@ def save_attachments( msg, dir ):
     #connect to log file for user
     logger = mylogger.attach_to_logfile( os.path.join(dir,'log.txt' ), level = log_level )
 
-    def keep_older_versions_of_this_file( filename ):
-
-        def change_name_version(newfilename,filename,changes=0):
-            #use just the filename (without path) for logging:
-            log_nfn = os.path.split(newfilename)[1]
-            log_fn = os.path.split(filename)[1]
-
-            logger.debug("Entering change_name_version %s <- %s " % (repr(log_nfn),repr(log_fn)))
-            try:
-                version = int(newfilename.split('.')[-1])
-                root = ".".join(newfilename.split('.')[0:-1])
-            except ValueError,msg:
-                logger.error( "problem with filename %s in increase_counter" % repr(filename))
-                raise ValueError,msg
-
-            if os.path.exists(newfilename):
-                logger.debug("file: %s exists -- recursive retry!" % repr(log_nfn))
-                changes = change_name_version(root+'.'+str(version+1),root+'.'+str(version),changes)
-            else:
-                logger.debug("Found last file: %s" % repr(log_nfn))
-
-            logger.debug( "About to rename %s to %s" % (repr(log_fn),repr(log_nfn)))
-            os.rename(filename,newfilename)
-            return changes+1
-
-        changes = None
-        if os.path.exists(filename):
-            changes = change_name_version(filename+'.1',filename)
-            return changes
-
     #save_attachements starts here
     (att, logstr) = extract_attachments( msg )
 
     logger.info("============ save_attachments =======(%s)" % repr(dir))
     logger.debug( logstr )
 
+    files = {}
     counter = 0
     for filename in att.keys():
         counter += 1
@@ -268,30 +224,53 @@ def save_attachments( msg, dir ):
         if att[filename] == None:
             logger.warn("Found empty attachement %i (att[%s]==None), Skipping" % (counter,repr(filename)))
             continue
+        files[filename] = att[filename]
 
-        changes = keep_older_versions_of_this_file(os.path.join(dir, filename))
+    # older versions are kept in the blob store, see blobstore.py
+    blobdir = getattr(conf, 'Blobdir', os.path.join(conf.Submissiondir, '_blobs'))
+    kept = blobstore.store_files(blobdir, dir, files)
 
-        if changes:
-            logger.info("Extracting attachment %i (named %s, keeping %d old copies)" % (counter,repr(filename),changes) )
+    for filename in files.keys():
+        if kept[filename] is None:
+            logger.info("Attachment %s is unchanged from the previous submission" % repr(filename))
+        elif kept[filename]:
+            logger.info("Extracting attachment %s (keeping %d old versions)" % (repr(filename),kept[filename]) )
         else:
-            logger.info("Extracting attachment %i (named %s)" % (counter,repr(filename)) )
-
-        fp = open(os.path.join(dir, filename), 'wb')
-        fp.write( att[filename] )
-        fp.close()
+            logger.info("Extracting attachment %s" % repr(filename) )
 
     return att
 
 
-def append_mail_to_mailbox( mail, student_login, logger, logcomment = "" ):
+def append_mail_to_mailbox( mail, student_login, logger, logcomment = "", assignment = None ):
     username = student_login
     mailboxdir = os.path.join(conf.Maildir, username)
 
     logger.info("Appending Email to %s %s" % (repr(mailboxdir),logcomment))
 
-    f_out = open ( mailboxdir , 'a' )
-    f_out.write( mail )
-    f_out.close()
+    # written at the latest when the current batch has been processed
+    get_mailbox_writer().append( username, mail, assignment )
+
+
+def get_mailbox_writer():
+    """Returns the MailboxWriter (or, if conf.mail_archive is set, the
+    MailArchive) of this process. It is made on first use, and again in
+    ingestion worker processes, which must not write what their parent
+    had buffered."""
+
+    global _mailbox_writer
+    if _mailbox_writer is None or _mailbox_writer.pid != os.getpid():
+        if getattr(conf, 'mail_archive', False):
+            _mailbox_writer = mailarchive.MailArchive(
+                getattr(conf, 'Mailarchivedir', os.path.join(conf.Maildir,'_archive')),
+                durability=getattr(conf, 'mailbox_durability', 'message'),
+                flush_bytes=getattr(conf, 'mailbox_flush_bytes', 1048576),
+                segment_format=getattr(conf, 'mail_archive_segment_format', "%Y-%m"))
+        else:
+            _mailbox_writer = mailboxwriter.MailboxWriter(conf.Maildir,
+                durability=getattr(conf, 'mailbox_durability', 'message'),
+                flush_bytes=getattr(conf, 'mailbox_flush_bytes', 1048576))
+        atexit.register(_mailbox_writer.close)
+    return _mailbox_writer
 
 
 def split_mailbox_into_strings( inbox ):
@@ -299,59 +278,11 @@ def split_mailbox_into_strings( inbox ):
     """Takes filename of inbox containing one or more email, and
     returns list of strings, each containing one email
 
+    This keeps all emails in memory; process_inbox() uses
+    mboxio.iter_mbox() instead.
     """
 
-    fin = open(inbox,"r")
-    mailstrings = []
-    mailtext = []
-    linecounter = 0
-
-    while 1:
-        line = fin.readline()
-        linecounter += 1
-        if (linecounter%10000)==0:
-            log_global.debug("read line %d: %s" % (linecounter,line[0:30]))
-        if not line:
-            if debug:
-                print "reached end of file"
-
-            #if we have found any data 
-            if mailtext != []:
-                # append last data (as string) to list of emails
-                mailstrings.append( string.join(mailtext,'') )
-            else:
-                #this indicates an empty inbox file
-                pass
-            break   #reached end of file
-
-        if line[0:5] == "From ":   #found new email, start new file
-            log_global.debug("Found new 'From' in mailbox file")
-            #this will make the first list entry 'None'. Remove that before we return
-            mailstrings.append( string.join(mailtext,'') )
-            mailtext = [line]
-            if debug:
-                print "Starting new mailf file"
-
-        # Emails that contain "From " on a single line get that escaped to ">From",
-        # and ">From" will be escaped to ">>From" etc.
-
-        fmatch=re.match(_rx_from_escape,line)
-        if fmatch:
-            line=fmatch.group(1)
-
-        #write line to currently active mailfile
-        try:
-            mailtext.append(line)
-        except IndexError:
-            log_global.exception("Error: file %s didn't start with 'From'" % repr(inbox))
-            raise IndexError
-        except:
-          print "Came across some other error while reading inbox"
-          sys.exit(1)
-
-    fin.close()
-
-    return mailstrings[1:] 
+    return [mail for (start, end, mail) in mboxio.iter_mbox(inbox)]
 
 
 def email_address_username_and_domain(addr):
@@ -393,10 +324,28 @@ def email_address_username_and_domain(addr):
     return username, domain
 
 
+def parse_headers( mail ):
+    """Parses only the headers of mail (a string) and returns them as
+    an email.Message.Message whose payload is the undecoded body.
+
+    This is all that is needed to decide what to do with an email, and
+    to reply to it or forward it. Only submissions need the full
+    (MIME-decoding) parse with email.message_from_string()."""
+
+    end = mail.find('\n\n')
+    if end < 0:
+        end = len(mail)
+    msg = email.parser.HeaderParser().parsestr( mail[:end+1] )
+    msg.set_payload( mail[end+2:] )
+    return msg
+
+
 def get_email_metadata( the_email, debug = 0 ):
     """expects email as msg object from email.Message.Message()
 
     Returns sender, login, domain, number of attachments and subject line.
+    (If the_email comes from parse_headers(), the number of attachments
+    is always 1.)
     """
 
     #identify student
@@ -420,20 +369,23 @@ def get_email_metadata( the_email, debug = 0 ):
     return result
 
 
-def sending_domain_okay(domain,known_domains=["example.org","example.org.uk"]):
-    pattern = "(%s)$" % reduce(lambda x,y:(x+"|"+y),["\\b"+re.escape(d) for d in known_domains])
-    # This turns known_domains into word-boundary-delimited matches, i.e.
-    # soton.ac.uk -> \bsoton\.ac\.uk, then builds a termimal-or-pattern from that.
+def sending_domain_okay(domain,known_domains=mailclassifier.default_known_domains):
+    if known_domains is mailclassifier.default_known_domains:
+        return get_classifier().sending_domain_okay(domain)
+    return is_true(mailclassifier.domain_pattern(known_domains).search(domain))
 
-    return is_true(re.search(pattern,domain,re.IGNORECASE))
 
-
-def replymail_confirm_submission(real_name, email_addr, text, subject, assignment, valid_attachments, q_id=None):
+def replymail_confirm_submission(real_name, email_addr, text, subject, assignment, valid_attachments, q_id=None, deferred_until=None, superseded=[]):
     """ Sends an email to the student named real_name at address
     email_addr, which consists of a confirmation of receipt of their
     email whose subject should be in subject, with a q_id (if
     assigned) followed by the contents of the traing text.
 
+    If the test of the submission has been deferred by the rate
+    limiter, deferred_until is the time at which it will be queued.
+    superseded lists the ids of earlier jobs that will not be tested
+    because of this submission.
+
     Returns the sent message as string if there are no attachments, or
     None."""
 
@@ -447,10 +399,23 @@ def replymail_confirm_submission(real_name, email_addr, text, subject, assignmen
                 "testing queue (id=%s).\n" % (q_id) + \
                 "You will receive a separate email with the "+\
                 "testing results.")+"\n\n"
+        if superseded:
+            intro += textwrap.fill("Your earlier submission(s) waiting in the "+\
+                "testing queue (id=%s) will not be tested, " % ", ".join(map(str,superseded))+\
+                "as they are superseded by this one.")+"\n\n"
 
         newsubject = "["+conf.ModulecodeSubjectLine+"] Submission Confirmation "\
             +str(assignment)+" ("+time.asctime()+")"
 
+    elif deferred_until:
+        intro += textwrap.fill("Your files have been saved. You have submitted "+\
+            "this assignment more often than can be tested in the given time, "+\
+            "so your latest submission will be added to the testing queue "+\
+            "at about %s. " % time.ctime(deferred_until)+\
+            "You will receive a separate email with the testing results.")+"\n\n"
+        newsubject = "["+conf.ModulecodeSubjectLine+"] Submission Confirmation "\
+            +str(assignment)+" ("+time.asctime()+")"
+
     else:
         intro += textwrap.fill("Your files will be archived.")+"\n\n"
         newsubject = "["+conf.ModulecodeSubjectLine+"] Archive confirmation "+str(assignment)+" ("+time.asctime()+")"
@@ -578,7 +543,7 @@ def submission_reply_report(student_dir, attachments, lab_name):
         report.append("         (Maybe you have forgotten to attach them?)\n\n")
 
     #get list of files in student_dir
-    submitted_files = os.listdir(os.path.join(student_dir,lab_name))
+    submitted_files = blobstore.latest_files(os.path.join(student_dir,lab_name))
 
     #remove log files from these and separate into known and unknown files
     submitted_by_type = analyze_filenames(assignment_file_map(lab_name), submitted_files, log_global)
@@ -596,9 +561,27 @@ def submission_reply_report(student_dir, attachments, lab_name):
 
 
 
-def check_maildaemon( msg, from_addr, domain ):
+def get_classifier():
+    """Returns the MailClassifier for the configured assignments and
+    sender checks (made on first use)."""
+
+    global _classifier
+    if _classifier is None:
+        if conf.allow_only_emails_given_in_list:
+            is_allowed = lambda addr: csvio.get_roster().is_allowed(addr)
+        else:
+            is_allowed = None
+        _classifier = mailclassifier.MailClassifier(
+            conf.assignments.keys(), conf.Modulecode, is_allowed,
+            getattr(conf, 'known_domains', mailclassifier.default_known_domains))
+    return _classifier
+
 
-    if re.search(_rx_email_daemon,from_addr,re.IGNORECASE):
+def forward_special_mail( msg, kind ):
+    """Forwards msg from a sender of kind (mailclassifier.DAEMON, MYSELF
+    or TWITTER) to the administrator."""
+
+    if kind == mailclassifier.DAEMON:
         log_global.critical("Received a msg from a mailing daemon (X)! ("+msg["From"]+")")
         log_global.critical("Forwarding it to administrator (%s)." % (conf.SysadminEmail) )
 
@@ -615,19 +598,16 @@ def check_maildaemon( msg, from_addr, domain ):
         msg["From"] = conf.ModuleEmailAddress
 
         enqueue_outgoing_mails.mailqueue_push(msg)
-        return 1
 
-    #check that the email is not from ourselves
-    if string.count( from_addr.lower(), conf.Modulecode.lower()):
+    elif kind == mailclassifier.MYSELF:
         log_global.critical("Received a msg from myself! ("+msg["From"]+")")
         log_global.critical("Forwarding it to administrator (%s)." % repr(conf.SysadminEmail) )
 
         subject = "Urgent: [%s] email from system (danger of loop): %s" % (conf.ModulecodeSubjectLine,repr(msg["Subject"]))
         sendmail = enqueue_outgoing_mails.send_text_message( conf.SysadminEmail, conf.ModuleEmailAddress, msg.as_string(), subject)
         append_mail_to_mailbox( sendmail, conf.sysadminmailfolder, log_global, "(outgoing mail to SysadminEmail (myself-loop))" )
-        return 1
 
-    if string.count(domain.lower(), "twitter"):
+    elif kind == mailclassifier.TWITTER:
         log_global.info("Received a msg from twitter: ("+msg["From"]+")")
         log_global.info("Forwarding it to administrator (%s)." % (conf.SysadminEmail) )
 
@@ -645,9 +625,19 @@ def check_maildaemon( msg, from_addr, domain ):
         msg["From"] = conf.ModuleEmailAddress
 
         enqueue_outgoing_mails.mailqueue_push(msg)
-        return 1
 
-    return 0
+    else:
+        raise ValueError, "Unknown kind of sender %s" % repr(kind)
+
+
+def check_maildaemon( msg, from_addr, domain ):
+
+    kind = get_classifier().sender_kind(from_addr, domain)
+    if kind is None:
+        return 0
+
+    forward_special_mail(msg, kind)
+    return 1
 
 
 def subject_identification( assignments, submission, log_global):
@@ -661,275 +651,712 @@ def subject_identification( assignments, submission, log_global):
     return None if could not identify
     """
 
-    debug = 0
-    if debug:
-        print 'trying to identify %20s\t: ' % submission,
-
-
-    if submission == None:
-        log_global.warn("unparseable subject: '%s' " % submission)
+    if assignments is conf.assignments:
+        classifier = get_classifier()
+    else:
+        classifier = mailclassifier.MailClassifier(assignments.keys(), conf.Modulecode)
+    return classifier.identify_assignment(submission, log_global)
+
+
+def get_job_queue():
+    """Returns the testing queue (a jobqueue.JobQueue) for this process
+    (made on first use, and again in ingestion worker processes). Jobs
+    left in the queue directory by earlier versions are migrated into
+    it."""
+
+    global _job_queue
+    if _job_queue is None or _job_queue.pid != os.getpid():
+        if not os.path.exists(conf.subtest_queue):
+            os.makedirs(conf.subtest_queue)
+        _job_queue = jobqueue.JobQueue(
+            getattr(conf, 'subtest_queue_db', os.path.join(conf.subtest_queue,'queue.sqlite')))
+        (migrated, unreadable) = _job_queue.migrate_directory(conf.subtest_queue)
+        if migrated > 0:
+            log_global.info("Migrated %d job(s) from the queue directory %s" % (migrated,conf.subtest_queue))
+        if len(unreadable) > 0:
+            log_global.error("Could not migrate %d job file(s) from the queue directory: %s" % (len(unreadable),unreadable))
+    return _job_queue
+
+
+def subtest_wakeup_socket():
+    """Returns the socket on which process_subtests.py --daemon listens
+    for new jobs (see wakeup.py)."""
+    return getattr(conf, 'subtest_wakeup_socket', os.path.join(conf.subtest_base,'wakeup.sock'))
+
+
+def submission_deadline(email_addr, assignment):
+    """Returns the deadline (in seconds since the epoch) of assignment
+    for the deadline group of the student with email_addr (see
+    conf.deadline_groups), or None if there is none."""
+
+    student = csvio.get_roster().lookup_email(email_addr)
+    if student is None:
         return None
-
-    if submission == '':
-        log_global.warn("unparseable empty string in subject: '%s' " % submission)
+    deadline = getattr(conf, 'deadline_groups', {}).get(student[1], {}).get(assignment)
+    if deadline is None:
         return None
+    return time.mktime(deadline.timetuple())
 
-    assert len(assignments.keys()) > 0, "Internal error"
 
-    match_spam=re.match(r"\{Spam?\}(.*)",submission)
-    if match_spam:
-        submission=match_spam.group(1)
-        log_global.warn("stripping off '{Spam?}' from subject line: %s " % repr(submission))
-
-    forward_reply_keywords = ['Fwd:', 'Forward:', 'Re:', 'Reply:']
-    for kwd in forward_reply_keywords:
-        if kwd in submission:
-            log_global.warn("stripping off '{}' from subject line: {} ".format(
-                kwd, submission))
-            submission = submission.replace(kwd, '')
-            continue
-
-    #The list of relevant keywords we are after is
-    keys = [x.lower() for x in assignments.keys()] #this is ['lab1','lab2',...,'lab6','cw']
-
-    #check whether subject line is preceeded by "{Spam?} ". If so,
-    #then the mailing system thinks it is spam. This could be wrong, however.
-    #we therefore get rid of this, and log it.
-
-    canonicalized_submission=submission.replace(' ','').lower()
-
-    #do trivial test (i.e. input is 'lab1' or 'cw')
-
-    if canonicalized_submission in keys:
-        return canonicalized_submission
+def subtestqueue_push(metadata):
+    """Adds a job with metadata (a dictionary) to the testing queue and
+    returns its id. Earlier jobs of the same student for the same
+    assignment which have not started yet are superseded; their ids
+    are added to metadata as 'superseded'."""
+
+    deadline = submission_deadline(metadata['email'], metadata['assignment'])
+    (q_id, superseded) = get_job_queue().enqueue(metadata, deadline=deadline)
+    log_global.info("Injecting job (id=%d) for %s/%s to testing-queue" % (q_id,metadata['assignment'],metadata['login']))
+    if superseded:
+        log_global.info("Superseded testing-queue entries %s" % superseded)
+    wakeup.notify(subtest_wakeup_socket())
 
-    log_global.warn("unparseable string: %s / %s" % (submission, canonicalized_submission))
-    return None
+    return q_id
 
 
-def subtestqueue_push(metadata):
+def batch_checkpoint_path(batchpath):
+    return batchpath + '.offset'
 
-    counterfile = os.path.join(conf.subtest_queue,'.maxid')
 
-    if not os.path.exists(counterfile):
-        #make sure directory exists
-        os.system('mkdir -p %s' % conf.subtest_queue)
-        open(counterfile,'w').write("0")
+def read_batch_checkpoint(batchpath):
+    """Returns the byte offset up to which the batch file has been
+    processed (0 if no email of this batch has been processed yet)."""
 
-    f = open(counterfile, 'r+')
-    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
-    q_id = int(f.read())+1
-    f.seek(0)
-    f.truncate(0)
-    f.write("%d" % q_id)
-    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    try:
+        return int(open(batch_checkpoint_path(batchpath),'r').read())
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return 0
+        raise
+
+
+def write_batch_checkpoint(batchpath, offset):
+    """Atomically records that batchpath has been processed up to byte
+    offset 'offset'."""
+
+    checkpoint = batch_checkpoint_path(batchpath)
+    f = open(checkpoint + '.tmp', 'w')
+    f.write("%d" % offset)
+    f.flush()
+    os.fsync(f.fileno())
     f.close()
+    os.rename(checkpoint + '.tmp', checkpoint)
 
-    filename = "s%05d-%s-%s" % (q_id,metadata['assignment'],metadata['login'])
-    log_global.info("Injecting job (id=%d) to testing-queue entry '%s'" % (q_id,filename))
 
-    metadata['id']=q_id
-    metadata['qfilename']=filename
-    metadata['qfilepath']=os.path.join(conf.subtest_queue,filename)
+def pending_batches(batchdir):
+    """Returns sorted list of paths to batch files in batchdir that have
+    not been processed completely (i.e. left over from a crashed run)."""
 
-    assert os.path.exists(os.path.join(conf.subtest_queue,filename))==False,"Internal error"
-    f=open(os.path.join(conf.subtest_queue,filename),'w')
-    f.write(pprint.pformat(metadata))
-    f.close()
+    if not os.path.exists(batchdir):
+        os.makedirs(batchdir)
+    names = [x for x in os.listdir(batchdir)
+             if x[0:6] == "batch-" and not x.endswith('.offset') and not x.endswith('.tmp')]
+    return [os.path.join(batchdir, x) for x in sorted(names)]
 
-    return q_id
 
+def handoff_inbox(batchdir):
+    """Moves all emails from conf.inbox into a new batch file with a
+    unique name in batchdir, and returns the path to that file (or None
+    if the inbox is empty).
 
-def process_inbox():
-    log_global.debug("process_inbox: lockdire=%s" % conf.Lockdir)
+    If possible, the inbox is renamed (no copying), and an empty inbox
+    is put in its place. This requires batchdir to be on the same file
+    system as the inbox, and the inbox directory to be writable for us.
+    Otherwise, the inbox is copied to a temporary file which is renamed
+    to the batch name only once complete, and the inbox is truncated
+    after that. In both cases a crash at any point leaves every email
+    either in the inbox or in a complete batch file.
+    """
 
-    semaphore=lock_semaphore(conf.Lockdir)
+    #lock mailbox file
+    finbox = open(conf.inbox, 'r+')
+    fcntl.flock(finbox.fileno(), fcntl.LOCK_EX)
 
-    if(not semaphore):
-        os.system('echo "\n---------------\n`date`"')
-        print "It seems that another version of this script is running already... Leaving cowardly."
-        print "Remove LOCKFILE in %s to overrride this" % repr(conf.Lockdir)
-        log_global.warn("Found LOCK, exiting now!")
-        return None
+    try:
+        inbox_stat = os.fstat(finbox.fileno())
+        if inbox_stat.st_size == 0:
+            return None
 
-    # now check whether there is anything in the mailbox file. If
-    # not, there is no point carrying on
+        batchpath = os.path.join(batchdir, "batch-%s-%d-%s" % (
+            time.strftime("%Y%m%d-%H%M%S"), os.getpid(), inbox_stat.st_size))
 
-    #test whether mailbox file exists
-    if not os.path.exists(conf.inbox):
-        raise StandardError, "Inbox file %s does not exist" % repr(conf.inbox)
+        try:
+            os.rename(conf.inbox, batchpath)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EACCES, errno.EPERM):
+                raise
+            log_global.debug("Cannot rename %s to %s (%s), will copy" % (repr(conf.inbox),repr(batchpath),e))
+        else:
+            log_global.debug("Renamed %s to %s" % (repr(conf.inbox),repr(batchpath)))
+            try:
+                fd = os.open(conf.inbox, os.O_WRONLY | os.O_CREAT | os.O_EXCL, inbox_stat.st_mode & 0777)
+                os.close(fd)
+            except OSError as e:
+                if e.errno != errno.EEXIST: # new mail has been delivered already
+                    raise
+            return batchpath
+
+        log_global.debug("Copying %s to %s" % (repr(conf.inbox),repr(batchpath)))
+        fout = open(batchpath + '.tmp', 'wb')
+        shutil.copyfileobj(finbox, fout)
+        fout.flush()
+        os.fsync(fout.fileno())
+        fout.close()
+        shutil.copymode(conf.inbox, batchpath + '.tmp') # also copy permissions
+        os.rename(batchpath + '.tmp', batchpath)
+
+        #now delete mailbox
+        finbox.seek(0)
+        finbox.truncate(0)
+        return batchpath
+
+    finally:
+        #unlock
+        fcntl.flock(finbox.fileno(), fcntl.LOCK_UN)
+        finbox.close()
+
+
+def mail_sender_login(mail):
+    """Returns the (lower case) login part of the sender address of
+    mail (a string), parsing only the headers. Returns '' if there is
+    no usable From header."""
+
+    headers = parse_headers(mail)
+    (real_name, email_addr) = email.Utils.parseaddr(headers["From"] or '')
+    return email_addr.rsplit('@',1)[0].lower()
+
+
+def _ingest_worker(batchpath, tasks, results):
+    """Runs in a child process: processes the emails (given as
+    (counter, start, end) in the queue tasks) in order. Reports
+    (start, end, status) for each of them to the queue results, where
+    status is None on success and "quarantined" for an email that
+    failed and has been put into quarantine (see quarantine_mail).
+    If even that fails, the traceback is reported, and the remaining
+    emails of this worker are not processed but reported as
+    "skipped".
+
+    Results are reported once the mailbox copies of the emails are
+    written. When there is no email to process, the buffered copies
+    are written right away: the parent only dispatches a limited
+    number of emails before it waits for results."""
+
+    failed = False
+    writer = get_mailbox_writer()
+    unflushed = [] # processed, but mailbox appends still buffered
+    fin = open(batchpath, 'rb')
+    while True:
+        try:
+            task = tasks.get(True, 0.1)
+        except Queue.Empty:
+            if len(unflushed) > 0:
+                writer.flush()
+                record_processed()
+                for result in unflushed:
+                    results.put(result)
+                unflushed = []
+            task = tasks.get()
+        if task is None:
+            break
+        (counter, mail_start, mail_end) = task
+        if failed:
+            results.put((mail_start, mail_end, "skipped"))
+            continue
+        log_global.debug("(1) processing mail %d (bytes %d-%d) in worker %d" % (counter,mail_start,mail_end,os.getpid()))
+        status = None
+        try:
+            mail = mboxio.read_mail(fin, mail_start, mail_end)
+            try:
+                process_one_mail(mail, counter)
+            except:
+                writer.discard_message()
+                quarantine_mail(mail, counter, traceback.format_exc())
+                status = "quarantined"
+        except:
+            log_global.exception("Worker %d failed to process mail %d" % (os.getpid(),counter))
+            # the unflushed emails are processed again on resumption
+            writer.discard()
+            del _unrecorded[:]
+            for (start, end, ignored) in unflushed:
+                results.put((start, end, "skipped"))
+            unflushed = []
+            results.put((mail_start, mail_end, traceback.format_exc()))
+            failed = True
+        else:
+            unflushed.append((mail_start, mail_end, status))
+            if writer.end_of_message():
+                record_processed()
+                for result in unflushed:
+                    results.put(result)
+                unflushed = []
+    fin.close()
+    writer.close()
+    record_processed()
+    for result in unflushed:
+        results.put(result)
+
+
+def _collect_ingest_result(batchpath, results, outstanding, dispatched, finished, errors, offset, timeout=None):
+    """Takes one result from the ingestion workers. The batch
+    checkpoint is advanced over all emails that have been processed
+    successfully, together with all emails before them. Failed (and
+    skipped) emails are not, so that they are processed again when the
+    batch is resumed. Returns the new (outstanding, offset)."""
+
+    global _quarantined
+
+    (mail_start, mail_end, error) = results.get(True, timeout)
+    if error is None:
+        finished[mail_start] = mail_end
+    elif error == "quarantined":
+        finished[mail_start] = mail_end
+        _quarantined += 1
+    elif error != "skipped":
+        errors.append(error)
+
+    advanced = False
+    while len(dispatched) > 0 and dispatched[0] in finished:
+        offset = finished.pop(dispatched.popleft())
+        advanced = True
+    if advanced:
+        write_batch_checkpoint(batchpath, offset)
+
+    return (outstanding - 1, offset)
+
+
+def process_mails_parallel(batchpath, mails, offset, counter, nworkers):
+    """Processes the emails yielded by mails (from mboxio.iter_mbox on
+    batchpath) with nworkers worker processes.
+
+    Emails are assigned to workers by a hash of the sender's login, so
+    that all emails of one student are processed by the same worker in
+    the order in which they arrived (save_attachments() relies on
+    this), while different students are processed concurrently.
+
+    The batch checkpoint only advances over emails for which all
+    earlier emails have been processed as well. At most 2*nworkers
+    emails are dispatched but not finished at any time, so that the
+    failure budget is checked as the results come in. Returns the new
+    (offset, counter)."""
+
+    tasks = [multiprocessing.Queue() for i in range(nworkers)]
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=_ingest_worker, args=(batchpath, tasks[i], results))
+               for i in range(nworkers)]
+    for worker in workers:
+        worker.start()
+
+    dispatched = collections.deque()    # start offsets, in order
+    finished = {}                       # start offset -> end offset
+    errors = []
+    outstanding = 0
+
+    def collect():
+        # wait for the next result, noticing workers that died
+        while True:
+            try:
+                return _collect_ingest_result(
+                    batchpath, results, outstanding, dispatched, finished, errors, offset, timeout=1)
+            except Queue.Empty:
+                if [w for w in workers if w.exitcode not in (None, 0)]:
+                    raise StandardError, "Ingestion worker died, %d email(s) unaccounted for" % outstanding
 
-    print("Trying to read from inbox {}".format(conf.inbox))
-    if int(os.popen("wc -c "+conf.inbox).read().split()[0]) == 0:
-      log_global.info("Inbox is empty. Quitting." )
-      unlock_semaphore(semaphore)
-      return None
+    try:
+        for (mail_start, mail_end, mail) in mails:
+            while outstanding >= 2*nworkers or (outstanding > 0 and not results.empty()):
+                (outstanding, offset) = collect()
+            if failure_budget_exhausted():
+                break
+            counter += 1
+            i = zlib.crc32(mail_sender_login(mail)) % nworkers
+            dispatched.append(mail_start)
+            tasks[i].put((counter, mail_start, mail_end))
+            outstanding += 1
+
+        for task in tasks:
+            task.put(None)
+
+        while outstanding > 0:
+            (outstanding, offset) = collect()
+
+    finally:
+        for worker in workers:
+            if outstanding > 0 and worker.is_alive():
+                worker.terminate()
+            worker.join()
+
+    if len(errors) > 0:
+        raise StandardError, "%d email(s) failed in parallel ingestion, first error:\n%s" % (len(errors),errors[0])
+    if failure_budget_exhausted():
+        raise StandardError, "Failure budget exhausted: %d email(s) quarantined in this run" % _quarantined
+
+    return (offset, counter)
+
+
+def quarantine_mail(mail, counter, tb):
+    """Puts mail (a string), which raised an exception with traceback tb
+    while being processed, into the quarantine directory, so that the
+    rest of the batch can be processed. The mail is saved as
+    <name>.eml together with the traceback as <name>.traceback."""
+
+    global _quarantined
+    _quarantined += 1
+
+    quarantinedir = getattr(conf, 'Quarantinedir', os.path.join(conf.Maildir,'_quarantine'))
+    if not os.path.exists(quarantinedir):
+        os.makedirs(quarantinedir)
+    name = "mail-%s-%d-%d" % (time.strftime("%Y%m%d-%H%M%S"), os.getpid(), counter)
+    log_global.error("Failed to process mail %d, moving it to quarantine as %s:\n%s" % (counter,repr(name),tb))
+
+    for (suffix, text) in (('.traceback', tb), ('.eml', mail)):
+        path = os.path.join(quarantinedir, name + suffix)
+        f = open(path + '.tmp', 'w')
+        f.write(text)
+        f.close()
+        os.rename(path + '.tmp', path)
 
-    #lock mailbox file
-    finbox = open(conf.inbox, 'r+')
-    fcntl.flock(finbox.fileno(), fcntl.LOCK_EX)
 
-    # copy file to tmp-file before we start analysing
-    tempname =  conf.tmpname
-    log_global.debug("Copying %s to %s" % (repr(conf.inbox),repr(tempname)))
-    shutil.copyfile( conf.inbox, tempname )
-    shutil.copymode( conf.inbox, tempname ) # also copy permissions
+def failure_budget_exhausted():
+    """True if more emails have been quarantined in this run than
+    conf.ingest_failure_budget allows."""
 
-    #now delete mailbox
-    finbox.seek(0)
-    finbox.truncate(0)
-    #unlock
-    fcntl.flock(finbox.fileno(), fcntl.LOCK_UN)
-    finbox.close()
+    return _quarantined > getattr(conf, 'ingest_failure_budget', 10)
 
-    mails = split_mailbox_into_strings( tempname )
 
-    log_global.info("=====> found %d emails in inbox %s" % (len(mails),repr(conf.inbox)))
+def process_batch(batchpath, counter=0):
+    """Processes all emails in the batch file batchpath, starting at the
+    recorded checkpoint, and removes the batch file when done. Returns
+    the counter of processed emails (starting from 'counter')."""
 
-    counter = 0
+    offset = read_batch_checkpoint(batchpath)
+    if offset > 0:
+        log_global.info("=====> resuming batch %s at byte %d" % (repr(batchpath),offset))
+    else:
+        log_global.info("=====> reading emails from batch %s" % repr(batchpath))
+
+    # If the inbox was renamed while the mail delivery agent was
+    # waiting for the lock, it may have appended to the batch file
+    # after we released the lock. Keep reading until we have seen the
+    # end of the file.
+    workers = getattr(conf, 'ingest_workers', 1)
+    size = None
+    while True:
+        if size == os.path.getsize(batchpath):
+            # A mail delivery agent that opened the inbox before it was
+            # renamed appends while holding the lock: check the size
+            # once more under the lock before removing the batch file.
+            fbatch = open(batchpath, 'rb')
+            fcntl.flock(fbatch.fileno(), fcntl.LOCK_EX)
+            try:
+                if size == os.fstat(fbatch.fileno()).st_size:
+                    os.remove(batchpath)
+                    break
+            finally:
+                fcntl.flock(fbatch.fileno(), fcntl.LOCK_UN)
+                fbatch.close()
+        size = os.path.getsize(batchpath)
+        mails = mboxio.iter_mbox(batchpath, start=offset, use_mmap=getattr(conf, 'inbox_use_mmap', False))
+        if workers > 1:
+            (offset, counter) = process_mails_parallel(batchpath, mails, offset, counter, workers)
+            continue
+        writer = get_mailbox_writer()
+        try:
+            for (mail_start, mail_end, mail) in mails:
+                counter += 1
+                log_global.debug("(1) processing mail %d (bytes %d-%d)" % (counter,mail_start,mail_end))
+                try:
+                    process_one_mail(mail, counter)
+                except:
+                    writer.discard_message()
+                    quarantine_mail(mail, counter, traceback.format_exc())
+                offset = mail_end
+                # only move the checkpoint past (and record in the
+                # ledger) emails whose mailbox copies are on disk
+                if writer.end_of_message():
+                    record_processed()
+                    write_batch_checkpoint(batchpath, offset)
+                if failure_budget_exhausted():
+                    writer.close()
+                    record_processed()
+                    write_batch_checkpoint(batchpath, offset)
+                    raise StandardError, "Failure budget exhausted: %d email(s) quarantined in this run" % _quarantined
+        except:
+            # emails after the checkpoint will be processed again
+            writer.discard()
+            del _unrecorded[:]
+            raise
+        writer.close()
+        record_processed()
+        write_batch_checkpoint(batchpath, offset)
+
+    if os.path.exists(batch_checkpoint_path(batchpath)):
+        os.remove(batch_checkpoint_path(batchpath))
+    return counter
+
+
+def get_rate_limiter():
+    """Returns the RateLimiter for submissions to the testing queue for
+    this process (made on first use, and again in ingestion worker
+    processes), or None if conf.submission_rate_capacity is None."""
+
+    global _rate_limiter
+    capacity = getattr(conf, 'submission_rate_capacity', None)
+    if capacity is None:
+        return None
+    if _rate_limiter is None or _rate_limiter.pid != os.getpid():
+        _rate_limiter = ratelimit.RateLimiter(
+            getattr(conf, 'submission_ratelimit_db', os.path.join(conf.Homedir,'ratelimit.sqlite')),
+            capacity, getattr(conf, 'submission_rate_interval', 120))
+    return _rate_limiter
 
-    for mail in mails:
-        counter += 1
 
-        log_global.debug("(1) processing mail %d" % counter)
+def release_deferred_tests():
+    """Queues the tests deferred by the rate limiter whose time has
+    come."""
 
-        msg = email.message_from_string( mail )
+    limiter = get_rate_limiter()
+    if limiter is None:
+        return
+    released = limiter.release_due(subtestqueue_push)
+    if released > 0:
+        log_global.info("Released %d deferred test(s) into the testing queue" % released)
 
-        (real_name, email_addr, email_login, domain, n_attach, subject) = get_email_metadata( msg )
 
-        #keep copy of email in folder with ALL incoming email (just in case)
-        append_mail_to_mailbox( mail, '_allincomingemail', log_global, "(keep copy of all incoming email in _allincomingemail)" )
-        log_global.info("%i: from %s (%s), ATT: %d, SUB: %s" % (counter,repr(real_name),repr(email_addr),n_attach,repr(subject)))
+def get_ledger():
+    """Returns the Ledger of processed emails for this process (made on
+    first use, and again in ingestion worker processes), or None if
+    conf.ingest_ledger is None."""
 
-        #check for special events (are we getting mail from a daemon?)
-        if check_maildaemon( msg, email_login, domain ):
-            log_global.info("(2a) sent email to administrator. Skipping to next student")
-            continue
+    global _ledger
+    filename = getattr(conf, 'ingest_ledger', os.path.join(conf.Maildir,'_ledger.sqlite'))
+    if filename is None:
+        return None
+    if _ledger is None or _ledger.pid != os.getpid():
+        _ledger = ledger.Ledger(filename)
+    return _ledger
+
+
+def process_one_mail(mail, counter):
+    """Processes mail (a string), unless the ledger records that it has
+    been processed before. The email is recorded in the ledger by the
+    next record_processed()."""
+
+    processed = get_ledger()
+    if processed is not None:
+        key = ledger.mail_key(mail, parse_headers(mail)["Message-ID"])
+        when = processed.seen(key)
+        if when is None and key in _unrecorded:
+            when = time.time()
+        if when is not None:
+            log_global.warn("%i: skipping email %s (already processed at %s)" % (counter,repr(key),time.ctime(when)))
+            return
+
+    process_new_mail(mail, counter)
+
+    if processed is not None:
+        _unrecorded.append(key)
+
+
+def record_processed():
+    """Commits the emails processed since the last call to the ledger.
+    Call this only once the mailbox writer has written their mailbox
+    copies (i.e. when end_of_message() returns True, or after close()):
+    emails in the ledger are skipped when a batch is processed again,
+    so their copies would be lost otherwise."""
+
+    while len(_unrecorded) > 0:
+        get_ledger().record(_unrecorded[0])
+        del _unrecorded[0]
+
+
+def process_new_mail(mail, counter):
+    # Rejected, forwarded and retrieval emails are dealt with using
+    # the headers only; the body is parsed for submissions only.
+    msg = parse_headers( mail )
+
+    (real_name, email_addr, email_login, domain, n_attach, subject) = get_email_metadata( msg )
+
+    #keep copy of email in folder with ALL incoming email (just in case)
+    log_global.info("%i: from %s (%s), SUB: %s" % (counter,repr(real_name),repr(email_addr),repr(subject)))
+
+    (decision, assignment) = get_classifier().classify(email_login, email_addr, domain, subject, log_global)
+    append_mail_to_mailbox( mail, '_allincomingemail', log_global, "(keep copy of all incoming email in _allincomingemail)", assignment )
+    log_global.debug("(2) routing decision: %s, assignment %s" % (decision, repr(assignment)))
+
+    #check for special events (are we getting mail from a daemon?)
+    if decision in (mailclassifier.DAEMON, mailclassifier.MYSELF, mailclassifier.TWITTER):
+        forward_special_mail(msg, decision)
+        log_global.info("(2a) sent email to administrator. Skipping to next student")
+        return
+
+    #Check whether we need to check for particular users
+    if decision == mailclassifier.UNKNOWN_SENDER:
+        log_global.warn("rejecting email from addresss %s (not in allowed list)" % (email_addr))
+        error_msg = replymail_error(msg, conf.TXT_address,CC_to_admin=True,maxsend=None)
+        append_mail_to_mailbox( error_msg, '_errors', log_global, "(outgoing error mail: sending email_address (%s) unknown)" % (email_addr) )
+        return
+    elif decision == mailclassifier.WRONG_DOMAIN:
+        log_global.warn("rejecting email from %s (wrong domain)" % (email_addr))
+        error_msg = replymail_error(msg, conf.TXT_Domain,CC_to_admin=True)
+        append_mail_to_mailbox( error_msg, '_errors', log_global, "(outgoing error mail: wrong domain (%s))" % (email_addr) )
+        return
+
+    #now we know the student
+    log_global.debug("(2) domain okay, student is %s (%s)" % (repr(email_login),repr(real_name)))
+
+    #check that the directory exists:
+    student_dirpart = email_login
+    student_dir = os.path.join( conf.Submissiondir, student_dirpart)
+    if not os.path.exists( student_dir ):
+        log_global.debug("Creating directory %s" % (repr(student_dir)))
+        os.mkdir(student_dir)
+    else:
+        log_global.debug("   Student directory exists (%s)" % (repr(student_dir)))
 
-        #Check whether we need to check for particular users
-        if conf.allow_only_emails_given_in_list:
-            log_global.debug("(3a) only users given in list are allowed")
-            if email_addr.lower() in map(string.lower,lab_helpers.allowed_email_addresses()):
-                log_global.debug("Incoming email from %s is in list of acceptable emails" % email_addr)
-            else:
-                log_global.warn("rejecting email from addresss %s (not in allowed list)" % (email_addr))
-                error_msg = replymail_error(msg, conf.TXT_address,CC_to_admin=True,maxsend=None)
-                append_mail_to_mailbox( error_msg, '_errors', log_global, "(outgoing error mail: sending email_address (%s) unknown)" % (email_addr) )
-                continue
-        else:     #do not check for address in list. Instead, check domain
-            log_global.debug("(3b) Allow all users from right domain")
-            if True: #set to False to allow emails from any domain (initially for St Poelten Summer School July 2011)
-                if not sending_domain_okay( domain ):
-                    log_global.warn("rejecting email from %s (wrong domain)" % (email_addr))
-                    error_msg = replymail_error(msg, conf.TXT_Domain,CC_to_admin=True)
-                    append_mail_to_mailbox( error_msg, '_errors', log_global, "(outgoing error mail: wrong domain (%s))" % (email_addr) )
-                    continue
-
-        #now we know the student
-        log_global.debug("(2) domain okay, student is %s (%s)" % (repr(email_login),repr(real_name)))
-
-        #check that the directory exists:
-        student_dirpart = email_login
-        student_dir = os.path.join( conf.Submissiondir, student_dirpart)
-        if not os.path.exists( student_dir ):
-            log_global.debug("Creating directory %s" % (repr(student_dir)))
-            os.mkdir(student_dir)
+    #connect to log file for user
+    logger = mylogger.attach_to_logfile( os.path.join( conf.Submissiondir, email_login,'log.txt' ), level = log_level )
+    logger.info(20*"-"+"studentdata:"+repr(email_login)+":"+repr(real_name))
+    csvio.get_roster().record_realname(email_login, real_name)
+
+    #keep copy of mail in Maildir
+    append_mail_to_mailbox( mail, email_login, logger, "(incoming mail from {})".format(email_login), assignment )
+
+    if decision == mailclassifier.BAD_SUBJECT:
+        log_global.warn("rejecting email from %s (unknown submission: %s)" % (repr(email_addr),repr(subject)))
+        logger.warn("rejecting email (unknown submission: %s)" % (repr(subject)))
+
+        errormail = replymail_error(msg, conf.TXT_Submission)
+        append_mail_to_mailbox( errormail, email_login, logger, "(outgoing error mail: couldn't parse assignment)" )
+
+        return #no need to carry on further
+
+    if decision == mailclassifier.RETRIEVAL:
+        logger.info("Identified retrieval attempt (%s)" % (repr(subject)) )
+        retrieve_assignment(assignment,msg,student_dir,real_name,email_addr,logger)
+        return  # no need to carry on further
+
+    #normal submission continues here
+    msg = email.message_from_string( mail )
+    if msg.is_multipart():
+        n_attach = len( msg.get_payload() )
+    logger.info("found submission for %s (%s)" % (assignment,repr(subject)))
+    log_global.info("found submission for %s from %s, ATT: %d" % (assignment,repr(email_login),n_attach))
+
+    #check that the directory exists:
+    student_lab_dir = os.path.join( conf.Submissiondir, student_dirpart, assignment )
+    if not os.path.exists( student_lab_dir ):
+        log_global.debug("Creating directory %s" % repr(student_lab_dir))
+        os.mkdir( student_lab_dir )
+
+     #check that files make sense
+    attachments = save_attachments( msg, student_lab_dir )
+
+    #generate report to be mailed to the student, and set
+    #valid_attachments to True if all the required files were
+    #attached to *this message*
+    (valid_attachments, reply) = submission_reply_report(student_dir, attachments, assignment)
+
+    #If we have the required attachments, check whether submission
+    #tests are associated with this assignment, and push a job to
+    #the test queue
+
+    log_global.debug("Have-found-valid_attachments = {}".format(valid_attachments))
+
+    we_have_a_testfile_for_this_submission = assignment in conf.subtest_tests.keys()
+
+    log_global.debug("Have-we-got-a-test-file-for-this-submission = {}"\
+        .format(we_have_a_testfile_for_this_submission))
+
+    if we_have_a_testfile_for_this_submission and valid_attachments:
+        log_global.debug("Found assignment {} in subtest.keys.".format(assignment))
+        subtest_metadata = {'student_lab_dir':student_lab_dir,
+                            'assignment':assignment,
+                            'real_name':real_name,
+                            'email':email_addr,
+                            'login':email_login,
+                            'subject':subject,
+                            'time':time.asctime()}
+        limiter = get_rate_limiter()
+        if limiter is None or limiter.admit(email_login, assignment):
+            q_id = subtestqueue_push(subtest_metadata) #read Queue-id
+            # Compose and send an email to the student, based on the
+            # report generated above.
+            confirm_mail = replymail_confirm_submission(real_name, email_addr, reply, subject, assignment, valid_attachments, q_id,
+                                                        superseded=subtest_metadata['superseded'])
+            append_mail_to_mailbox(confirm_mail, email_login, logger, "(outgoing confirmation mail; job submitted for testing)", assignment)
         else:
-            log_global.debug("   Student directory exists (%s)" % (repr(student_dir)))
+            # too many submissions: test the latest one later
+            limiter.defer(email_login, assignment, subtest_metadata)
+            deferred_until = limiter.next_admission(email_login, assignment)
+            log_global.info("Rate limit reached for %s/%s, deferring test until %s" % (repr(email_login),assignment,time.ctime(deferred_until)))
+            confirm_mail = replymail_confirm_submission(real_name, email_addr, reply, subject, assignment, valid_attachments, deferred_until=deferred_until)
+            append_mail_to_mailbox(confirm_mail, email_login, logger, "(outgoing confirmation mail; testing deferred)", assignment)
+
+    elif valid_attachments == True and we_have_a_testfile_for_this_submission == False:
+        log_global.info("Did not find assignment {} in subtest.keys={}".format(assignment, conf.subtest_tests.keys()))
+        q_id = None
+        confirm_mail = replymail_confirm_submission(real_name, email_addr, reply, subject, assignment, valid_attachments, q_id)
+        append_mail_to_mailbox(confirm_mail, email_login, logger, "(outgoing confirmation email - no testing to follow)", assignment)
+    elif valid_attachments == False:
+        # the function 'submission_reply_report' above sends an error message in this case so we don't need to do anything here.
+        error_mail = replymail_error(msg, reply)
+        append_mail_to_mailbox(error_mail, email_login, logger, "(outgoing error mail - attachmenns not valid)", assignment)
+    else:
+        raise RuntimeError("This should be impossible")
 
-        #connect to log file for user
-        logger = mylogger.attach_to_logfile( os.path.join( conf.Submissiondir, email_login,'log.txt' ), level = log_level )
-        logger.info(20*"-"+"studentdata:"+repr(email_login)+":"+repr(real_name))
 
-        #keep copy of mail in Maildir
-        append_mail_to_mailbox( mail, email_login, logger, "(incoming mail from {})".format(email_login) )
+def process_inbox():
+    log_global.debug("process_inbox: lockdire=%s" % conf.Lockdir)
 
-        retrieval = False
-        #check whether this is a retrieval attempt
-        if is_retrieval(subject):
-            logger.info("Identified retrieval attempt (%s)" % (repr(subject)) )
-            retrieval = True
+    semaphore=lock_semaphore(conf.Lockdir)
+
+    if(not semaphore):
+        os.system('echo "\n---------------\n`date`"')
+        print "It seems that another version of this script is running already... Leaving cowardly."
+        print "Remove LOCKFILE in %s to overrride this" % repr(conf.Lockdir)
+        log_global.warn("Found LOCK, exiting now!")
+        return None
 
-            #chop off 'retrieve' from subject line
-            remaining_subject=re.match(r"\s*retrieve\s+(.*)",subject,re.IGNORECASE).group(1)
+    #test whether mailbox file exists
+    if not os.path.exists(conf.inbox):
+        raise StandardError, "Inbox file %s does not exist" % repr(conf.inbox)
 
-            assignment = subject_identification( conf.assignments, remaining_subject, log_global)
-            log_global.warn("RETR: S=%s rems=%s a=%s" % (subject,remaining_subject,assignment))
+    # Batches left over by a run that did not finish come first, then
+    # whatever is in the inbox now.
+    batchdir = getattr(conf, 'inbox_batchdir', os.path.join(conf.Maildir,'_batches'))
+    batches = pending_batches(batchdir)
+    if len(batches) > 0:
+        log_global.warn("Found %d unfinished batch(es) from previous run(s): %s" % (len(batches),batches))
 
-        else:
-            #check lab makes sense
-            assignment = subject_identification( conf.assignments, subject, log_global)
+    release_deferred_tests()
 
-        if assignment == None:
-            log_global.warn("rejecting email from %s (unknown submission: %s)" % (repr(email_addr),repr(subject)))
-            logger.warn("rejecting email (unknown submission: %s)" % (repr(subject)))
+    print("Trying to read from inbox {}".format(conf.inbox))
+    batch = handoff_inbox(batchdir)
+    if batch:
+        batches.append(batch)
+
+    # now check whether there is anything to do. If not, there is
+    # no point carrying on
+    if len(batches) == 0:
+        log_global.info("Inbox is empty. Quitting." )
+        unlock_semaphore(semaphore)
+        return None
 
-            errormail = replymail_error(msg, conf.TXT_Submission)
-            append_mail_to_mailbox( errormail, email_login, logger, "(outgoing error mail: couldn't parse assignment)" )
+    global _quarantined
+    _quarantined = 0
 
-            continue #no need to carry on further
-        else:
-            if retrieval:
-                retrieve_assignment(assignment,msg,student_dir,real_name,email_addr,logger)
-                continue  # no need to carry on further
-
-        #normal submission continues here
-        logger.info("found submission for %s (%s)" % (assignment,repr(subject)))
-        log_global.info("found submission for %s from %s" % (assignment,repr(email_login)))
-
-        #check that the directory exists:
-        student_lab_dir = os.path.join( conf.Submissiondir, student_dirpart, assignment )
-        if not os.path.exists( student_lab_dir ):
-            log_global.debug("Creating directory %s" % repr(student_lab_dir))
-            os.mkdir( student_lab_dir )
-
-         #check that files make sense
-        attachments = save_attachments( msg, student_lab_dir )
-
-        #generate report to be mailed to the student, and set
-        #valid_attachments to True if all the required files were
-        #attached to *this message*
-        (valid_attachments, reply) = submission_reply_report(student_dir, attachments, assignment)
-
-        #If we have the required attachments, check whether submission
-        #tests are associated with this assignment, and push a job to
-        #the test queue
-
-        log_global.debug("Have-found-valid_attachments = {}".format(valid_attachments))
-
-        we_have_a_testfile_for_this_submission = assignment in conf.subtest_tests.keys()
-
-        log_global.debug("Have-we-got-a-test-file-for-this-submission = {}"\
-            .format(we_have_a_testfile_for_this_submission))
-
-        if we_have_a_testfile_for_this_submission and valid_attachments:
-            log_global.debug("Found assignment {} in subtest.keys.".format(assignment))
-            subtest_metadata = {'student_lab_dir':student_lab_dir,
-                                'assignment':assignment,
-                                'real_name':real_name,
-                                'email':email_addr,
-                                'login':email_login,
-                                'subject':subject,
-                                'time':time.asctime()}
-            q_id = subtestqueue_push(subtest_metadata) #read Queue-id
-            # Compose and send an email to the student, based on the
-            # report generated above.
-            confirm_mail = replymail_confirm_submission(real_name, email_addr, reply, subject, assignment, valid_attachments, q_id)
-            append_mail_to_mailbox(confirm_mail, email_login, logger, "(outgoing confirmation mail; job submitted for testing)")
-
-        elif valid_attachments == True and we_have_a_testfile_for_this_submission == False:
-            log_global.info("Did not find assignment {} in subtest.keys={}".format(assignment, conf.subtest_tests.keys()))
-            q_id = None
-            confirm_mail = replymail_confirm_submission(real_name, email_addr, reply, subject, assignment, valid_attachments, q_id)
-            append_mail_to_mailbox(confirm_mail, email_login, logger, "(outgoing confirmation email - no testing to follow)")
-        elif valid_attachments == False:
-            # the function 'submission_reply_report' above sends an error message in this case so we don't need to do anything here.
-            error_mail = replymail_error(msg, reply)
-            append_mail_to_mailbox(error_mail, email_login, logger, "(outgoing error mail - attachmenns not valid)")
-        else:
-            raise RuntimeError("This should be impossible")
+    counter = 0
+    for batch in batches:
+        counter = process_batch(batch, counter)
+
+    if _quarantined > 0:
+        quarantinedir = getattr(conf, 'Quarantinedir', os.path.join(conf.Maildir,'_quarantine'))
+        subject = "[%s-admin] %d email(s) quarantined" % (conf.ModulecodeSubjectLine,_quarantined)
+        text = "%d email(s) could not be processed in this run and have been moved\n" \
+               "to %s (with their tracebacks).\n" % (_quarantined,quarantinedir)
+        enqueue_outgoing_mails.send_text_message( conf.SysadminEmail, conf.ModuleEmailAddress, text, subject)
 
-    log_global.info("Finish.proc. %d emails. Rm %s and quit" % (len(mails),tempname)
+    log_global.info("Finish.proc. %d emails from %d batch(es) and quit" % (counter,len(batches)))
     unlock_semaphore(semaphore)
 
 
@@ -957,6 +1384,122 @@ def startup():
     return log_global
 
 
+def write_pulse():
+    f=open(conf.pulsefile,'w')
+    data = {'now-secs':time.time(),'now-ascii':time.ctime(),'module':conf.ModulecodeSubjectLine,
+            'what':"process-emails"}
+    f.write("%s" % repr(data))
+    f.close()
+
+
+def report_malfunction():
+    log_global.exception("Something went wrong (caught globally)")
+
+    log_global.critical("Preparing email to sysadmin (%s)" % repr(conf.SysadminEmail))
+    ins,outs = os.popen4('tail -n 100 '+conf.Logfile)
+    text = outs.read()
+    subject = "URGENT: Malfunction in %s at %s !!!" % (conf.ModulecodeSubjectLine,time.asctime())
+    enqueue_outgoing_mails.send_text_message( conf.SysadminEmail, conf.ModuleEmailAddress,text, subject)
+    log_global.info("Leaving now (not removing lockfile).")
+
+
+def inbox_has_mail():
+    try:
+        return os.path.getsize(conf.inbox) > 0
+    except OSError as e:
+        if e.errno == errno.ENOENT: # e.g. between rename and re-creation
+            return False
+        raise
+
+
+def make_inbox_waiter(min_interval, max_interval):
+    """Returns a function wait(had_mail) that blocks until the inbox may
+    have changed, but at most max_interval seconds.
+
+    If pyinotify is available, we watch the directory containing the
+    inbox (the inbox itself is replaced when it is handed off by
+    renaming). Otherwise we poll: the interval starts at min_interval
+    after mail has been found, and doubles up to max_interval while
+    the inbox stays empty."""
+
+    try:
+        import pyinotify
+    except ImportError:
+        pyinotify = None
+
+    if pyinotify:
+        wm = pyinotify.WatchManager()
+        wm.add_watch(os.path.dirname(conf.inbox),
+                     pyinotify.IN_MODIFY | pyinotify.IN_CLOSE_WRITE |
+                     pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO)
+        notifier = pyinotify.Notifier(wm, default_proc_fun=lambda event: None,
+                                      timeout=int(max_interval*1000))
+        log_global.info("Watching %s with inotify" % repr(os.path.dirname(conf.inbox)))
+
+        def wait(had_mail):
+            if notifier.check_events():
+                notifier.read_events()
+                notifier.process_events()
+        return wait
+
+    log_global.info("pyinotify not available, polling %s every %g to %g seconds" % (
+        repr(conf.inbox),min_interval,max_interval))
+    interval = [min_interval]
+
+    def wait(had_mail):
+        if had_mail:
+            interval[0] = min_interval
+        time.sleep(interval[0])
+        interval[0] = min(2*interval[0], max_interval)
+    return wait
+
+
+def run_daemon():
+    """Stays resident and processes the inbox whenever mail arrives,
+    rather than being started by cron. Updates the pulse file every
+    conf.daemon_pulse_interval seconds as a heartbeat. Returns on
+    SIGTERM or SIGINT (after finishing the current batch); exceptions
+    from process_inbox() are passed on, as in non-daemon mode.
+
+    Note that the configuration is only read at start-up: restart the
+    daemon after changing it."""
+
+    import signal
+
+    stop = []
+    def handle_signal(signum, frame):
+        log_global.info("Received signal %d, will stop" % signum)
+        stop.append(signum)
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    pidfile = getattr(conf, 'daemon_pidfile', os.path.join(conf.Homedir,'log','process-emails.pid'))
+    open(pidfile,'w').write("%d\n" % os.getpid())
+    log_global.info("Starting daemon (pid %d)" % os.getpid())
+
+    wait = make_inbox_waiter(conf.sleeptime, getattr(conf, 'daemon_max_poll', 1.0))
+    pulse_interval = getattr(conf, 'daemon_pulse_interval', 60)
+    last_pulse = 0
+    had_mail = True # pick up batches left over from previous runs
+
+    try:
+        while not stop:
+            if had_mail:
+                process_inbox()
+            if time.time() - last_pulse >= pulse_interval:
+                if not had_mail:
+                    release_deferred_tests()
+                write_pulse()
+                last_pulse = time.time()
+            if not stop:
+                wait(had_mail)
+            had_mail = inbox_has_mail()
+    finally:
+        os.remove(pidfile)
+
+    log_global.info("Daemon stopped")
+
+
 if __name__ == "__main__":
     #set everything up
     log_global = startup()
@@ -965,27 +1508,19 @@ if __name__ == "__main__":
 
     live = True
 
+    if '--daemon' in sys.argv[1:]:
+        run = run_daemon
+    else:
+        run = process_inbox
+
     if live:
         try:
-            process_inbox()
+            run()
         except:
-            log_global.exception("Something went wrong (caught globally)")
-
-            log_global.critical("Preparing email to sysadmin (%s)" % repr(conf.SysadminEmail))
-            ins,outs = os.popen4('tail -n 100 '+conf.Logfile)
-            text = outs.read()
-            subject = "URGENT: Malfunction in %s at %s !!!" % (conf.ModulecodeSubjectLine,time.asctime())
-            enqueue_outgoing_mails.send_text_message( conf.SysadminEmail, conf.ModuleEmailAddress,text, subject)
-            log_global.info("Leaving now (not removing lockfile).")
+            report_malfunction()
 
     else:
-        process_inbox()
+        run()
 
-    import datetime,time
-    f=open(conf.pulsefile,'w')
-    data = {'now-secs':time.time(),'now-ascii':time.ctime(),'module':conf.ModulecodeSubjectLine,
-            'what':"process-emails"}
-    f.write("%s" % repr(data))
-    f.close()
+    write_pulse()
     log_global.debug("About to leave, updated pulse.")
-
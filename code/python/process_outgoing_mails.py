@@ -30,7 +30,7 @@
 
 
 import cPickle, datetime, email, errno, fcntl, logging, os, os.path, shutil
-import smtplib, time
+import smtplib, sys, time
 
 # Reads outgoing mail queue, tries to send each item therein.
 # Dequeues those which were sent successfully, and leaves those which
@@ -42,6 +42,7 @@ live = True
 
 import mylogger
 import enqueue_outgoing_mails
+import wakeup
 
 # Find module code and read correct config file.
 try:
@@ -407,6 +408,28 @@ def send_mail( msg, debug = 0 ):
     raise Exception,"send_mail(): something should have returned, execution should not reach here."
 
 
+def write_pulse():
+    f=open(conf.outgoingmail_pulsefile,'w')
+    data = {'now-secs':time.time(),'now-ascii':time.ctime(),'module':conf.ModulecodeSubjectLine,
+            'what':"process-outgoingmail"}
+    f.write("%s" % repr(data))
+    f.close()
+
+
+def run_daemon():
+    """Stays resident and sends mails as soon as they are queued (we
+    are woken up by enqueue_outgoing_mails, see wakeup.py), rather than
+    being started by cron. Mails that could not be sent are retried
+    every conf.outgoingmail_daemon_poll seconds. Returns on SIGTERM or
+    SIGINT after the current pass over the queue."""
+
+    wakeup.run_daemon("outgoing mail", process_queue, write_pulse,
+                      enqueue_outgoing_mails.wakeup_socket(),
+                      getattr(conf, 'outgoingmail_daemon_pidfile',
+                              os.path.join(conf.Homedir,'log','process-outgoingmail.pid')),
+                      getattr(conf, 'outgoingmail_daemon_poll', 60), log_global)
+
+
 if __name__ == "__main__":
 
     global log_global
@@ -420,9 +443,14 @@ if __name__ == "__main__":
 
         log_global.debug("About to read queue")
 
+        if '--daemon' in sys.argv[1:]:
+            run = run_daemon
+        else:
+            run = process_queue
+
         if live:
             try:
-                process_queue()
+                run()
                 unlock_semaphore(lock)
             except:
                 log_global.exception("Something went wrong (caught globally)")
@@ -435,13 +463,8 @@ if __name__ == "__main__":
                 log_global.info("Leaving now (not removing lockfile).")
                 raise
         else:
-            process_queue()
+            run()
             unlock_semaphore(lock)
 
-    import time
-    f=open(conf.outgoingmail_pulsefile,'w')
-    data = {'now-secs':time.time(),'now-ascii':time.ctime(),'module':conf.ModulecodeSubjectLine,
-            'what':"process-outgoingmail"}
-    f.write("%s" % repr(data))
-    f.close()
+    write_pulse()
     log_global.debug("About to leave, updated pulse.")
@@ -28,18 +28,22 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-import os, logging, re, time, errno
+import os, sys, logging, re, time, errno, pprint, fcntl, multiprocessing, signal
+import datetime, shutil, tempfile, threading, traceback
 
 from lab_helpers import lock_semaphore, unlock_semaphore
-from lab_helpers import PyTestException
+from lab_helpers import PyTestException, RunConstrainedException
 
 live = True
 
+import jobqueue
 import mylogger
 import subtest
 import process_emails
 import enqueue_outgoing_mails
 import post_test_analysis
+import subtestremote
+import wakeup
 
 try:
     import pwd
@@ -50,8 +54,13 @@ Modulecode = pwd.getpwuid(os.getuid()).pw_name.upper()
 
 conf = __import__('config_' + Modulecode.lower())
 
+# Failures of the testing machinery rather than of the submission
+# (py.test itself or the sandbox broke): testing the job again later
+# may well succeed.
+infrastructure_failures = (PyTestException, RunConstrainedException)
 
-def startup(log_level=logging.INFO):
+
+def startup(log_level=logging.INFO, check_tests=True):
     log_global = mylogger.attach_to_logfile( conf.subtest_logfile, level = log_level )
     process_emails.log_global=log_global #let functions in that module use the same logger
     enqueue_outgoing_mails.log_global=log_global
@@ -79,14 +88,15 @@ def startup(log_level=logging.INFO):
     log_global.debug("============= Starting ===========")
 
     log_global.debug("Checking testing scripts are all in place:")
-    #Check that testing codes are available
-    for labname in conf.subtest_tests.keys():
-        testfilename = conf.subtest_tests[labname]
-        testfilepath = os.path.join(conf.subtest_testcodedir,labname,testfilename)
-        log_global.debug("Checking labname={}, looking for {} at {}".format(
-            labname, testfilename, testfilepath))
-        assert os.path.exists(testfilepath), "Test file '%s' for submission '%s' is missing" \
-               % (testfilepath,labname)
+    #Check that testing codes are available (workers for a coordinator
+    #get them from the coordinator)
+    for labname in (conf.subtest_tests.keys() if check_tests else []):
+        for testfilename in test_files(labname):
+            testfilepath = os.path.join(conf.subtest_testcodedir,labname,testfilename)
+            log_global.debug("Checking labname={}, looking for {} at {}".format(
+                labname, testfilename, testfilepath))
+            assert os.path.exists(testfilepath), "Test file '%s' for submission '%s' is missing" \
+                   % (testfilepath,labname)
 
     # make sure PYTHONPATH is set to new modules and packages, such as 
     # ctestlib
@@ -113,28 +123,76 @@ def startup(log_level=logging.INFO):
     return log_global
 
 
-def read_queue():
-    def open_and_evaluate(filename):
-        return eval(open(filename,'r').read())
+def make_queue_directory(name, what):
+    """Returns the path of subdirectory name of the queue directory,
+    making it if needed (testing workers may race to do so)."""
+
+    path=os.path.join(conf.subtest_queue,name)
+    if not os.path.exists(path):
+        log_global.info("Directory for %s jobs does not exist (%s), will create it now." % (what,path))
+        try:
+            os.mkdir(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    return path
+
+
+def running_directory():
+    return make_queue_directory('running', 'running')
+
 
-    entryfiles = filter(lambda x: x[0:1] == "s", os.listdir(conf.subtest_queue))
+def job_record(job):
+    """Adds the name and path of the job's record in running/ to job
+    (as 'qfilename' and 'qfilepath') and returns it."""
 
-    entryfilepaths = map(lambda x : os.path.join(conf.subtest_queue,x), entryfiles)
+    job['qfilename'] = "s%05d-%s-%s" % (job['id'],job['assignment'],job['login'])
+    job['qfilepath'] = os.path.join(running_directory(),job['qfilename'])
+    return job
+
+
+def worker_name():
+    """Returns the name under which this process claims jobs."""
+    return "%s:%d" % (os.uname()[1], os.getpid())
+
+
+def subtestqueue_claim(worker=None):
+    """Claims the next job from the testing queue for worker (by
+    default this process) and returns it (or None if the queue is
+    empty).
+
+    The job's metadata is also written to running/<qfilename> (and
+    copied into the test run directory), for debugging."""
+
+    if worker is None:
+        worker = worker_name()
+    job = process_emails.get_job_queue().claim(worker, getattr(conf, 'subtest_lease', 3600),
+                                               getattr(conf, 'subtest_schedule', 'fifo'))
+    if job is None:
+        return None
+
+    job_record(job)
+    f = open(job['qfilepath'],'w')
+    f.write(pprint.pformat(job))
+    f.close()
+    return job
 
-    entries = map(open_and_evaluate,entryfilepaths)
 
-    return entries
+def subtestqueue_pop(job, worker=None):
+    """Removes job, tested by worker (by default this process), from
+    the testing queue. Returns False (leaving the job alone) if worker
+    no longer holds the claim on it."""
 
+    if worker is None:
+        worker = worker_name()
+    if not process_emails.get_job_queue().complete(job['id'], worker=worker):
+        log_global.warn("Not removing %s from queue: %s does not hold its claim" % (job['qfilename'],worker))
+        return False
 
-def subtestqueue_pop(filename):
-    filepath = os.path.join(conf.subtest_queue,filename)
-    processed_directory=os.path.join(conf.subtest_queue,'processed')
-    if not os.path.exists(processed_directory):
-        log_global.info("Directory for processed jobs does not exist (%s), will create it now." % processed_directory)
-        os.mkdir(processed_directory)
-    filepath = os.path.join(conf.subtest_queue,filename)
-    os.rename(filepath,os.path.join(processed_directory,filename))
-    log_global.info("Remove '%s' from queue" % filename)
+    processed_directory=make_queue_directory('processed', 'processed')
+    os.rename(job['qfilepath'],os.path.join(processed_directory,job['qfilename']))
+    log_global.info("Remove '%s' from queue" % job['qfilename'])
+    return True
 
 
 def find_memory_error(dir):
@@ -162,11 +220,97 @@ def find_memory_error(dir):
     return memory_error
 
 
+def append_test_result(student_lab_dir, line):
+    """Appends line to _test_results.txt in student_lab_dir (under a
+    lock, as several jobs may be tested at the same time)."""
+
+    f = open(os.path.join(student_lab_dir,"_test_results.txt"),'a')
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        f.write(line)
+        f.flush()
+    finally:
+        f.close()
+
+
+def renew_lease(filename, q_id, worker, stop):
+    """Renews the lease of worker on job q_id in the testing queue
+    (the database filename) every third of conf.subtest_lease seconds,
+    until the threading.Event stop is set or the claim is lost. Runs
+    in a thread of its own, with a connection of its own."""
+
+    lease = getattr(conf, 'subtest_lease', 3600)
+    queue = jobqueue.JobQueue(filename)
+    while not stop.wait(lease / 3.0):
+        if not queue.renew(q_id, lease, worker):
+            log_global.warn("Lost the claim on job %d" % q_id)
+            break
+
+
 def process_one_subtest(job):
+    """Tests and reports job, which this process has claimed, keeping
+    the claim for as long as testing takes."""
+
+    worker = worker_name()
+    stop = threading.Event()
+    renewer = threading.Thread(target=renew_lease,
+                               args=(process_emails.get_job_queue().filename, job['id'], worker, stop))
+    renewer.daemon = True
+    renewer.start()
+    try:
+        test_run_dir = run_one_subtest(job)
+    finally:
+        stop.set()
+        renewer.join()
+    report_subtest(job, test_run_dir, worker)
+
+
+def test_files(assignment):
+    """Returns the names of the test files of assignment (in
+    conf.subtest_tests, an assignment has one, or a list of them)."""
+
+    testfiles = conf.subtest_tests[assignment]
+    if isinstance(testfiles, basestring):
+        return [testfiles]
+    return list(testfiles)
+
+
+def test_shards(assignment):
+    """Returns the number of sandboxes among which the tests of
+    assignment are shared (see conf.subtest_shards)."""
+
+    return getattr(conf, 'subtest_shards', {}).get(assignment, 1)
+
+
+def test_environment(assignment, testcodepaths):
+    """Returns the precompiled environment of assignment for the
+    sandbox (see subtest.assignment_environment), or None if
+    conf.subtest_envcache is not set."""
+
+    if not getattr(conf, 'subtest_envcache', None):
+        return None
+    return subtest.assignment_environment(assignment, testcodepaths, log_global)
+
+
+def run_constrained(testcodepaths, nshards, **kwargs):
+    """Runs the tests in testcodepaths in the sandbox, split among
+    nshards sandboxes running at the same time if nshards > 1, and
+    returns the directory with the results. The keyword arguments are
+    those of subtest.run_pytest_constrained."""
+
+    if nshards > 1:
+        return subtest.run_pytest_sharded(None, testcodepaths, log_global, nshards, **kwargs)
+    return subtest.run_pytest_constrained(None, testcodepaths[0], log_global,
+                                          other_testfilepaths=testcodepaths[1:], **kwargs)
+
+
+def run_one_subtest(job):
+    """Tests the submission of job in the sandbox, and returns the
+    directory with the results (in the student's lab directory)."""
+
     student_lab_dir = job['student_lab_dir']
-    testcodefile = conf.subtest_tests[job['assignment']]
-    testcodepath = os.path.join(conf.subtest_testcodedir,
-                                job['assignment'], testcodefile)
+    testcodepaths = [os.path.join(conf.subtest_testcodedir, job['assignment'], testcodefile)
+                     for testcodefile in test_files(job['assignment'])]
 
     all_submitted_files = conf.assignments[job['assignment']].keys()
     all_submitted_filepaths=[ os.path.join(student_lab_dir, fn) \
@@ -176,42 +320,60 @@ def process_one_subtest(job):
 
     log_global.info("Run py.test in %s " % student_lab_dir)
 
+    environment = test_environment(job['assignment'], testcodepaths)
+
     try:
         if False:
             log_global.debug("Will run run_pytest (not constrained)")
             log_global.warn("Will run run_pytest (not constrained) -- not secure")  # student code could 
                                                                                     # damage files etc
-            test_run_dir=subtest.run_pytest(submitted_filepath,testcodepath,
+            test_run_dir=subtest.run_pytest(submitted_filepath,testcodepaths[0],
                                             rundirectorypath=student_lab_dir,
                                             jobfilepath=job['qfilepath'],
                                             maxseconds=conf.subtest_maxseconds,
                                             log_global=log_global)
         else:
             log_global.debug("Will run run_pytest_constrained")
-            test_run_dir=subtest.run_pytest_constrained(submitted_filepath,testcodepath,
-                                                        rundirectorypath=student_lab_dir,
-                                                        other_submitted_filepaths=all_submitted_filepaths,
-                                                        jobfilepath=job['qfilepath'],
-                                                        maxseconds=conf.subtest_maxseconds,
-                                                        log_global=log_global,
-                                                        pytest_args=conf.pytest_additional_arguments)
+            test_run_dir=run_constrained(testcodepaths, test_shards(job['assignment']),
+                                         rundirectorypath=student_lab_dir,
+                                         other_submitted_filepaths=all_submitted_filepaths,
+                                         jobfilepath=job['qfilepath'],
+                                         maxseconds=conf.subtest_maxseconds,
+                                         pytest_args=conf.pytest_additional_arguments,
+                                         environment=environment)
 
     except PyTestException,msg:
         log_global.exception("pytest failed: %s" % msg)
-        log_global.error("possible cause: error in test_*.py code?")
-        ins,outs = os.popen4('tail -n 100 '+conf.subtest_logfile)
-        text = outs.read()+'\n'+'Error message is:\n'+str(msg)
-        subject = "Urgent: Malfunction in %s at %s (pytest reports problem)" % (conf.ModulecodeSubjectLine,time.asctime())
-        enqueue_outgoing_mails.send_text_message( conf.SysadminEmail, conf.ModuleEmailAddress,text, subject)
-        log_global.info("Emailed sysadmin (%s)" % conf.SysadminEmail)
         raise PyTestException,msg
 
+    return test_run_dir
+
+
+def report_subtest(job, test_run_dir, worker=None):
+    """Reports the results of testing job (in test_run_dir) to the
+    student, records them and removes the job from the queue, unless
+    worker (by default this process) no longer holds the claim on the
+    job: then it is tested (and reported) by another worker."""
+
+    if worker is None:
+        worker = worker_name()
+    if process_emails.get_job_queue().claimant(job['id']) != worker:
+        log_global.warn("Not reporting %s: %s does not hold its claim" % (job['qfilename'],worker))
+        return
+
+    process_emails.get_job_queue().timestamp(job['id'], 'tested')
+
+    student_lab_dir = job['student_lab_dir']
+    testcodefile = ",".join(test_files(job['assignment']))
+    all_submitted_files = conf.assignments[job['assignment']].keys()
 
     #always pointing to last submission
     shortcutname = os.path.join(student_lab_dir,'_test')
-    if os.path.exists(shortcutname):
-        os.remove(shortcutname)
-    os.symlink(test_run_dir,shortcutname)
+    tmpname = "%s.%d" % (shortcutname, os.getpid())
+    if os.path.lexists(tmpname):
+        os.remove(tmpname)
+    os.symlink(test_run_dir,tmpname)
+    os.rename(tmpname,shortcutname)
 
     #post-process and create email
     report,status=conf.parse_pytest_report(test_run_dir, log_global)
@@ -300,9 +462,7 @@ Student {2:s} ({3:s}) was sent the following email.
 
         #collect "pass/fail/total; datetime; id" data for assignment
 
-        f=open(os.path.join(student_lab_dir,"_test_results.txt"),'a')
-        f.write(str(conf.pass_fail_total(report))+';'+job['time']+';'+str(job['id'])+"\n")
-        f.close()
+        append_test_result(student_lab_dir, str(conf.pass_fail_total(report))+';'+job['time']+';'+str(job['id'])+"\n")
 
         log_global.debug("Writing to _test_resuls.txt in %s:" % student_lab_dir)
         log_global.debug("\n"+str(conf.pass_fail_total(report))+';'+job['time']+';'+str(job['id'])+"\n")
@@ -331,38 +491,450 @@ Student {2:s} ({3:s}) was sent the following email.
         # 
         #collect "pass/fail/total; datetime; id" data for assignment
         #
-        f = open(os.path.join(student_lab_dir,"_test_results.txt"),'a')
-
-
-        f.write(str(passtotalfail)+';'+job['time']+';'+str(job['id'])+"\n")
-        f.close()
+        append_test_result(student_lab_dir, str(passtotalfail)+';'+job['time']+';'+str(job['id'])+"\n")
 
         log_global.debug("Writing to _test_resuls.txt in %s:" % student_lab_dir)
         log_global.debug("\n"+str(conf.pass_fail_total(report))+';'+job['time']+';'+str(job['id'])+"\n")
 
+    # the student has been sent the result above
+    process_emails.get_job_queue().timestamp(job['id'], 'mailed')
 
+    subtestqueue_pop(job, worker)
 
-    subtestqueue_pop(job['qfilename'])
 
+def dead_letter(job, error):
+    """Moves the record of job, which could not be tested, from
+    running/ to conf.subtest_manual, with the error in <qfilename>.error
+    next to it, for the administrator to look into."""
 
-def process_queue():
+    manual_path = os.path.join(conf.subtest_manual,job['qfilename'])
+    f = open(manual_path + '.error','w')
+    f.write(error)
+    f.close()
+    if os.path.exists(job['qfilepath']):
+        os.rename(job['qfilepath'],manual_path)
+    log_global.error("Moved %s to %s" % (job['qfilename'],conf.subtest_manual))
+
+
+def subtest_failed(job, error, infrastructure, worker=None):
+    """Handles job, whose testing by worker (by default this process)
+    failed with error (a traceback). A failure of the testing
+    infrastructure (see infrastructure_failures) is retried up to
+    conf.subtest_retries times (so the job is tested at most
+    conf.subtest_retries + 1 times), after conf.subtest_retry_backoff
+    seconds, doubling each time; other failures are not retried. A job
+    that is not retried is failed and moved to the dead-letter
+    directory (see dead_letter()). The administrator is told of the
+    first failure and of jobs given up. The failure is ignored if
+    worker no longer holds the claim on the job (its lease expired,
+    and the job was handed to another worker)."""
+
+    if worker is None:
+        worker = worker_name()
+    if infrastructure:
+        retries = getattr(conf, 'subtest_retries', 3)
+    else:
+        retries = 0
+    retried = process_emails.get_job_queue().retry(job['id'], error, retries,
+                                                    getattr(conf, 'subtest_retry_backoff', 60), worker)
+    if retried is None:
+        log_global.warn("Ignoring failure of job %d from %s, which does not hold its claim:\n%s" % (job['id'],worker,error))
+        return
+    attempts, delay = retried
+    if delay is not None:
+        log_global.error("Testing %s failed (attempt %d of %d), will retry in %ds:\n%s" % (job['qfilename'],attempts,retries+1,delay,error))
+        if attempts > 1:
+            return
+        subject = "Malfunction in %s at %s (job %d will be retried)" % (conf.ModulecodeSubjectLine,time.asctime(),job['id'])
+    else:
+        log_global.error("Testing %s failed (attempt %d of %d), giving up:\n%s" % (job['qfilename'],attempts,retries+1,error))
+        dead_letter(job, error)
+        subject = "Urgent: Malfunction in %s at %s (job %d moved to %s)" % (conf.ModulecodeSubjectLine,time.asctime(),
+                                                                            job['id'],conf.subtest_manual)
+
+    if 'PyTestException' in error:
+        log_global.error("possible cause: error in test_*.py code?")
+    ins,outs = os.popen4('tail -n 100 '+conf.subtest_logfile)
+    text = outs.read()+'\n'+'Error testing job %d (%s, attempt %d):\n%s' % (job['id'],job['qfilename'],attempts,error)
+    enqueue_outgoing_mails.send_text_message( conf.SysadminEmail, conf.ModuleEmailAddress,text, subject)
+    log_global.info("Emailed sysadmin (%s)" % conf.SysadminEmail)
+
+
+def subtest_worker(stop=None):
+    """Claims and tests jobs until the queue is empty (or the
+    multiprocessing.Event stop is set). Jobs arriving while we are
+    testing are processed as well. A job that fails does not stop
+    the worker, see subtest_failed()."""
+
+    while stop is None or not stop.is_set():
+        job = subtestqueue_claim()
+        if job is None:
+            break
+        log_global.info("Processing %s" % (job['qfilename']))
+        try:
+            process_one_subtest(job)
+        except infrastructure_failures:
+            subtest_failed(job, traceback.format_exc(), True)
+        except Exception:
+            subtest_failed(job, traceback.format_exc(), False)
+        except:
+            # interrupted: leave the job in the queue
+            process_emails.get_job_queue().release(job['id'])
+            raise
 
-    jobs = read_queue()
 
-    if len(jobs)==0:
+def sandboxes_per_worker():
+    """Returns the number of sandboxes each testing worker keeps for
+    itself: one for each shard of the most sharded assignment (see
+    conf.subtest_shards), but not more than there are."""
+
+    nshards = max([1] + getattr(conf, 'subtest_shards', {}).values())
+    return min(nshards, len(subtest.sandboxes()))
+
+
+def worker_count():
+    """Returns the number of testing workers to run, conf.subtest_workers,
+    but at most as many as have sandboxes of their own (see
+    conf.subtest_sandboxes and sandboxes_per_worker()): tests running at
+    the same time must not share a sandbox user."""
+
+    nworkers = getattr(conf, 'subtest_workers', 1)
+    nsandboxes = len(subtest.sandboxes())
+    nmax = nsandboxes // sandboxes_per_worker()
+    if nworkers > nmax:
+        log_global.warn("subtest_workers is %d, but there are %d sandbox(es) in subtest_sandboxes "
+                        "(%d per worker): testing with %d worker(s)"
+                        % (nworkers, nsandboxes, sandboxes_per_worker(), nmax))
+        return nmax
+    return nworkers
+
+
+def use_sandboxes(number):
+    """Makes this process test in the sandboxes of worker number."""
+
+    n = sandboxes_per_worker()
+    subtest.worker_sandboxes = range(number*n, (number+1)*n)
+
+
+def _subtest_worker_process(number, stop):
+    # do not inherit the daemon's handler (see wakeup.run_daemon)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    use_sandboxes(number)
+    try:
+        subtest_worker(stop)
+    except:
+        stop.set()
+        log_global.exception("Testing worker %d failed" % number)
+        raise
+
+
+def process_queue_parallel(nworkers):
+    """Tests the jobs in the queue with nworkers worker processes, each
+    claiming jobs independently (and testing them in its own
+    temporary directory and sandboxes, see use_sandboxes()). A
+    failing worker (failing jobs do not stop it, see subtest_failed())
+    stops the others once their current job is done; an exception is
+    then raised, as in serial testing."""
+
+    stop = multiprocessing.Event()
+    workers = [multiprocessing.Process(target=_subtest_worker_process, args=(i, stop))
+               for i in range(nworkers)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    failed = [w for w in workers if w.exitcode != 0]
+    if len(failed) > 0:
+        raise StandardError, "%d of %d testing worker(s) failed (exit codes %s)" \
+              % (len(failed), nworkers, [w.exitcode for w in failed])
+
+
+def process_queue():
+
+    start = time.time()
+    pending = process_emails.get_job_queue().count(jobqueue.PENDING)
+    if pending == 0:
         log_global.info("Queue empty, quitting")
     else:
-        log_global.info("Found %d job(s) (%s)" % (len(jobs),[job['id'] for job in jobs]))
+        log_global.info("Found %d job(s)" % pending)
 
-    for job in jobs:
-        log_global.info("Processing %s" % (job['qfilename']))
-        process_one_subtest(job)
+    nworkers = min(worker_count(), pending)
+    if nworkers > 1:
+        log_global.info("Testing with %d workers" % nworkers)
+        process_queue_parallel(nworkers)
+    else:
+        use_sandboxes(0)
+        subtest_worker()
+
+    policy = getattr(conf, 'subtest_schedule', 'fifo')
+    stats = process_emails.get_job_queue().turnaround(policy, since=start)
+    if stats is not None:
+        log_global.info("Turnaround of %d job(s) (%s): mean %.1fs, p95 %.1fs" % (stats[0], policy, stats[1], stats[2]))
+
+
+def _max_archive():
+    return getattr(conf, 'subtest_max_archive', 64*1048576)
+
+
+def coordinator_job(q_id, worker):
+    """Returns job q_id if worker holds its claim, and None otherwise
+    (the lease expired, and the job was handed to another worker)."""
+
+    queue = process_emails.get_job_queue()
+    if queue.claimant(q_id) != worker:
+        log_global.warn("Ignoring report on job %d from %s, which does not hold its claim" % (q_id,worker))
+        return None
+    return job_record(queue.get(q_id))
+
+
+def coordinator_inputs(job):
+    """Returns what a worker needs to test job: the message entries
+    for run_pytest_constrained, and the archive with the test file,
+    the job record and the submitted files."""
+
+    testcodefiles = test_files(job['assignment'])
+    all_submitted_files = sorted(conf.assignments[job['assignment']].keys())
+
+    files = [('test/'+testcodefile, os.path.join(conf.subtest_testcodedir, job['assignment'], testcodefile))
+             for testcodefile in testcodefiles]
+    files.append(('job/'+job['qfilename'], job['qfilepath']))
+    for fn in all_submitted_files:
+        path = os.path.join(job['student_lab_dir'], fn)
+        if os.path.exists(path):
+            files.append(('files/'+fn, path))
+
+    log_global.info("Handing out %s" % job['qfilename'])
+    return ({'testfiles': testcodefiles, 'shards': test_shards(job['assignment']),
+             'files': all_submitted_files, 'jobfile': job['qfilename'],
+             'maxseconds': conf.subtest_maxseconds, 'pytest_args': conf.pytest_additional_arguments},
+            subtestremote.pack(files))
+
+
+def coordinator_finish(q_id, worker, archive):
+    """Unpacks the result of job q_id from worker into the student's
+    lab directory, and reports it as process_one_subtest() does."""
+
+    job = coordinator_job(q_id, worker)
+    if job is None:
+        return
+    log_global.info("Received result of %s from %s" % (job['qfilename'],worker))
+
+    # as run_pytest_constrained names the directory
+    test_run_dir = os.path.join(job['student_lab_dir'],
+                                "_test-"+datetime.datetime.now().strftime("%Y-%m-%d-%H:%M:%S"))
+    if os.path.isdir(test_run_dir):
+        os.rename(test_run_dir, test_run_dir + str(time.time()))
+    tmpdir = tempfile.mkdtemp(prefix='.incoming-', dir=job['student_lab_dir'])
+    try:
+        subtestremote.safe_extract(archive, tmpdir, _max_archive())
+        os.rename(tmpdir, test_run_dir)
+    except subtestremote.PayloadTooLarge:
+        # another run would produce as much
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        subtest_failed(job, "Result from worker %s:\n%s" % (worker,traceback.format_exc()), False, worker)
+        return
+    except:
+        # a broken archive: the worker may do better next time
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        subtest_failed(job, "Result from worker %s:\n%s" % (worker,traceback.format_exc()), True, worker)
+        return
+
+    try:
+        report_subtest(job, test_run_dir, worker)
+    except Exception:
+        subtest_failed(job, traceback.format_exc(), False, worker)
+
+
+def coordinator_fail(q_id, worker, error, exception):
+    """Handles job q_id, which worker could not test (raising
+    exception, the name of its class, with traceback error) as
+    subtest_worker() does."""
+
+    job = coordinator_job(q_id, worker)
+    if job is None:
+        return
+    infrastructure = exception in [e.__name__ for e in infrastructure_failures]
+    subtest_failed(job, "Worker %s:\n%s" % (worker,error), infrastructure, worker)
+
+
+def run_coordinator():
+    """Hands out the jobs in the queue to workers (process_subtests.py
+    --worker on this or other hosts) at conf.subtest_coordinator, see
+    subtestremote.py. Returns on SIGTERM or SIGINT."""
+
+    stop = []
+    def handle_signal(signum, frame):
+        log_global.info("Received signal %d, will stop" % signum)
+        stop.append(signum)
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    server = subtestremote.Coordinator(conf.subtest_coordinator, getattr(conf, 'subtest_coordinator_token', None),
+                                       subtestqueue_claim, coordinator_inputs,
+                                       coordinator_finish, coordinator_fail,
+                                       log_global, max_size=_max_archive())
+    server.timeout = 1
+    log_global.info("Coordinator listening on %s" % repr(server.server_address))
+
+    last_pulse = 0
+    try:
+        while not stop:
+            server.handle_request()
+            if time.time() - last_pulse >= 60:
+                write_pulse()
+                last_pulse = time.time()
+    finally:
+        server.server_close()
+    log_global.info("Coordinator stopped")
+
+
+def remote_test(header, archive):
+    """Tests a job received from the coordinator (see
+    coordinator_inputs) and returns the archive of the results."""
+
+    workdir = tempfile.mkdtemp(prefix='tetepy-worker-')
+    try:
+        subtestremote.safe_extract(archive, workdir, _max_archive())
+        def path(*names):
+            return os.path.join(workdir, *[os.path.basename(name) for name in names])
+        testcodepaths = [path('test', fn) for fn in header['testfiles']]
+        environment = test_environment(header['job']['assignment'], testcodepaths)
+        test_run_dir = run_constrained(testcodepaths, header['shards'],
+                                       rundirectorypath=workdir,
+                                       rundirectoryname='result',
+                                       other_submitted_filepaths=[path('files', fn) for fn in header['files']],
+                                       jobfilepath=path('job', header['jobfile']),
+                                       maxseconds=header['maxseconds'],
+                                       pytest_args=header['pytest_args'],
+                                       environment=environment)
+        return subtestremote.pack_directory(test_run_dir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _remote_worker_process(number):
+    stop = []
+    def handle_signal(signum, frame):
+        stop.append(signum)
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # the parent passes it on
+    use_sandboxes(number)
+
+    name = worker_name()
+    try:
+        subtestremote.run_worker(conf.subtest_coordinator, getattr(conf, 'subtest_coordinator_token', None),
+                                 name, remote_test, log_global,
+                                 poll=getattr(conf, 'subtest_worker_poll', 2),
+                                 max_size=_max_archive(), stop=stop)
+    except:
+        log_global.exception("Testing worker %d failed" % number)
+        raise
+
+
+def run_remote_workers():
+    """Runs worker_count() worker processes testing jobs from the
+    coordinator at conf.subtest_coordinator. Returns on SIGTERM or
+    SIGINT once the workers have finished their current job, or when
+    all workers have failed."""
+
+    nworkers = worker_count()
+    workers = [multiprocessing.Process(target=_remote_worker_process, args=(i,))
+               for i in range(nworkers)]
+    for worker in workers:
+        worker.start()
+
+    def handle_signal(signum, frame):
+        log_global.info("Received signal %d, stopping workers" % signum)
+        for worker in workers:
+            if worker.is_alive():
+                os.kill(worker.pid, signal.SIGTERM)
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    log_global.info("Started %d worker(s) for the coordinator at %s" % (nworkers,repr(conf.subtest_coordinator)))
+    for worker in workers:
+        worker.join()
+
+
+def _label(value):
+    return '"%s"' % str(value).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')
+
+
+def write_metrics(filename):
+    """Writes the depth of the testing queue and the histograms of
+    queue wait, testing time and turnaround per assignment (see
+    jobqueue.py) to filename in the Prometheus text format, for the
+    node exporter's textfile collector."""
+
+    queue = process_emails.get_job_queue()
+    module = _label(Modulecode.lower())
+    lines = []
+
+    lines.append("# HELP tetepy_subtest_queue_jobs Jobs in the testing queue.")
+    lines.append("# TYPE tetepy_subtest_queue_jobs gauge")
+    for state in (jobqueue.PENDING, jobqueue.CLAIMED, jobqueue.FAILED):
+        lines.append("tetepy_subtest_queue_jobs{module=%s,state=%s} %d" % (module, _label(state), queue.count(state)))
+
+    histograms = queue.histograms()
+    for (metric, description) in ((jobqueue.WAIT, "Time from queueing a job to the start of its test."),
+                                  (jobqueue.RUN, "Time taken to test a job."),
+                                  (jobqueue.TURNAROUND, "Time from queueing a job to mailing its result.")):
+        name = "tetepy_subtest_%s_seconds" % metric
+        lines.append("# HELP %s %s" % (name, description))
+        lines.append("# TYPE %s histogram" % name)
+        for (key, (buckets, total, count)) in sorted(histograms.items()):
+            if key[0] != metric:
+                continue
+            labels = "module=%s,assignment=%s" % (module, _label(key[1]))
+            for le in jobqueue.histogram_buckets:
+                lines.append("%s_bucket{%s,le=%s} %d" % (name, labels, _label(le), buckets[le]))
+            lines.append("%s_sum{%s} %.3f" % (name, labels, total))
+            lines.append("%s_count{%s} %d" % (name, labels, count))
+
+    lines.append("# HELP tetepy_subtest_metrics_timestamp_seconds When these metrics were written.")
+    lines.append("# TYPE tetepy_subtest_metrics_timestamp_seconds gauge")
+    lines.append("tetepy_subtest_metrics_timestamp_seconds{module=%s} %.3f" % (module, time.time()))
+
+    # the collector must never see a partly written file
+    f = open(filename + '.tmp','w')
+    f.write("\n".join(lines) + "\n")
+    f.close()
+    os.rename(filename + '.tmp', filename)
+
+
+def write_pulse():
+    f=open(conf.subtest_pulsefile,'w')
+    data = {'now-secs':time.time(),'now-ascii':time.ctime(),'module':conf.ModulecodeSubjectLine,
+            'what':"process-subtest"}
+    f.write("%s" % repr(data))
+    f.close()
+
+    metricsfile = getattr(conf, 'subtest_metricsfile', None)
+    if metricsfile is not None:
+        write_metrics(metricsfile)
+
+
+def run_daemon():
+    """Stays resident and tests jobs as soon as process_emails queues
+    them (it wakes us up, see wakeup.py), rather than being started by
+    cron. Returns on SIGTERM or SIGINT once the queue is empty."""
+
+    wakeup.run_daemon("testing", process_queue, write_pulse,
+                      process_emails.subtest_wakeup_socket(),
+                      getattr(conf, 'subtest_daemon_pidfile',
+                              os.path.join(conf.Homedir,'log','process-subtests.pid')),
+                      getattr(conf, 'subtest_daemon_poll', 60), log_global)
 
 
 if __name__=="__main__":
+    daemon = '--daemon' in sys.argv[1:]
+    coordinator = '--coordinator' in sys.argv[1:]
+    worker = '--worker' in sys.argv[1:]
+
     #if live, wait a bit so that emails can be processed and put into testing queue
     # before we start going through the testing queue.
-    if live:
+    if live and not (daemon or coordinator or worker):
         if Modulecode == 'TEST':  # Make testing faster
             wait_time = 0;
         else:
@@ -370,7 +942,13 @@ if __name__=="__main__":
         time.sleep(wait_time)
 
     global log_global
-    log_global = startup(log_level=conf.log_level)
+    log_global = startup(log_level=conf.log_level, check_tests=not worker)
+
+    if worker:
+        # testing jobs of a coordinator, which holds the lock and the queue
+        run_remote_workers()
+        sys.exit(0)
+
     lock = lock_semaphore(conf.subtest_locks)
 
     if lock == False:
@@ -379,9 +957,16 @@ if __name__=="__main__":
 
         log_global.debug("About to read queue")
 
+        if daemon:
+            run = run_daemon
+        elif coordinator:
+            run = run_coordinator
+        else:
+            run = process_queue
+
         if live:
             try:
-                process_queue()
+                run()
                 unlock_semaphore(lock)
             except:
                 log_global.exception("Something went wrong (caught globally)")
@@ -395,13 +980,8 @@ if __name__=="__main__":
                 raise
 
         else:
-            process_queue()
+            run()
             unlock_semaphore(lock)
 
-    import datetime,time
-    f=open(conf.subtest_pulsefile,'w')
-    data = {'now-secs':time.time(),'now-ascii':time.ctime(),'module':conf.ModulecodeSubjectLine,
-            'what':"process-subtest"}
-    f.write("%s" % repr(data))
-    f.close()
+    write_pulse()
     log_global.debug("About to leave, updated pulse.")
@@ -0,0 +1,157 @@
+# This file is part of the TeTePy software
+# Copyright (c) 2017, 2018, University of Southampton
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+# Per-student admission control for the testing queue.
+#
+# Each (login, assignment) has a token bucket holding up to 'capacity'
+# tokens, which refills at one token per 'interval' seconds. Queueing
+# a submission for testing takes a token. A submission arriving when
+# the bucket is empty is saved and acknowledged as usual, but its test
+# is deferred: only the latest deferred job per (login, assignment) is
+# kept, and it is released into the testing queue as soon as a token
+# is available again (see release_due). Since the job refers to the
+# student's lab directory, it then tests the latest files submitted.
+#
+# Buckets and deferred jobs are kept in an sqlite database, so that
+# they are shared between runs and between ingestion workers.
+
+import ast, os, pprint, sqlite3, time
+
+_schema = """
+CREATE TABLE IF NOT EXISTS buckets (
+    login TEXT NOT NULL,
+    assignment TEXT NOT NULL,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (login, assignment)
+);
+CREATE TABLE IF NOT EXISTS deferred (
+    login TEXT NOT NULL,
+    assignment TEXT NOT NULL,
+    metadata TEXT NOT NULL,
+    time REAL NOT NULL,
+    PRIMARY KEY (login, assignment)
+);
+"""
+
+
+class RateLimiter(object):
+
+    def __init__(self, filename, capacity, interval):
+        self.filename = filename
+        self.capacity = capacity
+        self.interval = interval
+        self.pid = os.getpid()
+        # transactions are started explicitly (BEGIN IMMEDIATE), so
+        # that reading and updating a bucket is atomic
+        self.db = sqlite3.connect(filename, timeout=60, isolation_level=None)
+        self.db.executescript(_schema)
+
+    def _tokens(self, login, assignment, now):
+        row = self.db.execute("SELECT tokens, updated FROM buckets WHERE login=? AND assignment=?",
+                              (login, assignment)).fetchone()
+        if row is None:
+            return self.capacity
+        (tokens, updated) = row
+        return min(self.capacity, tokens + (now - updated) / float(self.interval))
+
+    def _take(self, login, assignment, now):
+        """Take a token if there is one (within a transaction). Returns
+        True if a token was taken."""
+        tokens = self._tokens(login, assignment, now)
+        if tokens < 1:
+            return False
+        self.db.execute("INSERT OR REPLACE INTO buckets (login, assignment, tokens, updated) VALUES (?, ?, ?, ?)",
+                        (login, assignment, tokens - 1, now))
+        return True
+
+    def admit(self, login, assignment, now=None):
+        """Return True (and take a token) if a submission of login for
+        assignment may be tested now. The deferred job for (login,
+        assignment), if any, is then forgotten: the admitted test runs
+        on the latest files."""
+        if now is None:
+            now = time.time()
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            admitted = self._take(login, assignment, now)
+            if admitted:
+                self.db.execute("DELETE FROM deferred WHERE login=? AND assignment=?", (login, assignment))
+        except:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+        return admitted
+
+    def next_admission(self, login, assignment, now=None):
+        """Return the time at which the next token for (login,
+        assignment) becomes available."""
+        if now is None:
+            now = time.time()
+        tokens = self._tokens(login, assignment, now)
+        return now + max(0, 1 - tokens) * self.interval
+
+    def defer(self, login, assignment, metadata, now=None):
+        """Keep metadata (a dictionary) as the deferred job for (login,
+        assignment), replacing any earlier one."""
+        if now is None:
+            now = time.time()
+        self.db.execute("INSERT OR REPLACE INTO deferred (login, assignment, metadata, time) VALUES (?, ?, ?, ?)",
+                        (login, assignment, pprint.pformat(metadata), now))
+
+    def release_due(self, push, now=None):
+        """Call push(metadata) for each deferred job which may now be
+        tested (taking a token for it), and forget the job. Returns
+        the number of jobs released. Each job is released in a
+        transaction of its own, and only forgotten once push has
+        returned, so that a failing push leaves the jobs released
+        before it forgotten and itself deferred."""
+        if now is None:
+            now = time.time()
+        released = 0
+        for (login, assignment) in self.db.execute(
+                "SELECT login, assignment FROM deferred ORDER BY time").fetchall():
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                # the job may have been replaced or admitted meanwhile
+                row = self.db.execute("SELECT metadata FROM deferred WHERE login=? AND assignment=?",
+                                      (login, assignment)).fetchone()
+                if row is not None and self._take(login, assignment, now):
+                    push(ast.literal_eval(row[0]))
+                    self.db.execute("DELETE FROM deferred WHERE login=? AND assignment=?", (login, assignment))
+                    released += 1
+            except:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+        return released
+
+    def close(self):
+        self.db.close()
@@ -235,7 +235,7 @@ if __name__ == "__main__":
 
     # Read student list, returns dictionary:
     # {'stud1@domain1':('stud1 name','stud1_group'), ...}
-    students = csvio.readcsv_group(conf.Studentlistcsvfile)
+    students = csvio.get_roster(conf.Studentlistcsvfile).students_with_groups()
 
     # Groups defined in config file.  Structure is a dictionary:
     # {'group1': {'lab3': '20 Nov 2009 09:00', 'lab4': '27 Nov 2009 09:00'},
@@ -29,6 +29,7 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import os, datetime, subprocess, time, re, exceptions, sys, tempfile, logging, shutil, errno, glob
+import ast, fcntl, hashlib, json, pipes, shlex, socket, stat, threading
 run_constrained_pytest_exe = os.path.expanduser("~/code/c/run_constrained_pytest")
 assert os.path.exists(run_constrained_pytest_exe),"Missing executable for constrained execution"
 
@@ -89,6 +90,487 @@ def run_time_limited_subprocess(command, maxseconds,check_dt=0.1,kill_dt=0.1):
     return s
 
 
+def sandboxes():
+    """Returns the sandboxes [(run_constrained_pytest executable, group
+    of the user it runs as)] of conf.subtest_sandboxes, by default
+    run_constrained_pytest_exe as run_stud."""
+    return list(getattr(conf, 'subtest_sandboxes', [(run_constrained_pytest_exe, 'run_stud')]))
+
+# The sandboxes (indices into sandboxes()) this process tests in: the
+# first, and one for each further shard of a job (see
+# run_pytest_sharded()). Tests running at the same time must each use
+# their own, so that the code tested in one cannot get at the files
+# and processes of another.
+worker_sandboxes = [0]
+
+
+_forkserver_processes = {}
+
+def forkserver_socket(sandbox):
+    """Returns the path of the fork server's socket for sandbox (each
+    sandbox has its own fork server)."""
+    if sandbox == 0:
+        return conf.subtest_forkserver_socket
+    return "%s.%d" % (conf.subtest_forkserver_socket, sandbox)
+
+
+def forkserver_request(request, timeout, sandbox):
+    """Sends request (a dictionary) to the fork server of sandbox (see
+    forkserver.py) and returns its reply."""
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.settimeout(timeout)
+        s.connect(forkserver_socket(sandbox))
+        s.sendall(json.dumps(request)+"\n")
+        data = ''
+        while not data.endswith("\n"):
+            chunk = s.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    finally:
+        s.close()
+    return json.loads(data)
+
+
+def start_forkserver(log_global, sandbox):
+    """Starts the fork server of sandbox (its run_constrained_pytest
+    --forkserver, preloading conf.subtest_forkserver_preload) unless it
+    is running already. It keeps running after we exit, for later jobs. Returns
+    True if the fork server answers.
+
+    We create the listening socket, which only we may connect to, and
+    pass it to the fork server: the code it tests runs as the same
+    user, and so must not be able to replace the socket. Hence its
+    directory must not be writable by anyone else."""
+    socketpath = forkserver_socket(sandbox)
+    st = os.stat(os.path.dirname(os.path.abspath(socketpath)))
+    if st.st_uid != os.getuid() or st.st_mode & 022:
+        log_global.error("Not using the fork server: the directory of %s must be ours, "
+                         "and not writable by others" % socketpath)
+        return False
+    lock = open(socketpath+'.lock','a')
+    try:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX) # parallel workers
+        try:
+            forkserver_request({'op': 'ping'}, 5, sandbox)
+            return True
+        except (socket.error, ValueError):
+            pass
+
+        if sandbox in _forkserver_processes:
+            _forkserver_processes[sandbox].poll() # reap the one that stopped
+        cmd = [sandboxes()[sandbox][0], '--forkserver'] + \
+            list(getattr(conf, 'subtest_forkserver_preload', []))
+        log_global.info("Starting fork server on %s: %s" % (socketpath, ' '.join(cmd)))
+        if os.path.exists(socketpath):
+            os.unlink(socketpath)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(socketpath)
+        os.chmod(socketpath, 0600)
+        listener.listen(16)
+        logfile = open(socketpath+'.log','a')
+        process = subprocess.Popen(cmd, stdin=listener.fileno(), stdout=logfile, stderr=logfile,
+                                   close_fds=True, preexec_fn=os.setsid)
+        _forkserver_processes[sandbox] = process
+        logfile.close()
+        listener.close()
+
+        start = time.time()
+        while time.time()-start < 60 and process.poll() is None:
+            try:
+                forkserver_request({'op': 'ping'}, 5, sandbox)
+                log_global.info("Fork server ready after %.1fs" % (time.time()-start))
+                return True
+            except (socket.error, ValueError):
+                time.sleep(0.1)
+        log_global.error("Fork server did not start (see %s.log)" % socketpath)
+        return False
+    finally:
+        lock.close()
+
+
+def run_in_forkserver(directory, test_ids, pytest_args, maxseconds, log_global, environment=None, sandbox=0):
+    """Runs py.test on test_ids (test files, or tests as
+    file::function) in directory in the fork server of sandbox
+    (starting it if needed), killing it after maxseconds, with the
+    directory environment (see assignment_environment()) in front of
+    the module search path if given. Returns
+    the exit code of py.test (negative if it was killed), or None if
+    the fork server cannot be used (then run_constrained_pytest is
+    to be started as usual). Raises RunConstrainedException if the
+    job failed before py.test started."""
+
+    if not start_forkserver(log_global, sandbox):
+        return None
+    args = list(test_ids) + ['-p', 'resultlog', '--resultlog='+pytest_log] + shlex.split(pytest_args)
+    open(os.path.join(directory,'pytest.command'),'a').write("forkserver: py.test %s\n" % ' '.join(args))
+    log_global.debug("Running py.test %s in the fork server" % ' '.join(args))
+    try:
+        reply = forkserver_request({'op': 'run', 'dir': directory, 'args': args,
+                                    'stdout': pytest_stdout, 'stderr': pytest_stderr,
+                                    'pythonpath': [environment] if environment else [],
+                                    'maxseconds': maxseconds}, maxseconds+60, sandbox)
+    except (socket.error, ValueError), e:
+        log_global.warn("Fork server failed (%s), will run run_constrained_pytest" % e)
+        return None
+    if reply.get('status') == 'timeout':
+        return -9
+    if reply.get('status') == 'exited':
+        return reply['code']
+    if reply.get('status') == 'failed':
+        raise RunConstrainedException, "Fork server could not run py.test %s in %s: %s" % (
+            ' '.join(args), directory, reply.get('error'))
+    log_global.warn("Fork server reports: %s, will run run_constrained_pytest" % reply.get('error'))
+    return None
+
+
+def _environment_sources(assignment, testfilepaths):
+    """Returns [(name in the environment, path)] of the files and
+    directories making up the environment of assignment."""
+    sources = [(os.path.join('test', os.path.basename(f)), f) for f in testfilepaths]
+    for libpath in list(getattr(conf, 'subtest_envcache_libs', [])) + \
+            list(getattr(conf, 'subtest_envcache_modules', {}).get(assignment, [])):
+        sources.append((os.path.basename(libpath.rstrip('/')), libpath))
+    return sources
+
+
+# files of the sources not copied into an environment
+_environment_ignored = ('*.pyc', '__pycache__')
+
+
+def _environment_files(name, source):
+    """Returns [(name in the environment, path)] of the files copied
+    from source into the environment as name."""
+    if not os.path.isdir(source):
+        return [(name, source)]
+    files = []
+    for (dirpath, dirnames, filenames) in os.walk(source):
+        ignored = set(shutil.ignore_patterns(*_environment_ignored)(dirpath, dirnames + filenames))
+        dirnames[:] = sorted(d for d in dirnames if d not in ignored)
+        for fn in sorted(filenames):
+            if fn not in ignored:
+                path = os.path.join(dirpath, fn)
+                files.append((os.path.join(name, os.path.relpath(path, source)), path))
+    return files
+
+
+def _environment_fingerprint(sources):
+    """Returns a hash of the interpreter, py.test and the name and
+    content of every file copied from sources, so that the same files
+    give the same environment wherever they are (remote workers get
+    the test files in a new directory for each job)."""
+    fingerprint = hashlib.sha1()
+    for f in (conf.subtest_envcache_python, conf.subtest_envcache_pytest):
+        st = os.stat(f)
+        fingerprint.update("%s %d %d\n" % (f, st.st_size, st.st_mtime))
+    for (name, source) in sources:
+        for (filename, path) in _environment_files(name, source):
+            f = open(path, 'rb')
+            try:
+                fingerprint.update("%s %s\n" % (filename, hashlib.sha1(f.read()).hexdigest()))
+            finally:
+                f.close()
+    return fingerprint.hexdigest()[:16]
+
+
+def _make_readonly(directory):
+    for (dirpath, dirnames, filenames) in os.walk(directory):
+        for fn in filenames:
+            os.chmod(os.path.join(dirpath, fn), 0444)
+        os.chmod(dirpath, 0555)
+
+
+def _remove_environment(directory):
+    for (dirpath, dirnames, filenames) in os.walk(directory):
+        os.chmod(dirpath, 0755)
+    shutil.rmtree(directory)
+
+
+def _build_environment(directory, sources, testfilenames, log_global):
+    """Builds the environment from sources in the new directory."""
+    os.mkdir(os.path.join(directory, 'test'))
+    for (name, source) in sources:
+        target = os.path.join(directory, name)
+        if os.path.isdir(source):
+            shutil.copytree(source, target, ignore=shutil.ignore_patterns(*_environment_ignored))
+        else:
+            shutil.copy2(source, target) # keeps the time recorded in the .pyc
+    env = {'PATH': os.environ.get('PATH', '/usr/bin:/bin'), 'PYTHONPATH': directory, 'LANG': 'C'}
+
+    cmd = [conf.subtest_envcache_python, '-m', 'compileall', '-q', directory]
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+    output = p.communicate()[0]
+    if p.returncode != 0:
+        raise StandardError, "Error executing '%s':\n%s" % (' '.join(cmd), output)
+
+    # py.test rewrites the asserts of test files, and keeps the result
+    # in __pycache__ next to them. Collecting the tests writes it (the
+    # test file cannot be imported without the student's code, but it
+    # is rewritten before that).
+    testdir = os.path.join(directory, 'test')
+    cmd = [conf.subtest_envcache_pytest, '--collect-only', '-q', '-p', 'no:cacheprovider'] + testfilenames
+    p = subprocess.Popen(cmd, cwd=testdir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+    p.communicate()
+    if not glob.glob(os.path.join(testdir, '__pycache__', '*pytest*.pyc')):
+        log_global.warn("py.test did not write the rewritten test file for %s" % directory)
+
+
+def assignment_environment(assignment, testfilepaths, log_global):
+    """Returns the directory with the precompiled environment of
+    assignment under conf.subtest_envcache (building it if needed), or
+    None if it cannot be built. The environment holds the test files
+    (list testfilepaths, in test/, with py.test's rewritten .pyc, see
+    copy_test_bytecode())
+    and the modules and packages of conf.subtest_envcache_libs and of
+    conf.subtest_envcache_modules[assignment], compiled by the sandbox's
+    python, read-only. It is put in front of the sandbox's module
+    search path. A change to any of its files, the interpreter or
+    py.test gives a new environment; the old one is removed when the
+    jobs that may still use it are over."""
+
+    cachedir = conf.subtest_envcache
+    try:
+        sources = _environment_sources(assignment, testfilepaths)
+        directory = os.path.join(cachedir, "%s-%s" % (assignment, _environment_fingerprint(sources)))
+        if not os.path.isdir(directory):
+            if not os.path.isdir(cachedir):
+                os.makedirs(cachedir)
+                os.chmod(cachedir, 0750) # run_stud reads it through the group
+            tmpdir = tempfile.mkdtemp(prefix='.build-', dir=cachedir)
+            try:
+                log_global.info("Building environment %s" % directory)
+                _build_environment(tmpdir, sources, [os.path.basename(f) for f in testfilepaths], log_global)
+                _make_readonly(tmpdir)
+            except:
+                _remove_environment(tmpdir)
+                raise
+            try:
+                os.rename(tmpdir, directory)
+            except OSError, e:
+                _remove_environment(tmpdir)
+                if e.errno not in (errno.EEXIST, errno.ENOTEMPTY): # built by another worker meanwhile
+                    raise
+    except Exception:
+        log_global.exception("Cannot build the environment for %s, testing without it" % assignment)
+        return None
+
+    # Environments of assignment that were replaced: mark them, and
+    # remove them once no job can be using them any more. The one in
+    # use may have been replaced before (and is current again): it
+    # must not be removed on the strength of that old mark.
+    try:
+        os.remove(directory + '.replaced')
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+    linger = max(600, 2 * getattr(conf, 'subtest_maxseconds', 60))
+    for name in os.listdir(cachedir):
+        old = os.path.join(cachedir, name)
+        if not re.match(re.escape(assignment) + r"-[0-9a-f]{16}$", name) or old == directory:
+            continue
+        marker = old + '.replaced'
+        try:
+            if not os.path.exists(marker):
+                open(marker, 'w').close()
+            elif time.time() - os.path.getmtime(marker) > linger:
+                _remove_environment(old)
+                os.remove(marker)
+                log_global.info("Removed environment %s" % old)
+        except OSError:
+            pass # removed by another worker
+    return directory
+
+
+def copy_test_bytecode(environment, testfilepath, rundirectory):
+    """Copies the rewritten test file from environment into
+    rundirectory (holding a copy of testfilepath), and gives that copy
+    the time of the environment's copy (which has the same content, but
+    may have been built from a copy of another time), so that py.test
+    uses it."""
+
+    testfilename = os.path.basename(testfilepath)
+    pycs = glob.glob(os.path.join(environment, 'test', '__pycache__',
+                                  os.path.splitext(testfilename)[0] + '.*pytest*.pyc'))
+    if not pycs:
+        return
+    cachedir = os.path.join(rundirectory, '__pycache__')
+    if not os.path.isdir(cachedir):
+        os.mkdir(cachedir)
+    for pyc in pycs:
+        shutil.copy(pyc, cachedir)
+        os.chmod(os.path.join(cachedir, os.path.basename(pyc)), 0664)
+    st = os.stat(os.path.join(environment, 'test', testfilename))
+    os.utime(os.path.join(rundirectory, testfilename), (st.st_atime, st.st_mtime))
+
+
+def collect_tests(testfilepath):
+    """Returns the py.test node ids (test_x.py::test_f) of the test
+    functions and Test classes defined at the top level of
+    testfilepath, in order, found without importing it. Test files
+    in syntax Python 2 cannot parse are searched line by line."""
+
+    testfilename = os.path.basename(testfilepath)
+    source = open(testfilepath).read()
+    try:
+        names = []
+        for node in ast.parse(source, testfilepath).body:
+            if isinstance(node, ast.FunctionDef) and node.name.startswith('test'):
+                names.append(node.name)
+            elif isinstance(node, ast.ClassDef) and node.name.startswith('Test'):
+                names.append(node.name)
+    except SyntaxError:
+        names = re.findall(r"^(?:async\s+)?def\s+(test\w*)\s*\(|^class\s+(Test\w*)", source, re.M)
+        names = [f or c for (f, c) in names]
+    return ["%s::%s" % (testfilename, name) for name in names]
+
+
+def collect_all_tests(testfilepaths):
+    """Returns the node ids of the tests in testfilepaths (see
+    collect_tests()); a test file in which no tests are found is run
+    as a whole."""
+
+    test_ids = []
+    for f in testfilepaths:
+        test_ids.extend(collect_tests(f) or [os.path.basename(f)])
+    return test_ids
+
+
+def make_shards(test_ids, nshards):
+    """Returns test_ids dealt out to (at most) nshards lists, in turn."""
+
+    shards = [test_ids[i::nshards] for i in range(nshards)]
+    return [shard for shard in shards if shard]
+
+
+def _resultlog_entries(filename):
+    """Returns the entries of a py.test result log (one per test: a
+    line starting with the outcome and the node id, then indented
+    lines of details)."""
+    entries = []
+    for line in open(filename).readlines():
+        if entries and line.startswith(' '):
+            entries[-1] += line
+        else:
+            entries.append(line)
+    return entries
+
+
+def merge_shard_results(resultdirectory, shard_directories, test_ids):
+    """Combines the results of the shards (in shard_directories) into
+    resultdirectory as if all tests had been run at once: the result
+    log has the entries of all shards in the order of test_ids, the
+    output files hold those of the shards one after the other, and the
+    status is 'unterminated' if any shard did not terminate. Then
+    conf.parse_pytest_report reads the merged results as usual."""
+
+    def node(entry):
+        # The result log names a test <run directory>/test_x.py:test_f
+        # (test_x.py:TestC().test_m for methods), or just
+        # <run directory>/test_x.py if the file could not be collected;
+        # each shard has a run directory of its own. Returns the test
+        # as test_x.py::test_f (or test_x.py).
+        name = entry.split('\n')[0].split(' ', 1)[-1].strip()
+        m = re.match(r"(.*?\.py)(?::+(.*))?$", name)
+        if m is None:
+            return name
+        (path, test) = m.groups()
+        if test is None:
+            return os.path.basename(path)
+        return "%s::%s" % (os.path.basename(path), test)
+
+    def order(entry):
+        name = node(entry)
+        for (i, test_id) in enumerate(test_ids):
+            if name == test_id or test_id.startswith(name + '::') or \
+                    any(name.startswith(test_id + sep) for sep in ('::', '[', '(', '.')):
+                return i
+        return len(test_ids)
+
+    # Errors in collecting a test file (e.g. if the student's code
+    # cannot be imported) are reported by each shard: keep the first.
+    entries = []
+    for d in shard_directories:
+        if os.path.exists(os.path.join(d, pytest_log)):
+            seen = set(node(entry) for entry in entries)
+            entries.extend(entry for entry in _resultlog_entries(os.path.join(d, pytest_log))
+                           if node(entry) not in seen)
+    entries.sort(key=order) # stable: entries of one test stay in order
+    f = open(os.path.join(resultdirectory, pytest_log), 'w')
+    f.write("".join(entries))
+    f.close()
+
+    for filename in (pytest_stdout, pytest_stderr):
+        f = open(os.path.join(resultdirectory, filename), 'w')
+        for d in shard_directories:
+            if os.path.exists(os.path.join(d, filename)):
+                f.write(open(os.path.join(d, filename)).read())
+        f.close()
+
+    statuses = [open(os.path.join(d, statusfilename)).readlines()[-1]
+                for d in shard_directories if os.path.exists(os.path.join(d, statusfilename))]
+    unterminated = [line for line in statuses if '::unterminated::' in line]
+    f = open(os.path.join(resultdirectory, statusfilename), 'w')
+    f.write((unterminated + statuses)[0] if statuses else
+            "fail::%s::unterminated::\n" % datetime.datetime.now().isoformat())
+    f.close()
+
+
+def run_pytest_sharded(submissionfilepath, testfilepaths, log_global, nshards,
+                       rundirectoryname=None, rundirectorypath=None, **kwargs):
+    """As run_pytest_constrained, for the test files testfilepaths, but
+    with their tests split into nshards shards (see make_shards()),
+    each run in a sandbox of its own (of worker_sandboxes) at the same
+    time, with the same time limit; with fewer sandboxes than nshards,
+    there are as many shards as sandboxes. The results of shard i are kept in shard-i in the
+    result directory, and merged into it (see merge_shard_results()).
+    Other keyword arguments are passed on to run_pytest_constrained.
+
+    Returns the result directory."""
+
+    if rundirectoryname == None:
+        d=datetime.datetime.now();
+        rundirectoryname = "_test-"+d.strftime("%Y-%m-%d-%H:%M:%S")
+    if rundirectorypath == None:
+        rundirectorypath = ''
+    resultdirectory = os.path.join(rundirectorypath,rundirectoryname)
+    if os.path.isdir(resultdirectory):
+        os.rename(resultdirectory, resultdirectory + str(time.time()))
+    os.mkdir(resultdirectory)
+
+    if nshards > len(worker_sandboxes):
+        log_global.warn("%d sandbox(es) for %d shards: running %d shard(s)"
+                        % (len(worker_sandboxes), nshards, len(worker_sandboxes)))
+        nshards = len(worker_sandboxes)
+    test_ids = collect_all_tests(testfilepaths)
+    shards = make_shards(test_ids, nshards)
+    log_global.info("Running %d test(s) in %d shard(s)" % (sum(len(shard) for shard in shards), len(shards)))
+    shard_directories = [None] * len(shards)
+    errors = []
+
+    def run_shard(i):
+        try:
+            shard_directories[i] = run_pytest_constrained(submissionfilepath, testfilepaths[0], log_global,
+                                                          rundirectoryname="shard-%d" % (i+1),
+                                                          rundirectorypath=resultdirectory,
+                                                          other_testfilepaths=testfilepaths[1:],
+                                                          test_ids=shards[i], sandbox=worker_sandboxes[i],
+                                                          **kwargs)
+        except:
+            errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=run_shard, args=(i,)) for i in range(len(shards))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+    merge_shard_results(resultdirectory, shard_directories, test_ids)
+    return resultdirectory
+
+
 def run_pytest(submissionfilepath, testfilepath, log_global, jobfilepath=None, rundirectoryname=None, 
                rundirectorypath=None,maxseconds=10):
     """Given a submissionfilepath (that is the path of the file coming from the student) 
@@ -155,7 +637,8 @@ def run_pytest_constrained(submissionfilepath, testfilepath, log_global,
                            other_submitted_filepaths=[],
                            rundirectoryname=None, 
                            rundirectorypath=None, jobfilepath=None,
-                           maxseconds=10, pytest_args='',):
+                           maxseconds=10, pytest_args='', environment=None,
+                           other_testfilepaths=[], test_ids=None, sandbox=None):
     """
     Run py.test on a given test_*.py file to analyse some piece of code.
     Do this in a sandboxed-environment. If it is Python code, the piece of
@@ -204,6 +687,24 @@ def run_pytest_constrained(submissionfilepath, testfilepath, log_global,
         Additional arguments to be given to py.test. For C-code testing, this
         might include ...?
 
+      environment : str or None
+        precompiled environment of the assignment (see
+        assignment_environment()) to put in front of the module search
+        path, or None.
+
+      other_testfilepaths : list of str
+        further test_*.py files of the assignment (copied next to
+        testfilepath, and run as well).
+
+      test_ids : list of str or None
+        the tests to run, as py.test node ids (test_x.py::test_f) of
+        the test files, or None to run all of them (see
+        run_pytest_sharded()).
+
+      sandbox : int or None
+        the sandbox (index into sandboxes()) to run in, or None for
+        the first of this process (see worker_sandboxes).
+
     Returns
     -------
 
@@ -276,11 +777,15 @@ def run_pytest_constrained(submissionfilepath, testfilepath, log_global,
         return os.path.join(tmprundirectory,fname)
 
 
-    # the run_stud executable will run with the id of user run_stud. To
+    # the run_stud executable will run with the id of user run_stud (or
+    # the user of our sandbox, see sandboxes()). To
     # be allowed to write to the temporary directory, we need to give
     # give permission for this. First, make the unix group of the directory
     # to be run_stud's group:
-    cmd = 'chgrp run_stud %s' % (tmprundirectory)
+    if sandbox is None:
+        sandbox = worker_sandboxes[0]
+    (wrapper, group) = sandboxes()[sandbox]
+    cmd = 'chgrp %s %s' % (group, tmprundirectory)
     log_global.debug(cmd)
     # if the this fails, we need to check the right cross-wise group member ship between
     # the account with the module code (for example sesa2006) and the account to run
@@ -290,8 +795,8 @@ def run_pytest_constrained(submissionfilepath, testfilepath, log_global,
     try:
         assert os.system(cmd) == 0,"Error executing '%s'" % cmd
     except AssertionError, msg:
-        mymsg = "If this fails, it could mean that the current user is not in the"+\
-            "run_stud group and vice versa (check in /etc/group)."
+        mymsg = "If this fails, it could mean that the current user is not in the "+\
+            "%s group and vice versa (check in /etc/group)." % group
         mymsg += "The error we caught was \n\t{}".format(msg)
         print(mymsg)
         log_global.error(mymsg)
@@ -303,8 +808,12 @@ def run_pytest_constrained(submissionfilepath, testfilepath, log_global,
 
     #the list of files that contains the tests to be carried out (typically having
     #names starting with 'test_'. We use only one file at the moment.
-    for f in [testfilepath]:
+    for f in [testfilepath] + list(other_testfilepaths):
         copy_helper(f, tmprundirectory, log_global)
+        if environment:
+            copy_test_bytecode(environment, f, tmprundirectory)
+    if test_ids is None:
+        test_ids = [os.path.basename(f) for f in [testfilepath] + list(other_testfilepaths)]
 
     # if given, copy job summary file into testing directory. Do this 
     # before copying any other files (this is the file we can lose as it provides
@@ -353,32 +862,58 @@ def run_pytest_constrained(submissionfilepath, testfilepath, log_global,
         else:
             log_global.debug("File %s is not there. Not submitted by student. Not copying to testing directory" % tmp_f)
 
-    #actual execution of testing procedure
-    cmd = "cd %s && %s %s -p resultlog --resultlog=%s %s > %s 2> %s" % (
-        path(""), run_constrained_pytest_exe, path(testfilename),
-        pytest_log, pytest_args, pytest_stdout, pytest_stderr)
-
-    open(path('pytest.command'),'a').write(cmd+"\n")
-
-    log_global.debug("Executing '%s'" % cmd)
-
-    subprocess  = run_time_limited_subprocess(cmd, maxseconds=maxseconds)
-
-    assert subprocess.returncode!=None,"Subprocess (%s) hasn't terminated return -- should be impossible" % cmd
-
-    log_global.debug( "subprocess.returncode=%d" % subprocess.returncode)
-
-    if subprocess.returncode < 0:
-        log_global.info("WARNING: code to be tested didn't terminate within given time limit")
-        open(path(statusfilename),'a').write("fail::%s::unterminated::\n" %  (datetime.datetime.now().isoformat()))
-    elif subprocess.returncode in [0]: #all okay, 
-        open(path(statusfilename),'a').write("okay::%s::retcode=%d\n" % (datetime.datetime.now().isoformat(),subprocess.returncode))
-    elif subprocess.returncode == 1: # some run_constrained reported problem
-        open(path(statusfilename),'a').write("fail::%s::retcode=%d:violation?\n" % (datetime.datetime.now().isoformat(),subprocess.returncode))
-        raise RunConstrainedException, "Run_constrained reports an error when running '%s' (returncode=%s)" % (cmd,subprocess.returncode)
-    elif subprocess.returncode >= 2: # not sure what this means
-        open(path(statusfilename),'a').write("fail::%s::retcode=%d:?\n" % (datetime.datetime.now().isoformat(),subprocess.returncode))
-        raise StandardError, "Should be impossible: running '%s' results in returncode=%s" % (cmd,subprocess.returncode)
+    #actual execution of testing procedure: in the fork server if there
+    #is one (the fastest way), or else by starting run_constrained_pytest
+    forkserver_returncode = None
+    if getattr(conf, 'subtest_forkserver_socket', None):
+        forkserver_returncode = run_in_forkserver(path(""), test_ids, pytest_args,
+                                                  maxseconds, log_global, environment, sandbox)
+
+    if forkserver_returncode is not None:
+        if forkserver_returncode < 0:
+            log_global.info("WARNING: code to be tested didn't terminate within given time limit")
+            open(path(statusfilename),'a').write("fail::%s::unterminated::\n" %  (datetime.datetime.now().isoformat()))
+        elif forkserver_returncode in [0,1] or (forkserver_returncode == 2 and os.path.exists(path(pytest_log))):
+            # py.test's own exit code: 1 if some test failed, 2 if it
+            # could not collect the tests (reported in its log)
+            open(path(statusfilename),'a').write("okay::%s::retcode=%d\n" % (datetime.datetime.now().isoformat(),forkserver_returncode))
+        else: # py.test was interrupted, or failed itself
+            open(path(statusfilename),'a').write("fail::%s::retcode=%d:?\n" % (datetime.datetime.now().isoformat(),forkserver_returncode))
+            raise RunConstrainedException, "py.test in the fork server reports an error in %s (returncode=%s, see %s)" % (
+                path(""),forkserver_returncode,pytest_stderr)
+    else:
+        if environment:
+            environment_args = "--pythonpath %s " % environment
+        else:
+            environment_args = ""
+        # (run_constrained_pytest runs py.test in the directory of its
+        # first argument, which is passed on without the directory)
+        cmd = "cd %s && %s %s%s -p resultlog --resultlog=%s %s > %s 2> %s" % (
+            path(""), wrapper, environment_args,
+            " ".join(pipes.quote(x) for x in [path(test_ids[0])] + test_ids[1:]),
+            pytest_log, pytest_args, pytest_stdout, pytest_stderr)
+
+        open(path('pytest.command'),'a').write(cmd+"\n")
+
+        log_global.debug("Executing '%s'" % cmd)
+
+        subprocess  = run_time_limited_subprocess(cmd, maxseconds=maxseconds)
+
+        assert subprocess.returncode!=None,"Subprocess (%s) hasn't terminated return -- should be impossible" % cmd
+
+        log_global.debug( "subprocess.returncode=%d" % subprocess.returncode)
+
+        if subprocess.returncode < 0:
+            log_global.info("WARNING: code to be tested didn't terminate within given time limit")
+            open(path(statusfilename),'a').write("fail::%s::unterminated::\n" %  (datetime.datetime.now().isoformat()))
+        elif subprocess.returncode in [0]: #all okay, 
+            open(path(statusfilename),'a').write("okay::%s::retcode=%d\n" % (datetime.datetime.now().isoformat(),subprocess.returncode))
+        elif subprocess.returncode == 1: # some run_constrained reported problem
+            open(path(statusfilename),'a').write("fail::%s::retcode=%d:violation?\n" % (datetime.datetime.now().isoformat(),subprocess.returncode))
+            raise RunConstrainedException, "Run_constrained reports an error when running '%s' (returncode=%s)" % (cmd,subprocess.returncode)
+        elif subprocess.returncode >= 2: # not sure what this means
+            open(path(statusfilename),'a').write("fail::%s::retcode=%d:?\n" % (datetime.datetime.now().isoformat(),subprocess.returncode))
+            raise StandardError, "Should be impossible: running '%s' results in returncode=%s" % (cmd,subprocess.returncode)
 
 
     # Now remove the group-access bits in the temporary directory's
@@ -0,0 +1,263 @@
+# This file is part of the TeTePy software
+# 
+# Copyright (c) 2017, 2018, University of Southampton
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# The fork server: a warm py.test for the sandbox.
+#
+# Started by run_constrained_pytest --forkserver (so it runs as the
+# sandbox user, with the wrapper's limits and environment), it imports
+# py.test and the modules given on the command line once, and then
+# accepts connections on the listening unix socket it gets as its
+# stdin. The socket is created by the module account, in a directory
+# the sandbox user cannot write, so that the code tested (which runs
+# as the same user as the server) can neither connect to it nor put a
+# socket of its own in its place. For each job it forks a runner, which
+# forks the job's process from this warm template: starting py.test
+# for a job costs a fork rather than an interpreter start and the
+# imports. The job's process
+#
+#   - has its own process group (killed as a whole on timeout),
+#   - gets the wrapper's CPU time limit (which the template itself
+#     does not have, as it lives much longer than a job),
+#   - runs py.test in the job's directory with stdout and stderr in
+#     files there, as run_constrained_pytest would.
+#
+# Requests and replies are lines of JSON, one request per connection:
+#
+#   {"op": "ping"}  ->  {"status": "ok", "pid": pid}
+#   {"op": "run", "dir": directory, "args": [py.test arguments],
+#    "stdout": filename, "stderr": filename, "maxseconds": seconds,
+#    "pythonpath": [directories put in front of sys.path]}
+#       ->  {"status": "exited", "code": exit code of py.test}, or
+#           {"status": "timeout"}, or
+#           {"status": "failed", "error": text}  (the job's process
+#            failed before py.test started, see its stderr), or
+#           {"status": "error", "error": text}  (the server failed)
+#
+# The server exits when the wrapper that started it dies (so killing
+# the run_constrained_pytest process stops it), and when a preloaded
+# module's file changes (so that jobs never use stale code; the client
+# starts a new server). It must run with both Python 2 and 3, and only
+# use the standard library until pytest is imported.
+#
+# Usage: forkserver.py <cpu seconds> [module ...]  < listening socket
+
+import errno, json, os, resource, select, signal, socket, sys, time, traceback
+
+
+def _reply(conn, reply):
+    conn.sendall((json.dumps(reply) + "\n").encode('ascii'))
+
+
+def _read_request(conn):
+    data = b''
+    while not data.endswith(b"\n"):
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    return json.loads(data.decode('utf-8'))
+
+
+def _module_files(modules):
+    """Returns {file: mtime} of the modules preloaded (for pytest and
+    the other packages, the files of all their loaded submodules)."""
+    files = {}
+    for (name, module) in list(sys.modules.items()):
+        if module is None or name.split('.')[0] not in modules:
+            continue
+        filename = getattr(module, '__file__', None)
+        if filename:
+            try:
+                files[filename] = os.stat(filename).st_mtime
+            except OSError:
+                pass
+    return files
+
+
+def _changed(files):
+    for (filename, mtime) in files.items():
+        try:
+            if os.stat(filename).st_mtime != mtime:
+                return True
+        except OSError:
+            return True
+    return False
+
+
+def _job(request, cpu_seconds, started):
+    """Runs in the job's process: never returns. Writes to the file
+    descriptor started just before py.test starts, so that the runner
+    can tell failures of ours from py.test's exit codes."""
+    try:
+        os.setpgid(0, 0)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        (soft, hard) = resource.getrlimit(resource.RLIMIT_CPU)
+        if hard == resource.RLIM_INFINITY:
+            hard = cpu_seconds
+        limit = min(hard, cpu_seconds)
+        resource.setrlimit(resource.RLIMIT_CPU, (limit, limit))
+
+        os.chdir(request['dir'])
+        os.umask(0o007) # the caller reads the results through the group
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        for (fd, key) in ((1, 'stdout'), (2, 'stderr')):
+            f = os.open(request[key], os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o660)
+            os.dup2(f, fd)
+            os.close(f)
+        os.close(devnull)
+
+        sys.argv = ['py.test'] + list(request['args'])
+        sys.path[0:0] = list(request.get('pythonpath', []))
+        import pytest
+        os.write(started, b'1')
+        os.close(started)
+        code = pytest.main(list(request['args']))
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(int(code))
+    except SystemExit as e:
+        os._exit(e.code if isinstance(e.code, int) else 1)
+    except:
+        try:
+            traceback.print_exc()
+            sys.stderr.flush()
+        finally:
+            os._exit(3)
+
+
+def _runner(conn, cpu_seconds, files):
+    """Handles one connection (in a process forked for it)."""
+    try:
+        request = _read_request(conn)
+        if request.get('op') == 'ping':
+            _reply(conn, {"status": "ok", "pid": os.getppid()})
+            return
+        if request.get('op') != 'run':
+            _reply(conn, {"status": "error", "error": "unknown request %r" % request.get('op')})
+            return
+        if _changed(files):
+            _reply(conn, {"status": "error", "error": "preloaded modules changed, restarting"})
+            os.kill(os.getppid(), signal.SIGTERM)
+            return
+
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        (started_r, started_w) = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # the job must not talk to our client, or accept the next one
+            conn.close()
+            os.close(started_r)
+            _job(request, cpu_seconds, started_w)
+        os.close(started_w)
+
+        deadline = time.time() + float(request['maxseconds'])
+        status = None
+        while status is None:
+            (wpid, status) = os.waitpid(pid, os.WNOHANG)
+            if wpid != 0:
+                break
+            status = None
+            readable = select.select([conn], [], [], 0.01)[0]
+            gone = readable and not conn.recv(1)
+            if gone or time.time() > deadline:
+                try:
+                    os.killpg(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                os.waitpid(pid, 0)
+                if not gone:
+                    _reply(conn, {"status": "timeout"})
+                return
+
+        if not (select.select([started_r], [], [], 0)[0] and os.read(started_r, 1)):
+            _reply(conn, {"status": "failed", "error": "the job failed before py.test started (status %d)" % status})
+        elif os.WIFEXITED(status):
+            _reply(conn, {"status": "exited", "code": os.WEXITSTATUS(status)})
+        else:
+            _reply(conn, {"status": "exited", "code": -os.WTERMSIG(status)})
+        try:
+            os.killpg(pid, signal.SIGKILL) # anything the job left behind
+        except OSError:
+            pass
+    except:
+        try:
+            _reply(conn, {"status": "error", "error": traceback.format_exc()})
+        except socket.error:
+            pass
+
+
+def serve(listener, cpu_seconds, modules):
+    for name in ['pytest'] + modules:
+        try:
+            __import__(name)
+        except Exception:
+            sys.stderr.write("forkserver: cannot preload %s\n" % name)
+            traceback.print_exc()
+    files = _module_files(['pytest', '_pytest'] + [name.split('.')[0] for name in modules])
+
+    parent = os.getppid()
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN) # runners reap themselves
+    listener.settimeout(1)
+    sys.stderr.write("forkserver: pid %d listening on %s\n" % (os.getpid(), listener.getsockname()))
+    sys.stderr.flush()
+
+    while os.getppid() == parent:
+        try:
+            (conn, address) = listener.accept()
+        except socket.timeout:
+            continue
+        except socket.error as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        conn.settimeout(None)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        if os.fork() == 0:
+            listener.close()
+            try:
+                _runner(conn, cpu_seconds, files)
+            finally:
+                os._exit(0)
+        conn.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.stderr.write("usage: %s <cpu seconds> [module ...] < listening socket\n" % sys.argv[0])
+        sys.exit(1)
+    listener = socket.fromfd(0, socket.AF_UNIX, socket.SOCK_STREAM)
+    # (jobs must not get at the socket through their stdin)
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.close(devnull)
+    serve(listener, int(sys.argv[1]), sys.argv[2:])
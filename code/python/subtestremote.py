@@ -0,0 +1,319 @@
+# This file is part of the TeTePy software
+# Copyright (c) 2017, 2018, University of Southampton
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Testing on several hosts: a coordinator, which owns the testing
+# queue, hands out jobs over TCP to workers on the same or other hosts
+# (see process_subtests.py --coordinator and --worker).
+#
+# Each request is one TCP connection carrying one message each way. A
+# message is a line of JSON (the header), followed by 'size' bytes of
+# payload if the header has a 'size' entry. Payloads are gzipped tar
+# archives. Every request carries the shared secret token; requests
+# without it are refused.
+#
+#   worker:      {"op": "claim", "worker": name}
+#   coordinator: {"op": "none"}  (queue empty: ask again later), or
+#                {"op": "job", "job": metadata, ...}  + archive of the
+#                test file, the job record and the submitted files
+#   worker:      {"op": "result", "id": id, "worker": name} + archive
+#                of the result directory, or
+#                {"op": "failed", "id": id, "worker": name, "error": text,
+#                 "exception": name of the exception's class}
+#   coordinator: {"op": "ok"} or {"op": "error", "error": text}
+#
+# The token is checked before the payload is read. Archives are limited
+# to max_size bytes: a job whose input or result archive is larger fails
+# (without retries), as the worker would produce the same archive again.
+#
+# A job stays claimed (with the lease of the testing queue) while the
+# worker tests it. If the worker dies, the lease expires and the job is
+# handed out again; a late result of a job that is no longer claimed by
+# its worker is ignored. Archives from the other side are extracted
+# with safe_extract(), which refuses anything but plain files and
+# directories below the target directory.
+
+import cStringIO, hmac, os, socket, SocketServer, tarfile, time, traceback
+
+import jobqueue
+
+
+class ProtocolError(StandardError):
+    pass
+
+
+class PayloadTooLarge(ProtocolError):
+    pass
+
+
+def send_message(f, header, payload=None):
+    """Writes the message (header, a dictionary, and payload, a string
+    or None) to the file object f."""
+    header = dict(header)
+    if payload is not None:
+        header['size'] = len(payload)
+    f.write(jobqueue.encode_metadata(header) + "\n")
+    if payload is not None:
+        f.write(payload)
+    f.flush()
+
+
+def recv_header(f):
+    """Reads the header of a message from the file object f and returns
+    it (a dictionary)."""
+    line = f.readline(1048576)
+    if not line.endswith("\n"):
+        raise ProtocolError("Connection closed, or header too long")
+    try:
+        header = jobqueue.decode_metadata(line)
+    except ValueError, e:
+        raise ProtocolError("Malformed header: %s" % e)
+    if not isinstance(header, dict):
+        raise ProtocolError("Malformed header: %s" % repr(line[:100]))
+    return header
+
+
+def recv_payload(f, header, max_size):
+    """Reads the payload of the message with header from the file
+    object f and returns it (None if the message has none). Payloads
+    larger than max_size bytes are refused (PayloadTooLarge), without
+    reading them."""
+    size = header.get('size')
+    if size is None:
+        return None
+    if not isinstance(size, (int, long)) or size < 0:
+        raise ProtocolError("Malformed payload size %s" % repr(size))
+    if size > max_size:
+        raise PayloadTooLarge("Refusing payload of %d bytes (at most %d allowed)" % (size, max_size))
+    payload = f.read(size)
+    if len(payload) != size:
+        raise ProtocolError("Connection closed after %d of %d bytes" % (len(payload), size))
+    return payload
+
+
+def recv_message(f, max_size):
+    """Reads a message from the file object f and returns (header,
+    payload). Payloads larger than max_size bytes are refused."""
+    header = recv_header(f)
+    return (header, recv_payload(f, header, max_size))
+
+
+def pack(files):
+    """Returns a gzipped tar archive (a string) of files, a list of
+    (name in the archive, path)."""
+    data = cStringIO.StringIO()
+    tar = tarfile.open(fileobj=data, mode='w:gz')
+    for (name, path) in files:
+        tar.add(path, arcname=name)
+    tar.close()
+    return data.getvalue()
+
+
+def pack_directory(directory):
+    """Returns a gzipped tar archive of the contents of directory."""
+    return pack([(name, os.path.join(directory, name)) for name in sorted(os.listdir(directory))])
+
+
+def safe_extract(archive, directory, max_size):
+    """Extracts the gzipped tar archive (a string) into directory.
+    Raises ProtocolError (before extracting anything) if the archive
+    holds anything but plain files and directories or names outside
+    directory, and PayloadTooLarge if it holds more than max_size
+    bytes."""
+    tar = tarfile.open(fileobj=cStringIO.StringIO(archive), mode='r:gz')
+    members = tar.getmembers()
+    root = os.path.realpath(directory)
+    total = 0
+    for member in members:
+        if not (member.isfile() or member.isdir()):
+            raise ProtocolError("Refusing archive member %s (not a file or directory)" % repr(member.name))
+        target = os.path.realpath(os.path.join(root, member.name))
+        if os.path.isabs(member.name) or not target.startswith(root + os.sep):
+            raise ProtocolError("Refusing archive member %s (outside the target directory)" % repr(member.name))
+        member.mode &= 0777 # no setuid/setgid/sticky bits
+        total += member.size
+        if total > max_size:
+            raise PayloadTooLarge("Refusing archive with more than %d bytes" % max_size)
+    tar.extractall(root, members)
+    tar.close()
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        server = self.server
+        self.connection.settimeout(server.io_timeout)
+        try:
+            header = recv_header(self.rfile)
+            if not hmac.compare_digest(str(header.get('token', '')), server.token):
+                server.log.warn("Refused request from %s (wrong token)" % repr(self.client_address))
+                send_message(self.wfile, {"op": "error", "error": "refused"})
+                return
+            op = header.get('op')
+            worker = "%s (%s)" % (header.get('worker'), self.client_address[0])
+            try:
+                payload = recv_payload(self.rfile, header, server.max_size)
+            except PayloadTooLarge, e:
+                server.log.warn("Request from %s failed: %s" % (repr(self.client_address), e))
+                if op == "result":
+                    server.fail(header['id'], worker, "Result archive: %s" % e, e.__class__.__name__)
+                send_message(self.wfile, {"op": "error", "error": str(e)})
+                return
+            if op == "claim":
+                job = server.claim(worker)
+                if job is None:
+                    send_message(self.wfile, {"op": "none"})
+                    return
+                (extra, archive) = server.inputs(job)
+                if len(archive) > server.max_size:
+                    # the worker would refuse it
+                    e = PayloadTooLarge("Input archive of %d bytes (at most %d allowed)"
+                                        % (len(archive), server.max_size))
+                    server.log.warn("Cannot hand out job %d: %s" % (job['id'], e))
+                    server.fail(job['id'], worker, str(e), e.__class__.__name__)
+                    send_message(self.wfile, {"op": "none"})
+                    return
+                reply = {"op": "job", "job": job}
+                reply.update(extra)
+                send_message(self.wfile, reply, archive)
+            elif op == "result" and payload is not None:
+                server.finish(header['id'], worker, payload)
+                send_message(self.wfile, {"op": "ok"})
+            elif op == "failed":
+                server.fail(header['id'], worker, header.get('error', ''), header.get('exception', ''))
+                send_message(self.wfile, {"op": "ok"})
+            else:
+                raise ProtocolError("Unknown request %s" % repr(op))
+        except (ProtocolError, socket.error), e:
+            server.log.warn("Request from %s failed: %s" % (repr(self.client_address), e))
+        except:
+            server.log.exception("Request from %s failed" % repr(self.client_address))
+            try:
+                send_message(self.wfile, {"op": "error", "error": traceback.format_exc()})
+            except socket.error:
+                pass
+
+
+class Coordinator(SocketServer.TCPServer):
+    """Serves the requests of workers at address (host, port), one at a
+    time (all queue operations are short, and sqlite connections must
+    stay in one thread). The work is done by the functions passed in:
+
+      claim(worker)                 -> metadata of a claimed job, or None
+      inputs(job)                   -> (dictionary added to the job
+                                       message, archive for the worker)
+      finish(id, worker, archive)   -- the job's result arrived
+      fail(id, worker, error, exception)
+                                    -- the worker could not test the job,
+                                       or an archive of the job was
+                                       larger than max_size bytes
+
+    A worker that stops sending for io_timeout seconds is cut off."""
+
+    allow_reuse_address = True
+
+    def __init__(self, address, token, claim, inputs, finish, fail, log,
+                 max_size=64*1048576, io_timeout=60):
+        if not token:
+            raise ValueError("A token (shared secret) is required for the coordinator")
+        SocketServer.TCPServer.__init__(self, address, _Handler)
+        self.token = str(token)
+        self.claim, self.inputs, self.finish, self.fail = claim, inputs, finish, fail
+        self.log = log
+        self.max_size = max_size
+        self.io_timeout = io_timeout
+
+
+def request(address, token, header, payload=None, max_size=64*1048576, timeout=60):
+    """Sends one request (header and payload) to the coordinator at
+    address and returns its reply (header, payload)."""
+    header = dict(header)
+    header['token'] = token
+    s = socket.create_connection(address, timeout)
+    try:
+        f = s.makefile('rwb')
+        send_message(f, header, payload)
+        reply = recv_message(f, max_size)
+        f.close()
+    finally:
+        s.close()
+    if reply[0].get('op') == 'error':
+        raise ProtocolError("Coordinator reports an error: %s" % reply[0].get('error'))
+    return reply
+
+
+def run_worker(address, token, name, run, log, poll=2, max_size=64*1048576, stop=None):
+    """Claims jobs from the coordinator at address and tests them with
+    run(header, archive), which returns the archive of the result
+    directory, until stop (a list, or a multiprocessing.Event) is set.
+    Waits poll seconds when the queue is empty or the coordinator
+    cannot be reached. If run() raises an Exception, or returns an
+    archive larger than max_size bytes, the failure is reported to the
+    coordinator (which decides whether to retry the job), and the
+    worker goes on."""
+
+    def stopped():
+        if stop is None:
+            return False
+        if isinstance(stop, list):
+            return len(stop) > 0
+        return stop.is_set()
+
+    while not stopped():
+        try:
+            (header, archive) = request(address, token, {"op": "claim", "worker": name}, max_size=max_size)
+        except (socket.error, ProtocolError), e:
+            log.warn("Cannot claim a job from %s: %s" % (repr(address), e))
+            time.sleep(poll)
+            continue
+        if header.get('op') != 'job':
+            time.sleep(poll)
+            continue
+
+        q_id = header['job']['id']
+        log.info("Worker %s testing job %d" % (name, q_id))
+        try:
+            result = run(header, archive)
+            if len(result) > max_size:
+                raise PayloadTooLarge("Result archive of %d bytes (at most %d allowed)" % (len(result), max_size))
+        except Exception, e:
+            error = traceback.format_exc()
+            log.error("Worker %s failed to test job %d:\n%s" % (name, q_id, error))
+            try:
+                request(address, token, {"op": "failed", "id": q_id, "worker": name, "error": error,
+                                         "exception": e.__class__.__name__})
+            except (socket.error, ProtocolError), e:
+                log.error("Worker %s could not report the failure of job %d: %s" % (name, q_id, e))
+            continue
+        try:
+            request(address, token, {"op": "result", "id": q_id, "worker": name}, result, max_size=max_size)
+        except (socket.error, ProtocolError), e:
+            # the job is handed out again when its lease expires
+            log.error("Worker %s could not deliver the result of job %d: %s" % (name, q_id, e))
+            continue
+        log.info("Worker %s sent the result of job %d" % (name, q_id))
@@ -0,0 +1,137 @@
+# This file is part of the TeTePy software
+# Copyright (c) 2017, 2018, University of Southampton
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# 
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Wake-up notifications for resident queue workers.
+#
+# A worker running in daemon mode (process_subtests.py --daemon,
+# process_outgoing_mails.py --daemon) listens on a Unix domain
+# datagram socket. Whoever adds to its queue calls notify() on the
+# socket's path after the addition is committed, which wakes the
+# worker at once instead of at its next poll. Notifications carry no
+# data: a worker woken up processes everything in its queue, and
+# several notifications arriving while it is busy wake it only once.
+#
+# Notifying never fails: if no worker is listening (or its socket
+# buffer is full, so it will wake up anyway), the notification is
+# dropped, and the queue is picked up by the next poll or cron run.
+
+import errno, os, select, signal, socket, time
+
+# errors of sendto() meaning that nobody is listening, or that the
+# listener has notifications pending already
+_ignored_errors = (errno.ENOENT, errno.ECONNREFUSED, errno.EAGAIN, errno.ENOTDIR)
+
+
+def notify(path):
+    """Wakes up the worker listening on the socket path, if any."""
+
+    if path is None:
+        return
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        s.setblocking(0)
+        s.sendto('.', path)
+    except socket.error, e:
+        if e.errno not in _ignored_errors:
+            raise
+    finally:
+        s.close()
+
+
+class Listener(object):
+    """The receiving end of notify(), bound to the socket path. Only
+    one process may listen on a path: callers hold the queue's lock
+    (see lab_helpers.lock_semaphore), so a socket file left over from
+    an earlier worker is replaced."""
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            os.remove(path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(path)
+        self.socket.setblocking(0)
+
+    def wait(self, timeout):
+        """Blocks until notified, but at most timeout seconds. Returns
+        True if we were notified. All pending notifications are
+        consumed."""
+
+        try:
+            readable = select.select([self.socket], [], [], timeout)[0]
+        except select.error, e:
+            if e.args[0] == errno.EINTR: # signal, e.g. SIGTERM
+                return False
+            raise
+        if not readable:
+            return False
+        while True:
+            try:
+                self.socket.recv(64)
+            except socket.error, e:
+                if e.errno == errno.EAGAIN:
+                    return True
+                raise
+
+    def close(self):
+        self.socket.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def run_daemon(name, work, pulse, socketpath, pidfile, poll, log):
+    """Stays resident, calling work() whenever notified on socketpath,
+    and at least every poll seconds (to pick up anything missed, for
+    example work added while notify() had no listener, or retries).
+    Calls pulse() after each round as a heartbeat, and records our pid
+    in pidfile while running. Returns on SIGTERM or SIGINT after the
+    current round of work; exceptions from work() are passed on."""
+
+    stop = []
+    def handle_signal(signum, frame):
+        log.info("Received signal %d, will stop" % signum)
+        stop.append(signum)
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    listener = Listener(socketpath)
+    open(pidfile,'w').write("%d\n" % os.getpid())
+    log.info("Starting %s daemon (pid %d), listening on %s" % (name, os.getpid(), repr(socketpath)))
+
+    try:
+        while not stop:
+            work()
+            pulse()
+            if not stop and listener.wait(poll):
+                log.debug("Woken up by notification")
+    finally:
+        listener.close()
+        os.remove(pidfile)
+
+    log.info("%s daemon stopped" % name)